@@ -0,0 +1,150 @@
+"""
+Compare the sync ingest views under gunicorn (WSGI, threaded) with the
+async views under uvicorn (ASGI) while many webhook connections are open at
+once.
+
+    python -m benchmarks.asgi_vs_wsgi --requests 2000 --concurrency 200 --output asgi.json
+
+Each server runs in its own process against its own scratch SQLite database.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import httpx
+
+from benchmarks.harness import BASE_DIR, latency_summary, write_results
+from benchmarks.workload import Workload
+
+
+@contextmanager
+def server(command, port, database=None, **extra_env):
+    env = {
+        **os.environ,
+        "DJANGO_SETTINGS_MODULE": "benchmarks.server_settings",
+        "MESSAGING_SLOW_REQUEST_MS": "0",
+        **extra_env,
+    }
+    if database is not None:
+        env["BENCHMARK_DATABASE"] = str(database)
+    subprocess.run(
+        [sys.executable, "manage.py", "migrate", "--verbosity", "0"],
+        cwd=BASE_DIR, env=env, check=True
+    )
+    process = subprocess.Popen(command, cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def slow_body(payload, delay):
+    """Send the body in two halves ``delay`` seconds apart, like a webhook
+    sender on a slow network."""
+    body = json.dumps(payload).encode()
+
+    async def chunks():
+        yield body[:len(body) // 2]
+        await asyncio.sleep(delay)
+        yield body[len(body) // 2:]
+    return chunks()
+
+
+async def load(base_url, path, make_payload, count, concurrency, upload_delay=0):
+    samples, errors = [], 0
+    remaining = iter(range(count))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def connection():
+            nonlocal errors
+            for _ in remaining:
+                payload = make_payload()
+                began = time.perf_counter()
+                try:
+                    if upload_delay:
+                        response = await client.post(
+                            path, content=slow_body(payload, upload_delay),
+                            headers={"Content-Type": "application/json", "Content-Length": str(len(json.dumps(payload)))}
+                        )
+                    else:
+                        response = await client.post(path, json=payload)
+                except httpx.TransportError:
+                    errors += 1
+                    continue
+                samples.append(time.perf_counter() - began)
+                errors += response.status_code >= 400
+
+        start = time.perf_counter()
+        await asyncio.gather(*(connection() for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+
+    summary = latency_summary(samples, seconds)
+    summary["errors"] = errors
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=200, help="open client connections")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads")
+    parser.add_argument("--upload-delay-ms", type=int, default=0, help="pause halfway through each request body")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    servers = {
+        "wsgi": (
+            ["gunicorn", "hatch_messaging.wsgi:application", "--bind", f"127.0.0.1:{args.port}",
+             "--workers", "1", "--threads", str(args.threads), "--backlog", "2048", "--keep-alive", "75"],
+            {"inbound": "/messages/inbound/", "outbound": "/messages/outbound/"},
+        ),
+        "asgi": (
+            ["uvicorn", "hatch_messaging.asgi:application", "--port", str(args.port),
+             "--workers", "1", "--no-access-log", "--log-level", "warning", "--backlog", "2048", "--timeout-keep-alive", "75"],
+            {"inbound": "/messages/inbound/async/", "outbound": "/messages/outbound/async/"},
+        ),
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        for name, (command, paths) in servers.items():
+            workload = Workload(prefix=name)
+            with server(command, args.port, Path(scratch) / f"{name}.sqlite3") as base_url:
+                results[name] = {
+                    endpoint: asyncio.run(load(
+                        base_url, path, getattr(workload, endpoint), args.requests, args.concurrency,
+                        args.upload_delay_ms / 1000
+                    ))
+                    for endpoint, path in paths.items()
+                }
+
+    write_results(
+        "asgi_vs_wsgi",
+        {"concurrency": args.concurrency, "upload_delay_ms": args.upload_delay_ms, **results},
+        args.output
+    )
+
+
+if __name__ == "__main__":
+    main()
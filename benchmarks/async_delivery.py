@@ -0,0 +1,52 @@
+"""
+Compare blocking one-at-a-time delivery (one Celery prefork process) with
+the asyncio engine against a stub provider that adds per-request latency.
+
+    python -m benchmarks.async_delivery --count 500 --latency-ms 50
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks.harness import setup_django
+from benchmarks.stub_provider import spawn_stub_provider
+
+PAYLOAD = {"from": "+12016661234", "to": "+18045551234", "type": "sms", "body": "Hello"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--latency-ms", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    setup_django()
+    from messaging.async_delivery import AsyncDeliveryEngine
+    from messaging.providers import check_provider_response, encode_provider_body, post_to_provider
+
+    body = encode_provider_body(PAYLOAD)
+
+    with spawn_stub_provider(args.port, args.latency_ms) as provider_url:
+        start = time.perf_counter()
+        for _ in range(args.count):
+            check_provider_response(post_to_provider(provider_url, body), retries=0)
+        blocking = time.perf_counter() - start
+
+        async def run():
+            async with AsyncDeliveryEngine(provider_concurrency=args.concurrency) as engine:
+                return await engine.deliver_many([(body, provider_url)] * args.count)
+
+        start = time.perf_counter()
+        results = asyncio.run(run())
+        concurrent = time.perf_counter() - start
+
+    failed = sum(result["status"] != "success" for result in results)
+    print(f"blocking, 1 process   {blocking * 1000:10.1f} ms {args.count / blocking:8.1f} msg/s")
+    print(f"asyncio engine        {concurrent * 1000:10.1f} ms {args.count / concurrent:8.1f} msg/s ({failed} failed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Concurrent insert throughput of the ingest endpoints before and after the
+database tuning.
+
+    python -m benchmarks.concurrent_inserts --requests 2000 --concurrency 64 --output inserts.json
+    python -m benchmarks.concurrent_inserts --database-url postgres://localhost/messaging_bench
+
+Both runs use gunicorn with several processes so writes really contend:
+
+  untuned  SQLite with Django's stock options and a connection per request,
+           which is how settings.py used to configure the database.
+  tuned    the configured database: DATABASE_URL if given, otherwise SQLite
+           with WAL, BEGIN IMMEDIATE, a busy timeout and persistent
+           connections.
+
+Inbound and outbound requests are sent at the same time, so every request
+is a writer. Errors are mostly "database is locked" 500s.
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.asgi_vs_wsgi import load, server
+from benchmarks.harness import write_results
+from benchmarks.workload import Workload
+
+
+async def run_mixed(base_url, workload, requests, concurrency):
+    start = time.perf_counter()
+    inbound, outbound = await asyncio.gather(
+        load(base_url, "/messages/inbound/", workload.inbound, requests, concurrency // 2),
+        load(base_url, "/messages/outbound/", workload.outbound, requests, concurrency - concurrency // 2),
+    )
+    seconds = time.perf_counter() - start
+    return {
+        "inbound": inbound,
+        "outbound": outbound,
+        "inserts_per_second": round(2 * requests / seconds, 1),
+        "errors": inbound["errors"] + outbound["errors"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=64, help="open client connections")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn processes")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per process")
+    parser.add_argument("--database-url", help="database for the tuned run; defaults to scratch SQLite")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    command = [
+        "gunicorn", "hatch_messaging.wsgi:application", "--bind", f"127.0.0.1:{args.port}",
+        "--workers", str(args.workers), "--threads", str(args.threads),
+        "--backlog", "2048", "--keep-alive", "75",
+    ]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        profiles = {
+            "untuned": {
+                "DATABASE_URL": f"sqlite:///{Path(scratch) / 'untuned.sqlite3'}",
+                "BENCHMARK_UNTUNED_DATABASE": "1",
+            },
+            "tuned": {
+                "DATABASE_URL": args.database_url or f"sqlite:///{Path(scratch) / 'tuned.sqlite3'}",
+            },
+        }
+        for name, env in profiles.items():
+            workload = Workload(prefix=name)
+            with server(command, args.port, **env) as base_url:
+                results[name] = asyncio.run(run_mixed(base_url, workload, args.requests, args.concurrency))
+
+    write_results(
+        "concurrent_inserts",
+        {
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "threads": args.threads,
+            "tuned_database": "sqlite" if not args.database_url else args.database_url.split(":", 1)[0],
+            **results,
+        },
+        args.output
+    )
+
+
+if __name__ == "__main__":
+    main()
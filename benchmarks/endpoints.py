@@ -0,0 +1,89 @@
+"""
+Drive /messages/inbound/ and /messages/outbound/ in-process with a realistic
+request mix and report latency percentiles, throughput and queries per
+request as JSON.
+
+    python -m benchmarks.endpoints --requests 2000 --output endpoints.json
+
+With --deliver, the outbox is then relayed and every delivery runs the
+send_message_to_provider task eagerly against the local stub provider, so
+the Celery path is measured without a broker.
+"""
+
+import argparse
+import time
+
+from benchmarks.harness import latency_summary, setup_django, test_database, write_results
+from benchmarks.stub_provider import spawn_stub_provider
+from benchmarks.workload import Workload
+
+
+def run_endpoint(client, path, make_payload, count):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    samples, queries, errors = [], [], 0
+    start = time.perf_counter()
+    for _ in range(count):
+        payload = make_payload()
+        with CaptureQueriesContext(connection) as captured:
+            began = time.perf_counter()
+            response = client.post(path, payload, format="json")
+            samples.append(time.perf_counter() - began)
+        queries.append(len(captured))
+        errors += response.status_code >= 400
+    summary = latency_summary(samples, time.perf_counter() - start, queries)
+    summary["errors"] = errors
+    return summary
+
+
+def run_delivery(latency_ms, port):
+    from hatch_messaging.celery import app
+    from messaging import tasks
+    from messaging.models import OutboxMessage
+
+    pending = OutboxMessage.objects.filter(dispatched_at__isnull=True).count()
+    app.conf.task_always_eager = True
+    with spawn_stub_provider(port, latency_ms) as provider_url:
+        # Rows were written with the real provider URLs; point them at the stub.
+        OutboxMessage.objects.update(provider_url=provider_url)
+        start = time.perf_counter()
+        while tasks.relay_outbox_batch():
+            pass
+        seconds = time.perf_counter() - start
+    return {
+        "deliveries": pending,
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(pending / seconds, 1) if seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint")
+    parser.add_argument("--contacts", type=int, default=500)
+    parser.add_argument("--reuse", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--deliver", action="store_true")
+    parser.add_argument("--latency-ms", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.test import APIClient
+
+    workload = Workload(contacts=args.contacts, reuse=args.reuse, seed=args.seed)
+    results = {}
+    with test_database():
+        client = APIClient()
+        results["inbound"] = run_endpoint(client, "/messages/inbound/", workload.inbound, args.requests)
+        results["outbound"] = run_endpoint(client, "/messages/outbound/", workload.outbound, args.requests)
+        if args.deliver:
+            results["delivery"] = run_delivery(args.latency_ms, args.port)
+
+    write_results("endpoints", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Shared setup for the benchmark scripts in this directory.
+
+Each benchmark runs against a throwaway test database so it never touches
+db.sqlite3. Run them from the project root, e.g.:
+
+    python -m benchmarks.inbound_batch
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def setup_django():
+    if str(BASE_DIR) not in sys.path:
+        sys.path.insert(0, str(BASE_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hatch_messaging.settings")
+
+    import django
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+@contextmanager
+def measure():
+    """Yield a dict that is filled with elapsed seconds and query count."""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    result = {}
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        yield result
+        result["seconds"] = time.perf_counter() - start
+    result["queries"] = len(queries)
+
+
+def report(name, result, count):
+    print(
+        f"{name:<28} {result['seconds'] * 1000:10.1f} ms"
+        f" {result['seconds'] * 1000 / count:8.3f} ms/msg"
+        f" {result['queries']:8d} queries"
+    )
+
+
+def latency_summary(samples, seconds, queries=None):
+    """
+    Summarize per-request latencies (seconds) into the fields compared
+    between commits: p50/p95/p99 in ms, throughput and queries per request.
+    """
+    cuts = statistics.quantiles(samples, n=100, method="inclusive") if len(samples) > 1 else samples * 99
+    summary = {
+        "requests": len(samples),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+        "throughput_rps": round(len(samples) / seconds, 1) if seconds else None,
+    }
+    if queries is not None:
+        summary["queries_per_request"] = round(sum(queries) / len(queries), 2)
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name, results, output=None):
+    """
+    Print ``results`` as JSON, tagged with the commit and environment, and
+    also write them to ``output`` if given, so runs can be diffed.
+    """
+    document = {
+        "benchmark": name,
+        "commit": git_revision(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    text = json.dumps(document, indent=2)
+    print(text)
+    if output:
+        Path(output).write_text(text + "\n")
@@ -0,0 +1,55 @@
+"""
+Compare N single inbound posts against one batch of N.
+
+    python -m benchmarks.inbound_batch --count 200 --senders 20
+"""
+
+import argparse
+
+from benchmarks.harness import measure, report, setup_django, test_database
+
+
+def make_payloads(count, senders, prefix):
+    return [
+        {
+            "from": f"+1804555{i % senders:04d}",
+            "to": "+12016661234",
+            "type": "sms",
+            "messaging_provider_id": f"{prefix}-{i}",
+            "body": f"Inbound message {i}",
+            "attachments": None,
+            "timestamp": "2024-11-01T14:00:00Z",
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.test import APIClient
+
+    with test_database():
+        client = APIClient()
+
+        with measure() as single:
+            for payload in make_payloads(args.count, args.senders, "single"):
+                client.post("/messages/inbound/", payload, format="json")
+
+        with measure() as batch:
+            client.post(
+                "/messages/inbound/batch/",
+                make_payloads(args.count, args.senders, "batch"),
+                format="json",
+            )
+
+    report(f"{args.count} single posts", single, args.count)
+    report(f"1 batch of {args.count}", batch, args.count)
+
+
+if __name__ == "__main__":
+    main()
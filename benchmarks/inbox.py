@@ -0,0 +1,133 @@
+"""
+Inbox listing on a seeded dataset: a business number's conversations by
+latest activity with a preview and message count, aggregated over Message
+as it had to be before, against the denormalized conversation summary.
+
+    python -m benchmarks.inbox --messages 2000000 --conversations 50000 --output inbox.json
+
+Seeding two million messages into SQLite takes a few minutes. The seeded
+summaries are built with rebuild_all_summaries, which is timed too.
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.harness import latency_summary, setup_django, test_database, write_results
+
+BUSINESS = "+12016661234"
+CHUNK = 10000
+
+
+def seed(conversations, messages, seed):
+    from messaging.models import Conversation, Message, Participant
+
+    rng = random.Random(seed)
+    business = Participant.objects.create(phone=BUSINESS, address_key=BUSINESS)
+    contacts = Participant.objects.bulk_create([
+        Participant(phone=f"+1804{i:07d}", address_key=f"+1804{i:07d}") for i in range(conversations)
+    ], batch_size=CHUNK)
+    # Contacts are created after the business and get the higher id, so the
+    # business is participant_1 of every conversation.
+    pairs = Conversation.objects.bulk_create([
+        Conversation(participant_1=business, participant_2=contact) for contact in contacts
+    ], batch_size=CHUNK)
+
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for offset in range(0, messages, CHUNK):
+        batch = []
+        for n in range(offset, min(offset + CHUNK, messages)):
+            # Half the traffic is spread evenly, half piles onto a few busy
+            # conversations, as a real business inbox does.
+            if n % 2:
+                conversation = rng.choice(pairs)
+            else:
+                conversation = pairs[int(rng.paretovariate(1.2)) % len(pairs)]
+            inbound = rng.random() < 0.5
+            batch.append(Message(
+                conversation=conversation,
+                sender_id=conversation.participant_2_id if inbound else conversation.participant_1_id,
+                receiver_id=conversation.participant_1_id if inbound else conversation.participant_2_id,
+                type="sms",
+                body=f"Seeded message {n} with a little text to preview",
+                timestamp=start + timedelta(seconds=n * 10 + rng.randrange(10)),
+                provider="sms_provider",
+                provider_message_id=f"seed-{n}",
+            ))
+        Message.objects.bulk_create(batch)
+
+
+def aggregate_inbox(page_size):
+    """The inbox without the summary columns: aggregate every message of every conversation."""
+    from django.db.models import Count, Max, OuterRef, Q, Subquery
+
+    from messaging.models import Conversation, Message
+
+    latest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-timestamp', '-id')
+    return list(
+        Conversation.objects
+        .filter(Q(participant_1__address_key=BUSINESS) | Q(participant_2__address_key=BUSINESS))
+        .annotate(
+            latest_at=Max('messages__timestamp'),
+            count=Count('messages'),
+            preview=Subquery(latest.values('body')[:1]),
+        )
+        .order_by('-latest_at', '-id')
+        .values('id', 'latest_at', 'count', 'preview')[:page_size]
+    )
+
+
+def time_calls(call, iterations):
+    samples = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        began = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - began)
+    return latency_summary(samples, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--conversations", type=int, default=50000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.test import APIClient
+
+    from messaging.utils.conversation_summary import rebuild_all_summaries
+
+    results = {"messages": args.messages, "conversations": args.conversations}
+    with test_database():
+        began = time.perf_counter()
+        seed(args.conversations, args.messages, args.seed)
+        results["seed_seconds"] = round(time.perf_counter() - began, 1)
+
+        began = time.perf_counter()
+        rebuild_all_summaries()
+        results["rebuild_seconds"] = round(time.perf_counter() - began, 1)
+
+        client = APIClient()
+        url = f"/conversations/inbox/?participant={BUSINESS}&page_size={args.page_size}"
+        for _ in range(20):
+            url = client.get(url).data["next"]
+        deep_url = url
+
+        results["aggregate"] = time_calls(lambda: aggregate_inbox(args.page_size), max(1, args.iterations // 4))
+        results["summary_first_page"] = time_calls(
+            lambda: client.get(f"/conversations/inbox/?participant={BUSINESS}&page_size={args.page_size}"),
+            args.iterations
+        )
+        results["summary_page_21"] = time_calls(lambda: client.get(deep_url), args.iterations)
+
+    write_results("inbox", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
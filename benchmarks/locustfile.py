@@ -0,0 +1,69 @@
+"""
+Locust scenarios for the messaging API.
+
+Start the API (and, to exercise delivery, a Celery worker, the outbox relay
+and the stub provider), then run e.g.:
+
+    locust -f benchmarks/locustfile.py --host http://127.0.0.1:8000 \
+        --headless -u 100 -r 20 -t 2m --results-json locust.json
+
+Each simulated user draws traffic from its own Workload, so inbound
+provider ids never collide between users while contacts are still reused.
+"""
+
+import sys
+import uuid
+from pathlib import Path
+
+from locust import HttpUser, between, events, task
+
+# locust only puts this file's directory on sys.path.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.harness import write_results
+from benchmarks.workload import Workload
+
+
+@events.init_command_line_parser.add_listener
+def add_arguments(parser):
+    parser.add_argument("--contacts", type=int, default=1000, help="Distinct contacts to message")
+    parser.add_argument("--reuse", type=float, default=0.8, help="Share of traffic to the busiest 10%% of contacts")
+    parser.add_argument("--results-json", default=None, help="Write p50/p95/p99 and throughput here")
+
+
+class MessagingUser(HttpUser):
+    wait_time = between(0.01, 0.1)
+
+    def on_start(self):
+        options = self.environment.parsed_options
+        self.workload = Workload(
+            contacts=options.contacts,
+            reuse=options.reuse,
+            seed=uuid.uuid4().int,
+            prefix=f"locust-{uuid.uuid4().hex[:12]}",
+        )
+
+    @task(3)
+    def inbound(self):
+        self.client.post("/messages/inbound/", json=self.workload.inbound(), name="inbound")
+
+    @task(1)
+    def outbound(self):
+        self.client.post("/messages/outbound/", json=self.workload.outbound(), name="outbound")
+
+
+@events.quitting.add_listener
+def write_summary(environment, **kwargs):
+    if not environment.parsed_options.results_json:
+        return
+    results = {}
+    for entry in environment.stats.entries.values():
+        results[entry.name] = {
+            "requests": entry.num_requests,
+            "failures": entry.num_failures,
+            "p50_ms": entry.get_response_time_percentile(0.5),
+            "p95_ms": entry.get_response_time_percentile(0.95),
+            "p99_ms": entry.get_response_time_percentile(0.99),
+            "throughput_rps": round(entry.total_rps, 1),
+        }
+    write_results("locust", results, environment.parsed_options.results_json)
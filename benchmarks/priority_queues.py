@@ -0,0 +1,115 @@
+"""
+SMS latency during a bulk email flood, with every delivery on one queue
+(as before routing) and with the routed queues from
+messaging.utils.outbound_routing.
+
+    python -m benchmarks.priority_queues --emails 5000 --sms 200 --high-share 0.1
+
+A campaign of --emails messages is queued at once and SMS then arrive
+every --sms-interval-ms; a --high-share of them are sent with priority
+"high". Workers are threads draining in-process queues with the
+concurrency in OUTBOUND_QUEUE_CONCURRENCY; the shared queue gets all of
+those workers. Provider calls are sleeps of --sms-latency-ms and
+--email-latency-ms, so the numbers show queueing delay, not broker or
+HTTP overhead. Latency is measured from enqueue to the end of the call.
+"""
+
+import argparse
+import queue
+import threading
+import time
+
+from benchmarks.harness import latency_summary, setup_django, write_results
+
+SHARED_QUEUE = "shared"
+
+
+def run(args, routed):
+    from django.conf import settings
+
+    from messaging.constants import PROVIDER_URLS
+    from messaging.utils import outbound_routing
+
+    latency = {
+        PROVIDER_URLS['sms']: args.sms_latency_ms / 1000,
+        PROVIDER_URLS['email']: args.email_latency_ms / 1000,
+    }
+    concurrency = settings.OUTBOUND_QUEUE_CONCURRENCY
+    if routed:
+        queues = {name: queue.Queue() for name in concurrency}
+        workers = [(name, count) for name, count in concurrency.items()]
+    else:
+        queues = {SHARED_QUEUE: queue.Queue()}
+        workers = [(SHARED_QUEUE, sum(concurrency.values()))]
+
+    samples = {"sms": [], "sms_high": [], "email": []}
+    lock = threading.Lock()
+
+    def work(name):
+        while (delivery := queues[name].get()) is not None:
+            kind, provider_url, queued_at = delivery
+            time.sleep(latency[provider_url])
+            with lock:
+                samples[kind].append(time.perf_counter() - queued_at)
+
+    def enqueue(kind, provider_url, priority):
+        name = outbound_routing.queue_for(provider_url, priority) if routed else SHARED_QUEUE
+        queues[name].put((kind, provider_url, time.perf_counter()))
+
+    threads = [
+        threading.Thread(target=work, args=(name,))
+        for name, count in workers for _ in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+
+    started = time.perf_counter()
+    for _ in range(args.emails):
+        enqueue("email", PROVIDER_URLS['email'], outbound_routing.NORMAL)
+    high_every = round(1 / args.high_share) if args.high_share else 0
+    for i in range(args.sms):
+        if high_every and i % high_every == 0:
+            enqueue("sms_high", PROVIDER_URLS['sms'], outbound_routing.HIGH)
+        else:
+            enqueue("sms", PROVIDER_URLS['sms'], outbound_routing.NORMAL)
+        time.sleep(args.sms_interval_ms / 1000)
+
+    for name, count in workers:
+        for _ in range(count):
+            queues[name].put(None)
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    return {
+        kind: latency_summary(values, seconds)
+        for kind, values in samples.items() if values
+    } | {"drain_seconds": round(seconds, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=5000)
+    parser.add_argument("--sms", type=int, default=200)
+    parser.add_argument("--sms-interval-ms", type=float, default=10.0)
+    parser.add_argument("--high-share", type=float, default=0.1, help="Fraction of SMS sent with priority high.")
+    parser.add_argument("--sms-latency-ms", type=float, default=30.0)
+    parser.add_argument("--email-latency-ms", type=float, default=60.0)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+
+    results = {
+        "emails": args.emails,
+        "sms": args.sms,
+        "workers": dict(settings.OUTBOUND_QUEUE_CONCURRENCY),
+        "single_queue": run(args, routed=False),
+        "routed": run(args, routed=True),
+    }
+    write_results("priority_queues", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
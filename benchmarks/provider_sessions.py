@@ -0,0 +1,49 @@
+"""
+Compare a fresh connection per delivery against the pooled provider sessions.
+
+    python -m benchmarks.provider_sessions --count 500 --threads 8
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.harness import setup_django
+from benchmarks.stub_provider import StubProvider
+
+PAYLOAD = {"from": "+12016661234", "to": "+18045551234", "type": "sms", "body": "Hello"}
+
+
+def run(post, url, count, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda _: post(url, json=PAYLOAD), range(count)))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    setup_django()
+    import requests
+    from messaging.utils import http_sessions
+
+    with StubProvider() as provider:
+        seconds = run(requests.post, provider.url, args.count, args.threads)
+        print(f"requests.post     {seconds * 1000:10.1f} ms {provider.connections:6d} connections")
+
+        provider.connections = 0
+        session = http_sessions.get_session(provider.url)
+        seconds = run(
+            lambda url, json: session.post(url, json=json, timeout=http_sessions.get_timeout()),
+            provider.url, args.count, args.threads
+        )
+        print(f"pooled session    {seconds * 1000:10.1f} ms {provider.connections:6d} connections")
+        http_sessions.close_sessions()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Fan-out latency of the realtime push channel: thousands of WebSocket
+clients connected to one ASGI process, split across participant channels,
+and events published the way the write paths publish them. Latency is
+measured from the publish to the ASGI ``websocket.send`` of each client.
+
+    python -m benchmarks.realtime_fanout --clients 5000 --channels 100 --events 200
+    python -m benchmarks.realtime_fanout --redis-url redis://localhost:6379/1
+
+Clients are driven through the ASGI interface in process, so the numbers
+cover Redis pub/sub and the hub but not socket writes. Without
+--redis-url an in-memory fakeredis server stands in for Redis.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+from benchmarks.harness import latency_summary, setup_django, test_database, write_results
+
+
+async def run(args, hub):
+    from messaging import realtime
+    from messaging.models import Participant
+
+    participants = [f"+1804555{i:04d}" for i in range(args.channels)]
+    ids = {}
+    for address in participants:
+        participant = await Participant.objects.acreate(phone=address, address_key=address)
+        ids[address] = participant.id
+
+    samples = []
+    deliveries = {"count": 0}
+    expected = {}
+
+    async def client(address, connected):
+        receive = asyncio.Queue()
+        await receive.put({"type": "websocket.connect"})
+
+        async def send(event):
+            if event["type"] == "websocket.accept":
+                connected.release()
+            elif event["type"] == "websocket.send":
+                samples.append(time.perf_counter() - json.loads(event["text"])["sent_at"])
+                deliveries["count"] += 1
+                if deliveries["count"] == expected.get("total"):
+                    expected["done"].set()
+
+        scope = {
+            "type": "websocket",
+            "path": realtime.WEBSOCKET_PATH,
+            "query_string": urlencode({"participant": address}).encode(),
+        }
+        task = asyncio.create_task(realtime.websocket_application(scope, receive.get, send))
+        return task, receive
+
+    connected = asyncio.Semaphore(0)
+    started = time.perf_counter()
+    clients = [await client(participants[i % args.channels], connected) for i in range(args.clients)]
+    for _ in clients:
+        await connected.acquire()
+    connect_seconds = time.perf_counter() - started
+
+    rng = random.Random(args.seed)
+    targets = [rng.choice(participants) for _ in range(args.events)]
+    per_channel = {address: 0 for address in participants}
+    for i in range(args.clients):
+        per_channel[participants[i % args.channels]] += 1
+    expected["total"] = sum(per_channel[address] for address in targets)
+    expected["done"] = asyncio.Event()
+
+    started = time.perf_counter()
+    for address in targets:
+        event = {"event": "benchmark", "sent_at": time.perf_counter()}
+        await asyncio.to_thread(realtime._publish, [(0, {ids[address]}, event)])
+        await asyncio.sleep(args.interval_ms / 1000)
+    await asyncio.wait_for(expected["done"].wait(), timeout=60)
+    seconds = time.perf_counter() - started
+
+    for task, receive in clients:
+        await receive.put({"type": "websocket.disconnect"})
+    await asyncio.gather(*(task for task, _ in clients))
+    hub.reader.cancel()
+
+    return {
+        "clients": args.clients,
+        "channels": args.channels,
+        "events": args.events,
+        "connect_seconds": round(connect_seconds, 2),
+        "deliveries": latency_summary(samples, seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--channels", type=int, default=100, help="Participants the clients are spread across.")
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=5.0, help="Pause between published events.")
+    parser.add_argument("--redis-url", help="Use this Redis instead of an in-memory stand-in.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    setup_django()
+    import fakeredis
+    import redis
+    import redis.asyncio as aioredis
+    from django.test import override_settings
+
+    from messaging import realtime
+
+    if args.redis_url:
+        subscriber, publisher = aioredis.Redis.from_url(args.redis_url), redis.Redis.from_url(args.redis_url)
+    else:
+        server = fakeredis.FakeServer()
+        subscriber, publisher = fakeredis.FakeAsyncRedis(server=server), fakeredis.FakeRedis(server=server)
+
+    with test_database(), override_settings(MESSAGING_REALTIME_QUEUE_SIZE=args.events + 1):
+        hub = realtime.Hub(subscriber)
+        with patch.object(realtime, "_hub", hub), patch.object(realtime, "_publisher", publisher):
+            results = asyncio.run(run(args, hub))
+    results["redis"] = "redis" if args.redis_url else "fakeredis"
+    write_results("realtime_fanout", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+"""
+Settings for benchmarks that run a real server process: the project
+settings, with the SQLite database pointed at a scratch file when
+BENCHMARK_DATABASE is set.
+"""
+
+import os
+
+from hatch_messaging.settings import *  # noqa: F401,F403
+from hatch_messaging.settings import DATABASES
+
+if "BENCHMARK_DATABASE" in os.environ:
+    DATABASES["default"]["NAME"] = os.environ["BENCHMARK_DATABASE"]
+
+if os.environ.get("BENCHMARK_UNTUNED_DATABASE"):
+    # The database setup before it was configurable: stock SQLite options
+    # (rollback journal, deferred transactions, 5s busy timeout) and a new
+    # connection for every request.
+    DATABASES["default"]["OPTIONS"] = {}
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
@@ -0,0 +1,144 @@
+"""
+Local stand-in for provider.app / mailplus.app.
+
+Speaks HTTP/1.1 keep-alive from a single asyncio loop, so thousands of
+concurrent connections don't need thousands of threads, and counts the TCP
+connections it accepts so benchmarks can show whether clients reuse them.
+Can also be run on its own for manual or locust testing:
+
+    python -m benchmarks.stub_provider --port 8099 --latency-ms 20
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+REASONS = {200: "OK", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class StubProvider:
+    def __init__(self, port=0, latency_ms=0, statuses=None):
+        self.port = port
+        self.latency = latency_ms / 1000
+        self.statuses = list(statuses or [])
+        self.connections = 0
+        self.requests = 0
+        self._loop = None
+        self._server = None
+        self._ready = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/api/messages"
+
+    def next_status(self):
+        return self.statuses.pop(0) if self.statuses else 200
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n")[1:]:
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                self.requests += 1
+                status = self.next_status()
+
+                body = json.dumps({"id": f"stub-{self.requests}"}).encode()
+                headers = [
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}",
+                    "Content-Type: application/json",
+                    f"Content-Length: {len(body)}",
+                ]
+                if status == 429:
+                    headers.append("Retry-After: 1")
+                writer.write("\r\n".join(headers).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", self.port, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def serve_forever(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self.serve())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        self._ready.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._loop.call_soon_threadsafe(self._server.close)
+        for task in asyncio.all_tasks(self._loop):
+            self._loop.call_soon_threadsafe(task.cancel)
+
+
+@contextmanager
+def spawn_stub_provider(port=8099, latency_ms=0):
+    """
+    Run the stub in a separate process so it doesn't compete with the
+    client under test for the GIL. Yields the provider URL.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.stub_provider", "--port", str(port), "--latency-ms", str(latency_ms)],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield f"http://127.0.0.1:{port}/api/messages"
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=int, default=0)
+    args = parser.parse_args()
+
+    provider = StubProvider(port=args.port, latency_ms=args.latency_ms)
+    print(f"Stub provider listening on {provider.url}", flush=True)
+    try:
+        provider.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
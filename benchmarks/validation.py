@@ -0,0 +1,59 @@
+"""
+Micro-benchmark build_validated_message_data with a cold and a warm
+resolution cache.
+
+    python -m benchmarks.validation --iterations 2000 --output validation.json
+"""
+
+import argparse
+import time
+
+from benchmarks.harness import latency_summary, setup_django, test_database, write_results
+from benchmarks.workload import Workload
+
+
+def run(payloads, before_each=None):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from messaging.utils.message_helpers import build_validated_message_data
+
+    samples, queries = [], []
+    start = time.perf_counter()
+    for payload in payloads:
+        if before_each:
+            before_each()
+        with CaptureQueriesContext(connection) as captured:
+            began = time.perf_counter()
+            build_validated_message_data(payload, require_type=False)
+            samples.append(time.perf_counter() - began)
+        queries.append(len(captured))
+    return latency_summary(samples, time.perf_counter() - start, queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--contacts", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    setup_django()
+    from messaging.utils.message_helpers import clear_resolution_caches
+
+    workload = Workload(contacts=args.contacts, seed=args.seed)
+    payloads = [workload.inbound() for _ in range(args.iterations)]
+
+    results = {}
+    with test_database():
+        # Create every participant and conversation up front, and fill the
+        # cache, so both runs measure lookups rather than inserts.
+        run(payloads)
+        results["warm_cache"] = run(payloads)
+        results["cold_cache"] = run(payloads, before_each=clear_resolution_caches)
+
+    write_results("validation", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
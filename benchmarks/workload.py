@@ -0,0 +1,73 @@
+"""
+Realistic request mixes shared by the endpoint benchmark and the locustfile.
+
+Traffic is skewed the way a real inbox is: a small set of contacts does most
+of the talking, so participant and conversation lookups mostly hit rows that
+already exist. Message types default to mostly SMS with some MMS and email.
+"""
+
+import itertools
+import random
+from datetime import datetime, timezone
+
+BUSINESS_PHONE = "+12016661234"
+BUSINESS_EMAIL = "support@usehatchapp.com"
+
+DEFAULT_TYPE_MIX = {"sms": 0.6, "mms": 0.1, "email": 0.3}
+
+
+class Workload:
+    """
+    Generate inbound and outbound payloads for ``contacts`` contacts.
+
+    ``reuse`` is the share of messages that go to the busiest tenth of the
+    contacts; the rest are spread evenly over everybody.
+    """
+
+    def __init__(self, contacts=1000, reuse=0.8, type_mix=None, seed=0, prefix="bench"):
+        self.contacts = contacts
+        self.reuse = reuse
+        self.type_mix = type_mix or DEFAULT_TYPE_MIX
+        self.random = random.Random(seed)
+        self.prefix = prefix
+        self._ids = itertools.count()
+
+    def contact(self):
+        hot = max(1, self.contacts // 10)
+        if self.random.random() < self.reuse:
+            return self.random.randrange(hot)
+        return self.random.randrange(self.contacts)
+
+    def message_type(self):
+        types, weights = zip(*self.type_mix.items())
+        return self.random.choices(types, weights)[0]
+
+    def addresses(self, msg_type, contact):
+        if msg_type == "email":
+            return BUSINESS_EMAIL, f"contact{contact}@example.com"
+        return BUSINESS_PHONE, f"+1804{contact:07d}"
+
+    def base_payload(self, msg_type, sender, receiver):
+        n = next(self._ids)
+        return {
+            "from": sender,
+            "to": receiver,
+            "type": msg_type,
+            "body": f"<p>Message {n}</p>" if msg_type == "email" else f"Message {n}",
+            "attachments": ["https://example.com/image.png"] if msg_type == "mms" else [],
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        }, n
+
+    def outbound(self):
+        msg_type = self.message_type()
+        business, contact = self.addresses(msg_type, self.contact())
+        payload, _ = self.base_payload(msg_type, business, contact)
+        return payload
+
+    def inbound(self):
+        msg_type = self.message_type()
+        business, contact = self.addresses(msg_type, self.contact())
+        payload, n = self.base_payload(msg_type, contact, business)
+        id_field = "xillio_id" if msg_type == "email" else "messaging_provider_id"
+        payload[id_field] = f"{self.prefix}-{n}"
+        return payload
@@ -0,0 +1,214 @@
+import asyncio
+import itertools
+import logging
+import time
+
+import httpx
+import msgpack
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .providers import JSON_HEADERS, RateLimited, backoff_countdown, check_provider_response, is_outage
+from .utils import circuit_breaker, delivery_status, outbound_routing, rate_limiter
+from .utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "messaging:outbound:async"
+# Popped before QUEUE_KEY, so high priority messages never wait behind it.
+PRIORITY_QUEUE_KEY = "messaging:outbound:async:priority"
+# Deliveries parked while their provider's circuit is open, scored by the
+# time they go back on their queue.
+PARKED_KEY = "messaging:outbound:async:parked"
+
+
+def enqueue(message_id, body, provider_url, priority=outbound_routing.NORMAL):
+    """Queue an encoded provider body for the asyncio delivery worker."""
+    enqueue_many([(message_id, body, provider_url)], priority)
+
+
+def enqueue_many(deliveries, priority=outbound_routing.NORMAL):
+    """Queue (message_id, body, provider_url) triples with a single Redis round trip."""
+    key = PRIORITY_QUEUE_KEY if priority == outbound_routing.HIGH else QUEUE_KEY
+    get_redis().rpush(key, *(msgpack.packb(delivery) for delivery in deliveries))
+
+
+def build_client(max_connections):
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            settings.PROVIDER_HTTP_READ_TIMEOUT,
+            connect=settings.PROVIDER_HTTP_CONNECT_TIMEOUT
+        ),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+
+
+class AsyncDeliveryEngine:
+    """
+    Deliver many messages concurrently from one event loop.
+
+    Each provider URL gets its own semaphore so a slow provider can't take
+    every connection. Retries follow send_message_to_provider: Retry-After
+    on 429, otherwise jittered exponential backoff, for up to max_retries
+    retries. While the provider's circuit is open a delivery is returned
+    as parked without calling it.
+
+    Connections are spread over several small clients per provider because
+    httpx's pool does a linear scan of its connections on every request.
+    """
+
+    def __init__(self, provider_concurrency, max_retries=5, client_factory=build_client, connections_per_client=16):
+        self.provider_concurrency = provider_concurrency
+        self.max_retries = max_retries
+        self.client_factory = client_factory
+        self.connections_per_client = connections_per_client
+        self._semaphores = {}
+        self._clients = {}
+        # (message_id, error, final) for delivery_status, written in bulk
+        # by flush_attempts.
+        self.attempts = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        for clients, _ in self._clients.values():
+            for client in clients:
+                await client.aclose()
+        self._clients.clear()
+
+    def _semaphore(self, provider_url):
+        if provider_url not in self._semaphores:
+            self._semaphores[provider_url] = asyncio.Semaphore(self.provider_concurrency)
+        return self._semaphores[provider_url]
+
+    def _client(self, provider_url):
+        if provider_url not in self._clients:
+            shards = -(-self.provider_concurrency // self.connections_per_client)
+            clients = [self.client_factory(self.connections_per_client) for _ in range(shards)]
+            self._clients[provider_url] = (clients, itertools.cycle(clients))
+        return next(self._clients[provider_url][1])
+
+    async def deliver(self, body, provider_url, message_id=None, retries=0):
+        """
+        ``retries`` is the number already spent by a delivery that was
+        parked; a parked result carries the count to resume from.
+        """
+        while True:
+            # Check the circuit first so parked deliveries take no tokens.
+            wait = await asyncio.to_thread(circuit_breaker.wait_seconds, provider_url)
+            if wait:
+                return {"status": "parked", "countdown": wait, "retries": retries}
+            wait = await asyncio.to_thread(rate_limiter.acquire, provider_url)
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+
+            async with self._semaphore(provider_url):
+                started = time.monotonic()
+                try:
+                    response = await self._client(provider_url).post(
+                        provider_url, content=body, headers=JSON_HEADERS
+                    )
+                    check_provider_response(response, retries)
+                except RateLimited as exc:
+                    await asyncio.to_thread(rate_limiter.penalize, provider_url, exc.countdown)
+                    countdown, error = exc.countdown, exc
+                except Exception as exc:
+                    countdown, error = backoff_countdown(retries), exc
+                else:
+                    error = None
+            failed = error is not None and is_outage(error)
+            await asyncio.to_thread(circuit_breaker.record, provider_url, failed, time.monotonic() - started)
+            if error is None:
+                self._record(message_id, None, False)
+                return {"status": "success", "status_code": response.status_code}
+
+            final = retries >= self.max_retries
+            self._record(message_id, str(error), final)
+            if final:
+                logger.error("Giving up on delivery to %s: %s", provider_url, error)
+                return {"status": "failed", "error": str(error)}
+
+            # Sleep outside the semaphore so waiting retries don't hold slots.
+            await asyncio.sleep(countdown)
+            retries += 1
+
+    def _record(self, message_id, error, final):
+        if message_id is not None:
+            self.attempts.append((message_id, error, final))
+
+    async def flush_attempts(self):
+        """Write the attempts recorded since the last flush in one batch."""
+        attempts, self.attempts = self.attempts, []
+        if attempts:
+            await sync_to_async(delivery_status.record_attempts)(attempts)
+
+    async def deliver_many(self, deliveries):
+        return await asyncio.gather(*(
+            self.deliver(body, provider_url)
+            for body, provider_url in deliveries
+        ))
+
+
+async def park(redis, queue_key, payload, countdown):
+    """Hold a popped delivery for ``countdown`` seconds without keeping a slot."""
+    await redis.zadd(PARKED_KEY, {msgpack.packb([queue_key, payload]): time.time() + countdown})
+
+
+async def release_parked(redis, now=None):
+    """Put parked deliveries that are due back on their queues. Returns how many were released."""
+    released = 0
+    for entry in await redis.zrangebyscore(PARKED_KEY, 0, now or time.time(), start=0, num=1000):
+        # Only the worker whose ZREM succeeds requeues the entry.
+        if await redis.zrem(PARKED_KEY, entry):
+            queue_key, payload = msgpack.unpackb(entry)
+            await redis.rpush(queue_key, payload)
+            released += 1
+    return released
+
+
+async def run_worker(redis, stop, max_in_flight=None, provider_concurrency=None, client_factory=build_client):
+    """
+    Pop queued bodies and deliver them until ``stop`` is set, with at
+    most ``max_in_flight`` deliveries running at once. Deliveries parked by
+    an open circuit wait in Redis and are requeued when they are due.
+    """
+    max_in_flight = max_in_flight or settings.ASYNC_DELIVERY_MAX_IN_FLIGHT
+    provider_concurrency = provider_concurrency or settings.ASYNC_DELIVERY_PROVIDER_CONCURRENCY
+    in_flight = asyncio.Semaphore(max_in_flight)
+    running = set()
+
+    flushed_at = time.monotonic()
+
+    async def deliver(queue_key, payload):
+        # Parked deliveries come back with the retries they had spent.
+        message_id, body, provider_url, *retries = msgpack.unpackb(payload)
+        result = await engine.deliver(body, provider_url, message_id, *retries)
+        if result["status"] == "parked":
+            payload = msgpack.packb([message_id, body, provider_url, result["retries"]])
+            await park(redis, queue_key, payload, result["countdown"])
+
+    async with AsyncDeliveryEngine(provider_concurrency, client_factory=client_factory) as engine:
+        while not stop.is_set():
+            if time.monotonic() - flushed_at >= settings.ASYNC_DELIVERY_STATUS_FLUSH_INTERVAL:
+                await engine.flush_attempts()
+                await release_parked(redis)
+                flushed_at = time.monotonic()
+
+            await in_flight.acquire()
+            item = await redis.blpop([PRIORITY_QUEUE_KEY, QUEUE_KEY], timeout=1)
+            if item is None:
+                in_flight.release()
+                continue
+
+            task = asyncio.create_task(deliver(*item))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: in_flight.release())
+
+        await asyncio.gather(*running)
+        await engine.flush_attempts()
@@ -2,4 +2,21 @@ PROVIDER_URLS = {
     'sms': "https://www.provider.app/api/messages",
     'mms': "https://www.provider.app/api/messages",
     'email': "https://www.mailplus.app/api/email",
-}
\ No newline at end of file
+}
+
+INBOUND_BATCH_MAX_SIZE = 500
+
+# Characters of the latest message kept on its conversation for inbox lists.
+CONVERSATION_PREVIEW_LENGTH = 140
+
+# Providers that accept a JSON array of messages, keyed by their
+# single-message URL. Batches for any other provider are fanned out.
+PROVIDER_BATCH_URLS = {}
+
+# Proactive token bucket per provider URL, shared by all workers through
+# Redis: `rate` requests per second with bursts of up to `burst`. URLs not
+# listed here are not limited.
+PROVIDER_RATE_LIMITS = {
+    "https://www.provider.app/api/messages": {"rate": 50, "burst": 100},
+    "https://www.mailplus.app/api/email": {"rate": 20, "burst": 40},
+}
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from messaging.utils.participant_merge import normalize_participants
+
+
+class Command(BaseCommand):
+    help = "Fill in Participant.address_key for existing rows and merge participants with the same address."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Participants to read per query.")
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Report what would be merged without changing anything."
+        )
+
+    def handle(self, *args, **options):
+        stats = normalize_participants(options["batch_size"], options["dry_run"])
+        prefix = "Would normalize" if options["dry_run"] else "Normalized"
+        self.stdout.write(
+            f"{prefix} {stats['normalized']} participants, merging {stats['merged']} duplicates; "
+            f"{stats['invalid']} addresses could not be normalized."
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from messaging.utils.conversation_summary import rebuild_all_summaries
+
+
+class Command(BaseCommand):
+    help = "Recompute last_message_at, last_message_preview and message_count for every conversation."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Conversations to rebuild per transaction."
+        )
+
+    def handle(self, *args, **options):
+        rebuilt = rebuild_all_summaries(options["batch_size"])
+        self.stdout.write(f"Rebuilt {rebuilt} conversation summaries.")
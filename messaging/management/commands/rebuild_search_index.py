@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from messaging.utils.message_search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index from every hot and archived message."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Messages to index per query."
+        )
+
+    def handle(self, *args, **options):
+        indexed = rebuild_index(options["batch_size"])
+        self.stdout.write(f"Indexed {indexed} messages.")
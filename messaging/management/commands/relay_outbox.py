@@ -0,0 +1,39 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messaging.tasks import purge_dispatched_outbox, relay_outbox_batch
+from messaging.utils import metrics
+
+
+class Command(BaseCommand):
+    help = "Continuously relay pending outbox rows to the delivery engine."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval", type=float, default=0.2,
+            help="Seconds to sleep when the outbox is empty."
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.OUTBOX_RELAY_BATCH_SIZE,
+            help="Rows to dispatch per transaction."
+        )
+        parser.add_argument("--once", action="store_true", help="Drain the outbox once and exit.")
+
+    def handle(self, *args, **options):
+        last_purge = 0
+        while True:
+            relayed = relay_outbox_batch(options["batch_size"])
+            if relayed:
+                self.stdout.write(f"Relayed {relayed} outbound messages.")
+
+            if time.monotonic() - last_purge > 60:
+                purge_dispatched_outbox(options["batch_size"])
+                last_purge = time.monotonic()
+
+            if relayed < options["batch_size"]:
+                if options["once"]:
+                    metrics.flush()
+                    return
+                time.sleep(options["interval"])
@@ -0,0 +1,39 @@
+import asyncio
+import signal
+
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messaging.async_delivery import run_worker
+
+
+class Command(BaseCommand):
+    help = "Run the asyncio outbound delivery worker (OUTBOUND_DELIVERY_ENGINE = 'asyncio')."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-in-flight", type=int, default=settings.ASYNC_DELIVERY_MAX_IN_FLIGHT,
+            help="Maximum concurrent deliveries in this process."
+        )
+        parser.add_argument(
+            "--provider-concurrency", type=int, default=settings.ASYNC_DELIVERY_PROVIDER_CONCURRENCY,
+            help="Maximum concurrent requests to each provider URL."
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options["max_in_flight"], options["provider_concurrency"]))
+
+    async def run(self, max_in_flight, provider_concurrency):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        client = aioredis.Redis.from_url(settings.MESSAGING_REDIS_URL)
+        self.stdout.write(f"Async delivery worker started ({max_in_flight} in flight).")
+        try:
+            await run_worker(client, stop, max_in_flight, provider_concurrency)
+        finally:
+            await client.aclose()
+        self.stdout.write("Async delivery worker stopped.")
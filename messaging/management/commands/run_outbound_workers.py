@@ -0,0 +1,45 @@
+import shlex
+import signal
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Start one Celery worker per outbound queue with the concurrency in OUTBOUND_QUEUE_CONCURRENCY."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--queue", action="append", dest="queues",
+            help="Only start the worker for this queue (repeatable)."
+        )
+        parser.add_argument(
+            "--print", action="store_true", dest="print_only",
+            help="Print the worker commands, e.g. for a process manager, instead of running them."
+        )
+
+    def worker_commands(self, queues):
+        return [
+            [
+                sys.executable, "-m", "celery", "-A", "hatch_messaging", "worker",
+                "-Q", queue, "-c", str(concurrency), "-n", f"{queue}@%h", "--loglevel=info",
+            ]
+            for queue, concurrency in settings.OUTBOUND_QUEUE_CONCURRENCY.items()
+            if not queues or queue in queues
+        ]
+
+    def handle(self, *args, **options):
+        commands = self.worker_commands(options["queues"])
+        if options["print_only"]:
+            for command in commands:
+                self.stdout.write(shlex.join(command))
+            return
+
+        workers = [subprocess.Popen(command) for command in commands]
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: [worker.terminate() for worker in workers])
+        self.stdout.write(f"Started {len(workers)} outbound workers.")
+        for worker in workers:
+            worker.wait()
@@ -0,0 +1,74 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .utils import metrics
+
+logger = logging.getLogger("messaging.slow_requests")
+
+
+class RequestMetricsMiddleware:
+    """
+    Record latency, query count, DB time and timed phases for every request,
+    labelled by URL route, and log requests slower than
+    MESSAGING_SLOW_REQUEST_MS together with their queries.
+
+    Runs natively under both WSGI and ASGI so async views don't pay for a
+    thread hop.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.MESSAGING_METRICS_ENABLED:
+            return self.get_response(request)
+
+        state, token, start = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.end_request(token)
+        self.finish(request, state, duration)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.MESSAGING_METRICS_ENABLED:
+            return await self.get_response(request)
+
+        state, token, start = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.end_request(token)
+        self.finish(request, state, duration)
+        return response
+
+    def start(self):
+        slow_ms = settings.MESSAGING_SLOW_REQUEST_MS
+        state = metrics.RequestMetrics(max_queries=settings.MESSAGING_SLOW_REQUEST_MAX_QUERIES if slow_ms else 0)
+        return state, metrics.begin_request(state), time.perf_counter()
+
+    def finish(self, request, state, duration):
+        match = request.resolver_match
+        endpoint = match.route if match else "unmatched"
+        metrics.observe_request(endpoint, request.method, duration, state)
+
+        slow_ms = settings.MESSAGING_SLOW_REQUEST_MS
+        if slow_ms and duration * 1000 >= slow_ms:
+            logger.warning(
+                "Slow request %s %s: %.1f ms, %d queries, %.1f ms in DB, phases %s\n%s",
+                request.method, request.path, duration * 1000, state.query_count, state.db_time * 1000,
+                {name: round(elapsed * 1000, 1) for name, elapsed in state.phases.items()},
+                "\n".join(f"  {elapsed * 1000:8.2f} ms  {sql}" for sql, elapsed in state.queries),
+            )
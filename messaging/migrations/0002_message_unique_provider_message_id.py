@@ -0,0 +1,37 @@
+# Generated by Django 5.2.1 on 2026-10-18 15:50
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_messages(apps, schema_editor):
+    """Keep the earliest row for each (provider, provider_message_id)."""
+    Message = apps.get_model('messaging', 'Message')
+    duplicates = (
+        Message.objects
+        .filter(provider_message_id__isnull=False)
+        .values('provider', 'provider_message_id')
+        .order_by()
+        .annotate(keep_id=Min('id'), rows=Count('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        Message.objects.filter(
+            provider=duplicate['provider'],
+            provider_message_id=duplicate['provider_message_id'],
+        ).exclude(id=duplicate['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('provider', 'provider_message_id'), name='unique_provider_message_id'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:40
+
+import json
+
+from django.db import migrations, models
+
+
+def encode_payloads(apps, schema_editor):
+    OutboxMessage = apps.get_model('messaging', 'OutboxMessage')
+    for entry in OutboxMessage.objects.filter(dispatched_at__isnull=True).iterator():
+        entry.body = json.dumps(entry.payload, separators=(",", ":")).encode()
+        entry.save(update_fields=['body'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0004_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='body',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.RunPython(encode_payloads, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='outboxmessage',
+            name='payload',
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:28
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def merge_duplicate_conversations(apps, schema_editor):
+    # Racing get_or_create calls could create the same pair twice; keep the
+    # oldest conversation and move the duplicates' messages onto it.
+    Conversation = apps.get_model('messaging', 'Conversation')
+    Message = apps.get_model('messaging', 'Message')
+    duplicates = (
+        Conversation.objects.values('participant_1', 'participant_2')
+        .annotate(keep=Min('id'), copies=Count('id'))
+        .filter(copies__gt=1)
+    )
+    for pair in duplicates:
+        extra = Conversation.objects.filter(
+            participant_1=pair['participant_1'], participant_2=pair['participant_2']
+        ).exclude(id=pair['keep'])
+        Message.objects.filter(conversation__in=extra).update(conversation=pair['keep'])
+        extra.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0007_attachmentoffload'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_conversations, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['timestamp', 'id'], name='message_timeline'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('participant_1', 'participant_2'), name='unique_conversation_participants'),
+        ),
+    ]
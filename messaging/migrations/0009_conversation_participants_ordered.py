@@ -0,0 +1,35 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:39
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def normalize_participant_order(apps, schema_editor):
+    # Pairs have always been written as (lower id, higher id); fold any row
+    # created another way into the normalized conversation.
+    Conversation = apps.get_model('messaging', 'Conversation')
+    Message = apps.get_model('messaging', 'Message')
+    for conversation in Conversation.objects.filter(participant_1__gt=F('participant_2')):
+        low, high = conversation.participant_2_id, conversation.participant_1_id
+        existing = Conversation.objects.filter(participant_1_id=low, participant_2_id=high).first()
+        if existing is None:
+            conversation.participant_1_id, conversation.participant_2_id = low, high
+            conversation.save(update_fields=['participant_1', 'participant_2'])
+        else:
+            Message.objects.filter(conversation=conversation).update(conversation=existing)
+            conversation.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0008_conversation_unique_pair'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_participant_order, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.CheckConstraint(condition=models.Q(('participant_1__lte', models.F('participant_2'))), name='conversation_participants_ordered'),
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:41
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Q
+
+from messaging.utils.addresses import is_email, normalize_address
+
+
+def backfill_address_keys(apps, schema_editor):
+    # Existing rows get their key before it becomes unique, so lookups by
+    # address_key find them and nothing is created twice. Participants that
+    # normalize to the same address are folded into the oldest one, and
+    # their conversations with the same person into one conversation.
+    # Addresses that can't be normalized keep a null key and are reported
+    # by `manage.py normalize_participants`.
+    Participant = apps.get_model('messaging', 'Participant')
+    Conversation = apps.get_model('messaging', 'Conversation')
+    Message = apps.get_model('messaging', 'Message')
+
+    groups = defaultdict(list)
+    for participant_id, email, phone in Participant.objects.order_by('id').values_list('id', 'email', 'phone'):
+        try:
+            groups[normalize_address(email or phone or "")].append(participant_id)
+        except ValueError:
+            continue
+
+    for address_key, (survivor_id, *duplicate_ids) in groups.items():
+        for duplicate_id in duplicate_ids:
+            conversations = Conversation.objects.filter(
+                Q(participant_1_id=duplicate_id) | Q(participant_2_id=duplicate_id)
+            ).values_list('id', 'participant_1_id', 'participant_2_id')
+            for conversation_id, participant_1_id, participant_2_id in list(conversations):
+                other_id = participant_2_id if participant_1_id == duplicate_id else participant_1_id
+                if other_id == duplicate_id:
+                    other_id = survivor_id
+                low, high = min(survivor_id, other_id), max(survivor_id, other_id)
+                target_id = (
+                    Conversation.objects
+                    .filter(participant_1_id=low, participant_2_id=high)
+                    .exclude(id=conversation_id)
+                    .values_list('id', flat=True)
+                    .first()
+                )
+                if target_id is None:
+                    Conversation.objects.filter(id=conversation_id).update(participant_1_id=low, participant_2_id=high)
+                else:
+                    Message.objects.filter(conversation_id=conversation_id).update(conversation_id=target_id)
+                    Conversation.objects.filter(id=conversation_id).delete()
+            Message.objects.filter(sender_id=duplicate_id).update(sender_id=survivor_id)
+            Message.objects.filter(receiver_id=duplicate_id).update(receiver_id=survivor_id)
+            Participant.objects.filter(id=duplicate_id).delete()
+
+        field = 'email' if is_email(address_key) else 'phone'
+        Participant.objects.filter(id=survivor_id).update(address_key=address_key, **{field: address_key})
+
+
+class Migration(migrations.Migration):
+    # The backfill commits on its own: PostgreSQL won't ALTER a table with
+    # foreign key checks still pending from the merge in the same transaction.
+    atomic = False
+
+    dependencies = [
+        ('messaging', '0009_conversation_participants_ordered'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='address_key',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='participant',
+            name='email',
+            field=models.EmailField(blank=True, max_length=254, null=True),
+        ),
+        migrations.AlterField(
+            model_name='participant',
+            name='phone',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.RunPython(backfill_address_keys, migrations.RunPython.noop, atomic=True),
+        migrations.AlterField(
+            model_name='participant',
+            name='address_key',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
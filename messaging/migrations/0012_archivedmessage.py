@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0011_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('type', models.CharField(choices=[('sms', 'SMS'), ('mms', 'MMS'), ('email', 'Email')], max_length=10)),
+                ('body', models.TextField()),
+                ('attachments', models.JSONField(blank=True, null=True)),
+                ('timestamp', models.DateTimeField()),
+                ('provider', models.CharField(max_length=50)),
+                ('provider_message_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='messaging.conversation')),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='messaging.participant')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='messaging.participant')),
+            ],
+            options={
+                'ordering': ['timestamp'],
+                'indexes': [models.Index(fields=['conversation', 'timestamp', 'id'], name='archived_conversation_timeline'), models.Index(fields=['timestamp', 'id'], name='archived_message_timeline')],
+            },
+        ),
+    ]
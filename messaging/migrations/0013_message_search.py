@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# The index is not a Django model: FTS5 tables are virtual tables, and the
+# PostgreSQL table is only ever read through messaging.utils.message_search.
+# Existing messages are indexed by `manage.py rebuild_search_index`.
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE messaging_message_search USING fts5(body, tokenize='unicode61 remove_diacritics 2')"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE TABLE messaging_message_search (message_id bigint PRIMARY KEY, document tsvector NOT NULL)"
+        )
+        schema_editor.execute(
+            "CREATE INDEX message_search_document ON messaging_message_search USING gin (document)"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute("DROP TABLE IF EXISTS messaging_message_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0012_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0014_delivery_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='priority',
+            field=models.CharField(default='normal', max_length=10),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0015_outboxmessage_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedDeliveryAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['provider', 'provider_message_id'], name='archived_provider_message_id'),
+        ),
+        migrations.AddField(
+            model_name='archiveddeliveryattempt',
+            name='message',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='delivery_attempts', to='messaging.archivedmessage'),
+        ),
+        migrations.AddIndex(
+            model_name='archiveddeliveryattempt',
+            index=models.Index(fields=['message', 'created_at'], name='archived_attempt_message'),
+        ),
+    ]
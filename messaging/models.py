@@ -2,8 +2,13 @@ from django.db import models
 
 
 class Participant(models.Model):
-    email = models.EmailField(blank=True, null=True, unique=True)
-    phone = models.CharField(max_length=50, blank=True, null=True, unique=True)
+    email = models.EmailField(blank=True, null=True)
+    phone = models.CharField(max_length=50, blank=True, null=True)
+    # Lower-cased email or E.164 phone number (messaging.utils.addresses),
+    # the only column participants are looked up by. Rows created before it
+    # existed are filled in by its migration; `manage.py
+    # normalize_participants` catches up rows written by older code since.
+    address_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -25,6 +30,33 @@ class Conversation(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Kept up to date by messaging.utils.conversation_summary whenever
+    # messages are inserted, so inboxes don't aggregate over Message.
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=255, blank=True, default="")
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # "Most recent conversations for a participant", one index per
+            # side of the pair.
+            models.Index(fields=['participant_1', '-last_message_at', '-id'], name='conversation_p1_recent'),
+            models.Index(fields=['participant_2', '-last_message_at', '-id'], name='conversation_p2_recent'),
+        ]
+        constraints = [
+            # Pairs are stored as (lower id, higher id), so this also serves
+            # the pair lookup and stops racing get_or_create calls from
+            # creating the same conversation twice.
+            models.UniqueConstraint(
+                fields=['participant_1', 'participant_2'],
+                name='unique_conversation_participants'
+            ),
+            models.CheckConstraint(
+                condition=models.Q(participant_1__lte=models.F('participant_2')),
+                name='conversation_participants_ordered'
+            ),
+        ]
+
     def __str__(self):
         return f"{self.participant_1} & {self.participant_2}"
 
@@ -35,6 +67,14 @@ class Message(models.Model):
         ("mms", "MMS"),
         ("email", "Email"),
     ]
+    # Outbound delivery, advanced by messaging.utils.delivery_status.
+    # Inbound messages have no status.
+    DELIVERY_STATUSES = [
+        ("queued", "Queued"),
+        ("sent", "Sent"),
+        ("delivered", "Delivered"),
+        ("failed", "Failed"),
+    ]
 
     conversation = models.ForeignKey(
         Conversation,
@@ -62,5 +102,163 @@ class Message(models.Model):
     provider = models.CharField(max_length=50)
     provider_message_id = models.CharField(max_length=255, null=True, blank=True)
 
+    status = models.CharField(max_length=10, choices=DELIVERY_STATUSES, null=True, blank=True)
+    status_updated_at = models.DateTimeField(null=True, blank=True)
+    attempt_count = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            # "Which messages failed (recently)?" Inbound rows are left out.
+            models.Index(
+                fields=['status', '-status_updated_at'],
+                condition=models.Q(status__isnull=False),
+                name='message_delivery_status'
+            ),
+            # Keyset pagination of a conversation's history on (timestamp, id).
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conversation_timeline'),
+            # Timeline scans across conversations, in the default ordering.
+            models.Index(fields=['timestamp', 'id'], name='message_timeline'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['provider', 'provider_message_id'],
+                name='unique_provider_message_id'
+            ),
+        ]
+
+
+class ArchivedMessage(models.Model):
+    """
+    A Message older than MESSAGING_ARCHIVE_AFTER_DAYS, moved out of the hot
+    table by the archive-messages beat task. It keeps the id it had as a
+    Message, so history pages across both tables in one (timestamp, id)
+    order.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='archived_messages'
+    )
+    sender = models.ForeignKey(Participant, on_delete=models.CASCADE, related_name='+')
+    receiver = models.ForeignKey(Participant, on_delete=models.CASCADE, related_name='+')
+
+    type = models.CharField(max_length=10, choices=Message.MESSAGE_TYPES)
+    body = models.TextField()
+    attachments = models.JSONField(null=True, blank=True)
+    timestamp = models.DateTimeField()
+
+    provider = models.CharField(max_length=50)
+    provider_message_id = models.CharField(max_length=255, null=True, blank=True)
+
+    status = models.CharField(max_length=10, choices=Message.DELIVERY_STATUSES, null=True, blank=True)
+    status_updated_at = models.DateTimeField(null=True, blank=True)
+    attempt_count = models.PositiveSmallIntegerField(default=0)
+
+    archived_at = models.DateTimeField(auto_now_add=True)
+
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='archived_conversation_timeline'),
+            # Retention deletes the oldest rows first.
+            models.Index(fields=['timestamp', 'id'], name='archived_message_timeline'),
+            # Webhook retries for archived messages are still duplicates.
+            models.Index(fields=['provider', 'provider_message_id'], name='archived_provider_message_id'),
+        ]
+
+
+class DeliveryAttempt(models.Model):
+    """
+    One try at handing an outbound message to its provider. Written in
+    bulk by the delivery workers; ``error`` is empty when the provider
+    accepted the message.
+    """
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name='delivery_attempts'
+    )
+    error = models.TextField(blank=True, default="")
+
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['message', 'created_at'], name='delivery_attempt_message'),
+        ]
+
+
+class ArchivedDeliveryAttempt(models.Model):
+    """A DeliveryAttempt of an archived message, moved along with it."""
+    message = models.ForeignKey(
+        ArchivedMessage,
+        on_delete=models.CASCADE,
+        related_name='delivery_attempts'
+    )
+    error = models.TextField(blank=True, default="")
+
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['message', 'created_at'], name='archived_attempt_message'),
+        ]
+
+
+class Attachment(models.Model):
+    """
+    Metadata for a content-addressed blob in the attachment store. Messages
+    refer to it as ``attachment:<sha256>`` instead of holding the media.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=255)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
+
+class OutboxMessage(models.Model):
+    """
+    Outbound delivery written in the same transaction as its Message and
+    handed to the broker later by the outbox relay.
+    """
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name='outbox_entries'
+    )
+    provider_url = models.CharField(max_length=255)
+    # Provider request body, JSON encoded once when the message is accepted.
+    body = models.BinaryField()
+    # Selects the delivery queue; see messaging.utils.outbound_routing.
+    priority = models.CharField(max_length=10, default='normal')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['id'],
+                condition=models.Q(dispatched_at__isnull=True),
+                name='outbox_pending'
+            ),
+            models.Index(fields=['dispatched_at'], name='outbox_dispatched_at'),
+        ]
+
+
+class AttachmentOffload(models.Model):
+    """
+    An inbound message with remote attachments still to be copied into the
+    attachment store. Keyed like the provider's webhook because
+    bulk_create(ignore_conflicts=True) doesn't return Message ids.
+    """
+    provider = models.CharField(max_length=50)
+    provider_message_id = models.CharField(max_length=255)
+
+    created_at = models.DateTimeField(auto_now_add=True)
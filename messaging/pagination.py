@@ -0,0 +1,180 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique composite ordering such as
+    (timestamp, id).
+
+    The cursor encodes the key of the last row on the page, so the next page
+    is a range scan on the matching index instead of an OFFSET. Page 500 of
+    a long thread costs the same as page 1.
+    """
+    ordering = ('id',)
+    page_size = 50
+    max_page_size = 200
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position))
+
+        rows = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_position = self.get_position(rows[-1])
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(self.next_position)
+        )
+
+    def get_position(self, row):
+        return [getattr(row, field.lstrip('-')) for field in self.ordering]
+
+    def get_position_filter(self, position):
+        # (a, b) > (x, y)  ==  a > x OR (a = x AND b > y)
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+
+        # The redundant bound on the leading column lets the planner seek
+        # straight to the cursor instead of filtering every earlier row.
+        field, value = self.ordering[0], position[0]
+        lookup = 'lte' if field.startswith('-') else 'gte'
+        return Q(**{f'{field.lstrip("-")}__{lookup}': value}) & condition
+
+    def encode_cursor(self, position):
+        values = [value.isoformat() if isinstance(value, datetime) else value for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, request, model):
+        """
+        The position in the request's cursor, each value parsed by its
+        ordering field on ``model``. Tampered cursors raise NotFound.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+        except (binascii.Error, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return [self.parse_value(model, field, value) for field, value in zip(self.ordering, position)]
+
+    def parse_value(self, model, field, value):
+        # to_python parses datetimes and ids; the validators bound integers
+        # to the column's range.
+        model_field = model._meta.get_field(field.lstrip('-'))
+        try:
+            value = model_field.to_python(value)
+            if value is None:
+                raise ValueError
+            model_field.run_validators(value)
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return value
+
+
+class ConversationPagination(KeysetPagination):
+    ordering = ('-id',)
+
+
+class MergedKeysetPagination(KeysetPagination):
+    """
+    Keyset pagination over the union of several querysets that share the
+    ordering columns.
+
+    Each queryset is read in index order up to a page past the cursor and
+    the pages are merged, so the union costs one range scan per queryset
+    however deep the page. Rows are de-duplicated by primary key. The
+    ordering columns must all sort in the same direction.
+    """
+
+    def paginate_queryset(self, querysets, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request, querysets[0].model)
+
+        rows = {}
+        for queryset in querysets:
+            queryset = queryset.order_by(*self.ordering)
+            if position is not None:
+                queryset = queryset.filter(self.get_position_filter(position))
+            for row in queryset[:page_size + 1]:
+                rows[row.pk] = row
+        rows = sorted(rows.values(), key=self.get_position, reverse=self.ordering[0].startswith('-'))
+
+        self.next_position = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_position = self.get_position(rows[-1])
+        return rows
+
+
+class MessageHistoryPagination(MergedKeysetPagination):
+    """
+    A conversation's history in (timestamp, id) order, read from the hot
+    Message table and the ArchivedMessage table together.
+    """
+    ordering = ('timestamp', 'id')
+
+
+class MessageSearchPagination(MergedKeysetPagination):
+    """Search results, newest first, from both message tables."""
+    ordering = ('-timestamp', '-id')
+
+
+class InboxPagination(MergedKeysetPagination):
+    """
+    A participant's conversations by most recent activity.
+
+    A participant's conversations are split across participant_1 and
+    participant_2, and an OR of the two can't be read in index order.
+    Each side is read from its own (participant, -last_message_at, -id)
+    index instead and the pages are merged, so a number with a million
+    conversations pages as cheaply as one with ten.
+    """
+    ordering = ('-last_message_at', '-id')
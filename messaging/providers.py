@@ -0,0 +1,102 @@
+import json
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+
+from .utils import http_sessions
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class RateLimited(Exception):
+    def __init__(self, countdown):
+        super().__init__("Rate limited (429)")
+        self.countdown = countdown
+
+
+class ProviderError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"Provider failed with status {status_code}: {text}")
+        self.status_code = status_code
+
+
+def is_outage(exc):
+    """
+    Whether a failed call counts against the provider's circuit: 5xx and
+    connection errors do; 429s and rejected requests mean it is up.
+    """
+    if isinstance(exc, RateLimited):
+        return False
+    if isinstance(exc, ProviderError):
+        return exc.status_code >= 500
+    return True
+
+
+def backoff_countdown(retries):
+    """
+    Seconds before the next retry: exponential, capped at
+    PROVIDER_RETRY_BACKOFF_MAX, and jittered over its upper half so
+    messages that failed together don't all retry together.
+    """
+    ceiling = min(settings.PROVIDER_RETRY_BACKOFF_MAX, 2 ** retries)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait for a Retry-After header, in delta-seconds or HTTP-date form, or None."""
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0, (retry_at - (now or datetime.now(timezone.utc))).total_seconds())
+
+
+def _encode_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_provider_body(data):
+    """
+    Encode a provider request body once, when the message is accepted.
+
+    Everything downstream (outbox, broker, batch buffer, HTTP client)
+    carries these bytes as they are.
+    """
+    return json.dumps(data, separators=(",", ":"), default=_encode_default).encode()
+
+
+def encode_batch_body(bodies):
+    """Join already-encoded bodies into a JSON array without decoding them."""
+    return b"[" + b",".join(bodies) + b"]"
+
+
+def post_to_provider(provider_url, body):
+    return http_sessions.get_session(provider_url).post(
+        provider_url,
+        data=body,
+        headers=JSON_HEADERS,
+        timeout=http_sessions.get_timeout()
+    )
+
+
+def check_provider_response(response, retries):
+    """Raise RateLimited on 429 and ProviderError on any other non-200."""
+    if response.status_code == 429:
+        retry_after = response.headers.get("Retry-After")
+        countdown = parse_retry_after(retry_after) if retry_after is not None else None
+        if countdown is None:
+            countdown = backoff_countdown(retries)
+        raise RateLimited(countdown)
+
+    elif response.status_code != 200:
+        raise ProviderError(response.status_code, response.text)
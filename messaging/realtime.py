@@ -0,0 +1,353 @@
+"""
+Push new messages and delivery status changes to WebSocket clients.
+
+Writers publish each event to Redis pub/sub channels, one per conversation
+and one per participant, after their transaction commits. Publishing
+happens on a background thread per process, so requests never wait on
+Redis; while Redis is unreachable events are dropped. Every ASGI
+process runs one Hub holding a single pub/sub connection: it subscribes to
+a channel while at least one of its clients wants it and hands incoming
+events to those clients' queues, so any number of processes can share
+subscribers without knowing about each other.
+
+Clients connect to ``/ws/events/`` with ``participant`` (an address) and
+``conversation`` (an id) query parameters, each repeatable, and receive
+JSON events:
+
+    {"event": "message.created", "message": {"id": 1, "conversation": 2, ...}}
+    {"event": "message.status", "message": {"id": 1, "conversation": 2, "status": "sent"}}
+
+A client that falls MESSAGING_REALTIME_QUEUE_SIZE events behind is
+disconnected with close code 4008 and should catch up from the history
+endpoint.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qs
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.db import transaction
+
+from .models import Conversation, Message, Participant
+from .utils.addresses import normalize_address
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_PATH = "/ws/events/"
+CHANNEL_PREFIX = "messaging:events:"
+
+# Close codes in the application range (4000-4999).
+CLOSE_BAD_REQUEST = 4400
+CLOSE_NOT_FOUND = 4404
+CLOSE_TOO_SLOW = 4008
+# Standard "try again later".
+CLOSE_UNAVAILABLE = 1013
+
+# Batches of events waiting for the publisher thread; more are dropped.
+PUBLISH_QUEUE_SIZE = 10000
+# Seconds events are dropped without trying Redis after a failed publish.
+OUTAGE_BACKOFF = 5.0
+
+_publisher = None
+
+
+def conversation_channel(conversation_id):
+    return f"{CHANNEL_PREFIX}conversation:{conversation_id}"
+
+
+def participant_channel(participant_id):
+    return f"{CHANNEL_PREFIX}participant:{participant_id}"
+
+
+def get_publisher():
+    """
+    Redis client for the publisher thread, with short timeouts: a Redis
+    outage drops the push, never the message.
+    """
+    global _publisher
+    if _publisher is None:
+        timeout = settings.MESSAGING_REALTIME_PUBLISH_TIMEOUT
+        _publisher = redis.Redis.from_url(
+            settings.MESSAGING_REDIS_URL, socket_timeout=timeout, socket_connect_timeout=timeout
+        )
+    return _publisher
+
+
+def message_event(message):
+    return {
+        "event": "message.created",
+        "message": {
+            "id": message.id,
+            "conversation": message.conversation_id,
+            "sender": message.sender_id,
+            "receiver": message.receiver_id,
+            "type": message.type,
+            "body": message.body,
+            "attachments": message.attachments,
+            "timestamp": message.timestamp.isoformat(),
+            "provider": message.provider,
+        },
+    }
+
+
+class EventPublisher:
+    """
+    Publishes queued events from a daemon thread, everything waiting in
+    one round trip. After a failed publish it drops events for
+    OUTAGE_BACKOFF seconds instead of trying Redis for each of them.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.pid = None
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+
+    def put(self, events):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(events)
+        except queue.Full:
+            logger.warning("Realtime publish queue is full, dropping %d events", len(events))
+
+    def start(self):
+        # A forked child gets its own queue and thread; the parent's thread
+        # doesn't exist there.
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(PUBLISH_QUEUE_SIZE)
+                threading.Thread(target=self.run, args=(self.queue,), name="realtime-publisher", daemon=True).start()
+                self.pid = os.getpid()
+
+    def join(self):
+        """Wait until everything queued so far has been handled."""
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def run(self, events_queue):
+        while True:
+            batches = [events_queue.get()]
+            while True:
+                try:
+                    batches.append(events_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.send([event for events in batches for event in events])
+            except Exception:
+                logger.exception("Realtime publisher failed")
+            finally:
+                for _ in batches:
+                    events_queue.task_done()
+
+    def send(self, events):
+        """Publish (conversation_id, participant_ids, event) triples in one round trip."""
+        if time.monotonic() < self.retry_at:
+            return
+        pipeline = get_publisher().pipeline(transaction=False)
+        for conversation_id, participant_ids, event in events:
+            data = json.dumps(event)
+            pipeline.publish(conversation_channel(conversation_id), data)
+            for participant_id in participant_ids:
+                pipeline.publish(participant_channel(participant_id), data)
+        try:
+            pipeline.execute()
+        except redis.RedisError as e:
+            self.retry_at = time.monotonic() + OUTAGE_BACKOFF
+            logger.warning(
+                "Could not publish %d realtime events, dropping events for %s seconds: %s",
+                len(events), OUTAGE_BACKOFF, e
+            )
+
+
+_events = EventPublisher()
+
+
+def _publish(events):
+    """Queue (conversation_id, participant_ids, event) triples for the publisher thread."""
+    if not settings.MESSAGING_REALTIME_ENABLED or not events:
+        return
+    _events.put(events)
+
+
+def publish_messages(messages):
+    """Push ``messages`` to subscribers once the current transaction commits."""
+    events = [
+        (message.conversation_id, {message.sender_id, message.receiver_id}, message_event(message))
+        for message in messages
+    ]
+    transaction.on_commit(lambda: _publish(events))
+
+
+def publish_status(message_ids, status):
+    """Push a delivery status change for ``message_ids`` once the current transaction commits."""
+    if not settings.MESSAGING_REALTIME_ENABLED:
+        return
+    rows = Message.objects.filter(id__in=message_ids).values_list('id', 'conversation_id', 'sender_id', 'receiver_id')
+    events = [
+        (
+            conversation_id,
+            {sender_id, receiver_id},
+            {"event": "message.status", "message": {"id": message_id, "conversation": conversation_id, "status": status}},
+        )
+        for message_id, conversation_id, sender_id, receiver_id in rows
+    ]
+    transaction.on_commit(lambda: _publish(events))
+
+
+class Subscriber:
+    """One WebSocket client's queue of outgoing events. ``None`` means stop."""
+
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue()
+        self.queue_size = queue_size
+        self.overflowed = False
+
+    def put(self, data):
+        if self.overflowed:
+            return
+        if self.queue.qsize() >= self.queue_size:
+            self.overflowed = True
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(data)
+
+
+class Hub:
+    """Per-process fan-out from one Redis pub/sub connection to local subscribers."""
+
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.subscribers = defaultdict(set)
+        self.reader = None
+        self.lock = asyncio.Lock()
+
+    async def subscribe(self, channels, subscriber):
+        async with self.lock:
+            new = [channel for channel in channels if not self.subscribers[channel]]
+            for channel in channels:
+                self.subscribers[channel].add(subscriber)
+            if new:
+                await self.pubsub.subscribe(*new)
+            if self.reader is None or self.reader.done():
+                self.reader = asyncio.create_task(self.read())
+
+    async def unsubscribe(self, channels, subscriber):
+        async with self.lock:
+            unused = []
+            for channel in channels:
+                self.subscribers[channel].discard(subscriber)
+                if not self.subscribers[channel]:
+                    del self.subscribers[channel]
+                    unused.append(channel)
+            if unused:
+                await self.pubsub.unsubscribe(*unused)
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except redis.RedisError as e:
+                # redis-py reconnects and re-subscribes on the next read.
+                logger.warning("Realtime pub/sub connection lost: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            channel = message["channel"].decode()
+            data = message["data"].decode()
+            for subscriber in list(self.subscribers.get(channel, ())):
+                subscriber.put(data)
+
+
+_hub = None
+
+
+def get_hub():
+    global _hub
+    if _hub is None:
+        _hub = Hub(aioredis.Redis.from_url(settings.MESSAGING_REDIS_URL))
+    return _hub
+
+
+async def resolve_channels(query_string):
+    """Channels for a connection's query string; raises LookupError or ValueError for bad subscriptions."""
+    params = parse_qs(query_string.decode())
+    channels = []
+    for address in params.get("participant", []):
+        # A lookup, not an upsert: subscribing must not create participants.
+        participant_id = await Participant.objects.filter(
+            address_key=normalize_address(address)
+        ).values_list("id", flat=True).afirst()
+        if participant_id is None:
+            raise LookupError(f"Unknown participant {address}.")
+        channels.append(participant_channel(participant_id))
+    for conversation_id in params.get("conversation", []):
+        conversation_id = int(conversation_id)
+        if not await Conversation.objects.filter(id=conversation_id).aexists():
+            raise LookupError(f"Unknown conversation {conversation_id}.")
+        channels.append(conversation_channel(conversation_id))
+    if not channels:
+        raise ValueError("Subscribe to at least one participant or conversation.")
+    return channels
+
+
+async def _read_client(receive, subscriber):
+    # Clients don't send anything we act on; wait for the disconnect.
+    while (await receive())["type"] != "websocket.disconnect":
+        pass
+    subscriber.queue.put_nowait(None)
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI application for ``/ws/events/`` connections."""
+    if (await receive())["type"] != "websocket.connect":
+        return
+    if scope["path"] != WEBSOCKET_PATH:
+        await send({"type": "websocket.close", "code": CLOSE_NOT_FOUND})
+        return
+    try:
+        channels = await resolve_channels(scope["query_string"])
+    except LookupError as e:
+        await send({"type": "websocket.close", "code": CLOSE_NOT_FOUND, "reason": str(e)})
+        return
+    except ValueError as e:
+        await send({"type": "websocket.close", "code": CLOSE_BAD_REQUEST, "reason": str(e)})
+        return
+
+    hub = get_hub()
+    subscriber = Subscriber(settings.MESSAGING_REALTIME_QUEUE_SIZE)
+    try:
+        await hub.subscribe(channels, subscriber)
+    except redis.RedisError as e:
+        logger.warning("Realtime subscription failed: %s", e)
+        await hub.unsubscribe(channels, subscriber)
+        await send({"type": "websocket.close", "code": CLOSE_UNAVAILABLE})
+        return
+    await send({"type": "websocket.accept"})
+    reader = asyncio.create_task(_read_client(receive, subscriber))
+    # A client subscribed to a conversation and one of its participants
+    # gets each event on two channels; send it once.
+    recent = deque(maxlen=32)
+    try:
+        while (data := await subscriber.queue.get()) is not None:
+            if data in recent:
+                continue
+            recent.append(data)
+            await send({"type": "websocket.send", "text": data})
+        if subscriber.overflowed:
+            await send({"type": "websocket.close", "code": CLOSE_TOO_SLOW})
+    finally:
+        reader.cancel()
+        await hub.unsubscribe(channels, subscriber)
@@ -2,14 +2,20 @@ from rest_framework import serializers
 from .models import Message, Conversation
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageHistorySerializer(serializers.ModelSerializer):
+    sender = serializers.StringRelatedField()
+    receiver = serializers.StringRelatedField()
+
     class Meta:
         model = Message
         fields = '__all__'
 
 
 class ConversationSerializer(serializers.ModelSerializer):
-    messages = MessageSerializer(many=True, read_only=True)
+    # Messages are served by the paginated history endpoint rather than
+    # nested here, which would load the whole thread into memory.
+    participant_1 = serializers.StringRelatedField()
+    participant_2 = serializers.StringRelatedField()
 
     class Meta:
         model = Conversation
@@ -0,0 +1,27 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import Conversation, Participant
+from .utils import metrics
+from .utils.message_helpers import conversation_cache, participant_cache
+
+
+@receiver(post_delete, sender=Participant)
+def evict_participant(sender, instance, **kwargs):
+    if instance.address_key:
+        participant_cache.delete(instance.address_key)
+
+
+@receiver(post_delete, sender=Conversation)
+def evict_conversation(sender, instance, **kwargs):
+    conversation_cache.delete((instance.participant_1_id, instance.participant_2_id))
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # Installed on every connection rather than per request because the
+    # async ORM runs queries on a different thread, and so a different
+    # connection, than the request's event loop.
+    if metrics.record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.record_query)
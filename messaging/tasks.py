@@ -1,33 +1,342 @@
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from celery import shared_task
-import requests
+from celery.exceptions import Retry
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import async_delivery
+from .constants import PROVIDER_BATCH_URLS
+from .models import AttachmentOffload, Message, OutboxMessage
+from .providers import (
+    RateLimited,
+    backoff_countdown,
+    check_provider_response,
+    encode_batch_body,
+    encode_provider_body,
+    is_outage,
+    post_to_provider,
+)
+from .utils import (
+    attachment_store,
+    circuit_breaker,
+    delivery_status,
+    http_sessions,
+    message_archive,
+    metrics,
+    outbound_batcher,
+    outbound_routing,
+    rate_limiter,
+)
+
+
+@worker_process_init.connect
+def open_provider_sessions(**kwargs):
+    http_sessions.open_sessions()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_provider_sessions(**kwargs):
+    http_sessions.close_sessions()
 
 
-@shared_task(bind=True, max_retries=5)
-def send_message_to_provider(self, message_payload, provider_url):
+@worker_process_shutdown.connect
+def flush_metrics(**kwargs):
+    metrics.flush()
+
+
+def call_provider(provider_url, body, retries=0):
+    """
+    POST ``body`` and check the response like check_provider_response,
+    counting the outcome against the provider's circuit.
+    """
+    started = time.monotonic()
     try:
-        response = requests.post(provider_url, json=message_payload)
-
-        if response.status_code == 429:
-            retry_after = response.headers.get("Retry-After")
-            if retry_after is not None:
-                # Retry-After might be in seconds or as an HTTP-date
-                try:
-                    countdown = int(retry_after)
-                except ValueError:
-                    # Handle HTTP-date format if needed in future
-                    countdown = 60  # fallback
-            else:
-                countdown = 2 ** self.request.retries  # exponential backoff fallback
-
-            raise self.retry(
-                exc=Exception("Rate limited (429)"),
-                countdown=countdown
-            )
+        response = post_to_provider(provider_url, body)
+        check_provider_response(response, retries)
+    except Exception as exc:
+        circuit_breaker.record(provider_url, is_outage(exc), time.monotonic() - started)
+        raise
+    circuit_breaker.record(provider_url, False, time.monotonic() - started)
+    return response
+
+
+@shared_task(bind=True, max_retries=5, serializer="msgpack", ignore_result=True)
+def send_message_to_provider(self, body, provider_url, message_id=None, priority=outbound_routing.NORMAL):
+    """
+    Deliver one message. ``body`` is the provider request body encoded by
+    encode_provider_body, sent as is; msgpack carries it through the broker
+    as raw bytes.
 
-        elif response.status_code != 200:
-            raise Exception(f"Provider failed with status {response.status_code}: {response.text}")
+    The outcome is recorded on the Message (see delivery_status), so
+    nothing is stored in the result backend. Rescheduled and retried
+    deliveries go to the retry queue (see outbound_routing).
+    """
+    if isinstance(body, dict):
+        # Tasks queued before bodies were pre-encoded.
+        body = encode_provider_body(body)
 
-        return {"status": "success", "response": response.json()}
+    # While the provider's circuit is open, park without calling it or
+    # taking a rate limit token.
+    wait, status = circuit_breaker.wait_seconds(provider_url), "parked"
+    if not wait:
+        wait, status = rate_limiter.wait_for_token(provider_url), "deferred"
+    if wait:
+        # Neither is a failure, so this doesn't spend a retry, but the
+        # retries already spent carry over so max_retries still applies.
+        self.apply_async(
+            (body, provider_url, message_id, priority),
+            countdown=wait,
+            queue=outbound_routing.retry_queue(priority),
+            retries=self.request.retries
+        )
+        return {"status": status, "countdown": wait}
 
+    try:
+        response = call_provider(provider_url, body, self.request.retries)
+    except Retry:
+        raise
     except Exception as exc:
-        raise self.retry(exc=exc, countdown=2 ** self.request.retries)
+        final = self.request.retries >= self.max_retries
+        delivery_status.record_attempts([(message_id, str(exc), final)])
+        queue = outbound_routing.retry_queue(priority)
+        if isinstance(exc, RateLimited):
+            rate_limiter.penalize(provider_url, exc.countdown)
+            raise self.retry(exc=exc, countdown=exc.countdown, queue=queue)
+        raise self.retry(exc=exc, countdown=backoff_countdown(self.request.retries), queue=queue)
+
+    delivery_status.record_attempts([(message_id, None, False)])
+    return {"status": "success", "status_code": response.status_code}
+
+
+def enqueue_outbound_batch(message_id, body, provider_url):
+    """Buffer a message and schedule the flush that will deliver its batch."""
+    buffered, opened_window = outbound_batcher.push(message_id, body, provider_url)
+    if buffered >= settings.OUTBOUND_BATCH_MAX_SIZE:
+        flush_outbound_batch.delay(provider_url)
+    elif opened_window:
+        flush_outbound_batch.apply_async((provider_url,), countdown=settings.OUTBOUND_BATCH_WINDOW)
+
+
+@shared_task
+def flush_outbound_batch(provider_url):
+    deliveries, remaining = outbound_batcher.drain(provider_url, settings.OUTBOUND_BATCH_MAX_SIZE)
+    if remaining:
+        flush_outbound_batch.delay(provider_url)
+    if deliveries:
+        return deliver_outbound_batch(deliveries, provider_url)
+    return {"delivered": 0, "retrying": 0}
+
+
+@shared_task(serializer="msgpack", ignore_result=True)
+def retry_outbound_batch(deliveries, provider_url, retries):
+    """Deliver a batch the provider's batch endpoint deferred or rate limited."""
+    return deliver_outbound_batch([tuple(delivery) for delivery in deliveries], provider_url, retries)
+
+
+def deliver_outbound_batch(deliveries, provider_url, retries=0):
+    """
+    Deliver (message_id, body) pairs in one request when the provider has a
+    batch endpoint, otherwise fan out concurrently over the pooled session.
+
+    A batch call takes one token from the provider's rate limit. When it
+    has to wait, or the provider answers 429, the whole batch is retried
+    later, up to send_message_to_provider's max_retries times before it is
+    fanned out. Messages that fail are handed to send_message_to_provider
+    on the retry queue so they keep its per-message retry and backoff
+    behaviour.
+    """
+    retry_queue = outbound_routing.retry_queue()
+    batch_url = PROVIDER_BATCH_URLS.get(provider_url)
+    # The batch endpoint has its own circuit; while it is open, fan out.
+    if batch_url and retries <= send_message_to_provider.max_retries and not circuit_breaker.wait_seconds(batch_url):
+        wait = rate_limiter.wait_for_token(provider_url)
+        if wait:
+            retry_outbound_batch.apply_async((deliveries, provider_url, retries), countdown=wait, queue=retry_queue)
+            return {"delivered": 0, "retrying": len(deliveries)}
+        try:
+            batch_body = encode_batch_body([body for _, body in deliveries])
+            call_provider(batch_url, batch_body, retries)
+        except RateLimited as exc:
+            rate_limiter.penalize(provider_url, exc.countdown)
+            delivery_status.record_attempts([(message_id, str(exc), False) for message_id, _ in deliveries])
+            retry_outbound_batch.apply_async(
+                (deliveries, provider_url, retries + 1), countdown=exc.countdown, queue=retry_queue
+            )
+            return {"delivered": 0, "retrying": len(deliveries)}
+        except Exception:
+            pass
+        else:
+            delivery_status.record_attempts([(message_id, None, False) for message_id, _ in deliveries])
+            return {"delivered": len(deliveries), "retrying": 0}
+
+    def deliver(delivery):
+        """Returns the attempt as (message_id, error, final), or None if it was deferred or parked."""
+        message_id, body = delivery
+        wait = circuit_breaker.wait_seconds(provider_url) or rate_limiter.wait_for_token(provider_url)
+        if wait:
+            send_message_to_provider.apply_async((body, provider_url, message_id), countdown=wait, queue=retry_queue)
+            return None
+        try:
+            call_provider(provider_url, body)
+            return (message_id, None, False)
+        except RateLimited as exc:
+            rate_limiter.penalize(provider_url, exc.countdown)
+            send_message_to_provider.apply_async(
+                (body, provider_url, message_id), countdown=exc.countdown, queue=retry_queue
+            )
+            return (message_id, str(exc), False)
+        except Exception as exc:
+            send_message_to_provider.apply_async(
+                (body, provider_url, message_id), countdown=backoff_countdown(0), queue=retry_queue
+            )
+            return (message_id, str(exc), False)
+
+    with ThreadPoolExecutor(max_workers=settings.OUTBOUND_BATCH_CONCURRENCY) as executor:
+        attempts = [attempt for attempt in executor.map(deliver, deliveries) if attempt is not None]
+    delivery_status.record_attempts(attempts)
+    delivered = sum(1 for _, error, _ in attempts if error is None)
+    return {"delivered": delivered, "retrying": len(deliveries) - delivered}
+
+
+def dispatch_outbound(deliveries, priority=outbound_routing.NORMAL):
+    """
+    Hand (message_id, body, provider_url) triples to the configured delivery
+    engine. High priority messages skip the batch window.
+    """
+    with metrics.phase("broker_publish", endpoint="outbox_relay"):
+        if settings.OUTBOUND_DELIVERY_ENGINE == "asyncio":
+            async_delivery.enqueue_many(deliveries, priority)
+        elif settings.OUTBOUND_BATCHING_ENABLED and priority == outbound_routing.NORMAL:
+            for message_id, body, provider_url in deliveries:
+                enqueue_outbound_batch(message_id, body, provider_url)
+        else:
+            for message_id, body, provider_url in deliveries:
+                send_message_to_provider.delay(body, provider_url, message_id, priority)
+
+
+def relay_outbox_batch(batch_size=None):
+    """
+    Dispatch up to ``batch_size`` pending outbox rows and mark them
+    dispatched in the same transaction.
+
+    Delivery is at least once: if the commit fails after the broker publish
+    the rows are sent again by the next relay. Returns the number relayed.
+    """
+    batch_size = batch_size or settings.OUTBOX_RELAY_BATCH_SIZE
+    with transaction.atomic():
+        entries = list(
+            OutboxMessage.objects
+            .select_for_update(skip_locked=True)
+            .filter(dispatched_at__isnull=True)
+            .order_by('id')
+            .values_list('id', 'message_id', 'body', 'provider_url', 'priority')[:batch_size]
+        )
+        if entries:
+            by_priority = defaultdict(list)
+            for _, message_id, body, provider_url, priority in entries:
+                # BinaryField reads back as memoryview on some backends.
+                by_priority[priority].append((message_id, bytes(body), provider_url))
+            for priority in sorted(by_priority, key=outbound_routing.PRIORITIES.index):
+                dispatch_outbound(by_priority[priority], priority)
+            OutboxMessage.objects.filter(
+                id__in=[entry[0] for entry in entries]
+            ).update(dispatched_at=timezone.now())
+    return len(entries)
+
+
+def purge_dispatched_outbox(batch_size=None):
+    batch_size = batch_size or settings.OUTBOX_RELAY_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(hours=settings.OUTBOX_RETENTION_HOURS)
+    expired = OutboxMessage.objects.filter(dispatched_at__lt=cutoff).values_list('id', flat=True)[:batch_size]
+    return OutboxMessage.objects.filter(id__in=list(expired)).delete()[0]
+
+
+@shared_task
+def relay_outbox():
+    relayed = 0
+    while True:
+        count = relay_outbox_batch()
+        relayed += count
+        if count < settings.OUTBOX_RELAY_BATCH_SIZE:
+            break
+    return {"relayed": relayed, "purged": purge_dispatched_outbox()}
+
+
+def schedule_attachment_offload(messages):
+    """
+    Record inbound messages that link to remote media so offload_attachments
+    can copy it into the attachment store. Nothing talks to the broker or
+    the media host during the request.
+    """
+    if not settings.MESSAGING_ATTACHMENT_OFFLOAD_INBOUND:
+        return
+    AttachmentOffload.objects.bulk_create([
+        AttachmentOffload(provider=message.provider, provider_message_id=message.provider_message_id)
+        for message in messages
+        if isinstance(message.attachments, list) and any(map(attachment_store.is_remote, message.attachments))
+    ])
+
+
+def offload_message_attachments(provider, provider_message_id):
+    """
+    Stream a message's remote attachments into the attachment store and
+    replace their URLs with references. Returns whether anything changed.
+    """
+    message = (
+        Message.objects
+        .filter(provider=provider, provider_message_id=provider_message_id)
+        .only('id', 'attachments')
+        .first()
+    )
+    if message is None or not isinstance(message.attachments, list):
+        return False
+    attachments = [
+        attachment_store.offload(value) if attachment_store.is_remote(value) else value
+        for value in message.attachments
+    ]
+    if attachments == message.attachments:
+        return False
+    Message.objects.filter(id=message.id).update(attachments=attachments)
+    return True
+
+
+def offload_attachment_batch(batch_size=None):
+    """
+    Offload up to ``batch_size`` pending messages and drop their entries.
+
+    Downloads run outside any transaction. Entries are removed only after
+    their message is handled, so a crash repeats the work, which the
+    content-addressed store makes harmless. Returns the number handled.
+    """
+    batch_size = batch_size or settings.OUTBOX_RELAY_BATCH_SIZE
+    entries = list(
+        AttachmentOffload.objects.order_by('id')
+        .values_list('id', 'provider', 'provider_message_id')[:batch_size]
+    )
+    for _, provider, provider_message_id in entries:
+        offload_message_attachments(provider, provider_message_id)
+    AttachmentOffload.objects.filter(id__in=[entry[0] for entry in entries]).delete()
+    return len(entries)
+
+
+@shared_task
+def offload_attachments():
+    offloaded = 0
+    while True:
+        count = offload_attachment_batch()
+        offloaded += count
+        if count < settings.OUTBOX_RELAY_BATCH_SIZE:
+            break
+    return {"offloaded": offloaded}
+
+
+@shared_task
+def archive_messages():
+    return message_archive.archive_messages()
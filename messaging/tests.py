@@ -1,17 +1,106 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from uuid import UUID
 
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from importlib import import_module
+from io import StringIO
+
+import fakeredis
+import httpx
+import msgpack
+import redis
+import requests
+from celery.exceptions import Retry
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
 from django.utils.dateparse import parse_datetime
-from django.test import TestCase
-from rest_framework.test import APITestCase
-from rest_framework import status
-from messaging.models import Message
-from messaging.utils.message_helpers import build_validated_message_data
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+from rest_framework import serializers, status
+from hatch_messaging.celery import app
+from messaging import async_delivery, realtime
+from messaging.constants import PROVIDER_URLS
+from messaging.models import (
+    ArchivedMessage, Attachment, AttachmentOffload, Conversation, DeliveryAttempt, Message, OutboxMessage,
+    Participant,
+)
+from messaging.providers import (
+    ProviderError, RateLimited, check_provider_response, encode_provider_body, is_outage, parse_retry_after
+)
+from messaging.tasks import (
+    deliver_outbound_batch,
+    flush_outbound_batch,
+    offload_attachment_batch,
+    purge_dispatched_outbox,
+    relay_outbox_batch,
+    send_message_to_provider,
+)
+from messaging.utils import (
+    attachment_store, circuit_breaker, http_sessions, metrics, outbound_batcher, rate_limiter
+)
+from messaging.utils.addresses import normalize_address
+from messaging.utils.cache import LRUCache
+from messaging.utils.conversation_summary import make_preview, rebuild_summaries
+from messaging.utils.message_archive import archive_messages
+from messaging.utils import message_helpers
+from messaging.utils.message_helpers import (
+    build_validated_message_data,
+    bulk_resolve_conversation_ids,
+    clear_resolution_caches,
+    get_resolution_cache_stats,
+    insert_message,
+    upsert_conversation_id,
+    upsert_participant_id,
+)
+from messaging.utils.message_validation import build_message
+
+DELETE = object()
+
+
+class ResolutionCacheMixin:
+    """
+    Start every test with empty resolution caches, since rolled back rows
+    leave stale ids behind, and publish realtime events to a fake Redis.
+    """
+
+    def setUp(self):
+        super().setUp()
+        clear_resolution_caches()
+        patcher = patch("messaging.realtime._publisher", fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Events queued by the test are sent before the fake goes away.
+        self.addCleanup(realtime._events.join)
+
 
+class FakeRedisMixin:
+
+    def setUp(self):
+        super().setUp()
+        self.redis_server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.redis_server)
+        for target in (
+            "messaging.utils.redis_client._client", "messaging.realtime._publisher", "messaging.utils.metrics._store"
+        ):
+            patcher = patch(target, self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
-class InboundMessageTests(APITestCase):
 
-    @patch("messaging.views.send_message_to_provider.delay")
+class InboundMessageTests(ResolutionCacheMixin, APITestCase):
+
+    @patch("messaging.tasks.send_message_to_provider.delay")
     def test_inbound_sms(self, mock_delay):
         data = {
             "from": "+18045551234",
@@ -27,7 +116,7 @@ class InboundMessageTests(APITestCase):
         self.assertEqual(Message.objects.count(), 1)
         mock_delay.assert_not_called()
 
-    @patch("messaging.views.send_message_to_provider.delay")
+    @patch("messaging.tasks.send_message_to_provider.delay")
     def test_inbound_mms(self, mock_delay):
         data = {
             "from": "+18045551234",
@@ -43,7 +132,7 @@ class InboundMessageTests(APITestCase):
         self.assertEqual(Message.objects.count(), 1)
         mock_delay.assert_not_called()
 
-    @patch("messaging.views.send_message_to_provider.delay")
+    @patch("messaging.tasks.send_message_to_provider.delay")
     def test_inbound_email(self, mock_delay):
         data = {
             "from": "user@usehatchapp.com",
@@ -59,6 +148,56 @@ class InboundMessageTests(APITestCase):
         self.assertEqual(Message.objects.count(), 1)
         mock_delay.assert_not_called()
 
+    def test_inbound_retry_is_idempotent(self):
+        data = {
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "sms",
+            "messaging_provider_id": "message-4",
+            "body": "Retried webhook",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        first = self.client.post("/messages/inbound/", data, format="json")
+        retry = self.client.post("/messages/inbound/", data, format="json")
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data["detail"], "Message already exists.")
+        self.assertEqual(Message.objects.count(), 1)
+
+        # A retry that passes the lookup still loses to the unique constraint.
+        with patch("messaging.views.message_exists", return_value=False), \
+                patch("messaging.views.schedule_attachment_offload") as mock_offload:
+            race = self.client.post("/messages/inbound/", data, format="json")
+        self.assertEqual(race.status_code, status.HTTP_200_OK)
+        self.assertEqual(race.data["detail"], "Message already exists.")
+        mock_offload.assert_not_called()
+
+    def test_insert_skips_duplicates_without_raising(self):
+        self.client.post("/messages/inbound/", {
+            "from": "+18045551234", "to": "+12016661234", "type": "sms",
+            "messaging_provider_id": "message-5", "body": "First", "timestamp": "2024-11-01T14:00:00Z",
+        }, format="json")
+        stored = Message.objects.get()
+
+        def copy(provider_message_id):
+            return Message(
+                type=stored.type, provider=stored.provider, provider_message_id=provider_message_id, body="Again",
+                sender_id=stored.sender_id, receiver_id=stored.receiver_id, conversation_id=stored.conversation_id,
+                timestamp=stored.timestamp,
+            )
+
+        # The conflicting insert is skipped, not rolled back.
+        duplicate = copy("message-5")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(insert_message(duplicate))
+        self.assertIsNone(duplicate.pk)
+        self.assertEqual([query["sql"].split()[0] for query in queries], ["SAVEPOINT", "INSERT", "RELEASE"])
+
+        message = copy("message-6")
+        self.assertTrue(insert_message(message))
+        self.assertEqual(Message.objects.get(provider_message_id="message-6").id, message.pk)
+        self.assertEqual(Conversation.objects.get().message_count, 2)
+
     def test_inbound_missing_type(self):
         data = {
             "from": "user@usehatchapp.com",
@@ -71,9 +210,101 @@ class InboundMessageTests(APITestCase):
         self.assertIn("detail", response.data)
 
 
-class OutboundMessageTests(APITestCase):
+class InboundBatchTests(ResolutionCacheMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sms = {
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "sms",
+            "messaging_provider_id": "batch-1",
+            "body": "Hello inbound SMS",
+            "attachments": None,
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        self.email = {
+            "from": "user@usehatchapp.com",
+            "to": "contact@gmail.com",
+            "xillio_id": "batch-2",
+            "body": "<html><body>Email content</body></html>",
+            "attachments": ["attachment-url"],
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+
+    def test_batch_stores_all_valid_items(self):
+        reply = dict(self.sms, **{"from": self.sms["to"], "to": self.sms["from"], "messaging_provider_id": "batch-3"})
+        response = self.client.post("/messages/inbound/batch/", [self.sms, self.email, reply], format="json")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([r["status"] for r in response.data["results"]], ["received"] * 3)
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(Participant.objects.count(), 4)
+        self.assertEqual(Conversation.objects.count(), 2)
+
+    def test_batch_reports_per_item_errors(self):
+        missing_type = {"from": "a@a.com", "to": "b@b.com", "body": "x", "timestamp": "2024-11-01T14:00:00Z"}
+        missing_body = dict(self.sms)
+        del missing_body["body"]
+        response = self.client.post(
+            "/messages/inbound/batch/", [self.sms, missing_type, missing_body, "junk"], format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.data["results"]
+        self.assertEqual(results[0]["status"], "received")
+        self.assertEqual(results[1]["detail"], "Missing 'type' and unable to infer message type.")
+        self.assertIn("body", results[2]["errors"])
+        self.assertEqual(results[3]["status"], "error")
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_batch_reports_impossible_timestamp_as_item_error(self):
+        bad_date = dict(self.sms, messaging_provider_id="batch-bad-date", timestamp="2024-13-45T14:00:00Z")
+        response = self.client.post("/messages/inbound/batch/", [bad_date, self.email], format="json")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.data["results"]
+        self.assertEqual(results[0]["status"], "error")
+        self.assertIn("month", results[0]["detail"])
+        self.assertEqual(results[1]["status"], "received")
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_batch_reuses_existing_participants_and_conversations(self):
+        self.client.post("/messages/inbound/", self.sms, format="json")
+        batch = [dict(self.sms, messaging_provider_id=f"batch-{i}") for i in range(10, 20)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/messages/inbound/batch/", batch, format="json")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(Message.objects.count(), 11)
+        self.assertEqual(Participant.objects.count(), 2)
+        self.assertEqual(Conversation.objects.count(), 1)
+        # Lookups, the insert, one conversation summary update and the
+        # search index insert.
+        self.assertLessEqual(len(queries), 8)
+
+    def test_batch_marks_duplicates(self):
+        self.client.post("/messages/inbound/", self.sms, format="json")
+        response = self.client.post("/messages/inbound/batch/", [self.sms, self.email, self.email], format="json")
+        statuses = [r["status"] for r in response.data["results"]]
+        self.assertEqual(statuses, ["duplicate", "received", "duplicate"])
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_batch_marks_duplicates_that_lose_the_race(self):
+        self.client.post("/messages/inbound/", self.sms, format="json")
+        # The duplicate is stored between the lookup and the bulk insert.
+        with patch("messaging.utils.message_helpers._drop_duplicate_messages", lambda pending, results: pending), \
+                patch("messaging.utils.message_helpers.schedule_attachment_offload") as mock_offload:
+            response = self.client.post("/messages/inbound/batch/", [self.sms, self.email], format="json")
+        self.assertEqual([r["status"] for r in response.data["results"]], ["duplicate", "received"])
+        self.assertEqual(Message.objects.count(), 2)
+        [offloaded] = mock_offload.call_args.args
+        self.assertEqual([message.provider_message_id for message in offloaded], ["batch-2"])
+
+    def test_batch_requires_list(self):
+        response = self.client.post("/messages/inbound/batch/", self.sms, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class OutboundMessageTests(ResolutionCacheMixin, APITestCase):
 
-    @patch("messaging.views.send_message_to_provider.delay")
+    @patch("messaging.tasks.send_message_to_provider.delay")
     def test_outbound_sms(self, mock_delay):
         data = {
             "from": "+12016661234",
@@ -86,9 +317,13 @@ class OutboundMessageTests(APITestCase):
         response = self.client.post("/messages/outbound/", data, format="json")
         self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
         self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.filter(dispatched_at__isnull=True).count(), 1)
+        mock_delay.assert_not_called()
+
+        self.assertEqual(relay_outbox_batch(), 1)
         mock_delay.assert_called_once()
 
-    @patch("messaging.views.send_message_to_provider.delay")
+    @patch("messaging.tasks.send_message_to_provider.delay")
     def test_outbound_email(self, mock_delay):
         data = {
             "from": "user@usehatchapp.com",
@@ -101,12 +336,964 @@ class OutboundMessageTests(APITestCase):
         response = self.client.post("/messages/outbound/", data, format="json")
         self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
         self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.filter(dispatched_at__isnull=True).count(), 1)
+        mock_delay.assert_not_called()
+
+        self.assertEqual(relay_outbox_batch(), 1)
         mock_delay.assert_called_once()
 
 
-class BuildValidatedMessageDataTests(TestCase):
+class AsyncIngestViewTests(ResolutionCacheMixin, FakeRedisMixin, TestCase):
+
+    inbound = {
+        "from": "+18045551234",
+        "to": "+12016661234",
+        "type": "sms",
+        "messaging_provider_id": "async-1",
+        "body": "Hello from ASGI",
+        "attachments": None,
+        "timestamp": "2024-11-01T14:00:00Z"
+    }
+
+    async def post(self, path, data):
+        return await self.async_client.post(path, json.dumps(data), content_type="application/json")
+
+    async def test_async_inbound_stores_message(self):
+        response = await self.post("/messages/inbound/async/", self.inbound)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(await Message.objects.acount(), 1)
+
+        message = await Message.objects.select_related("sender", "conversation").aget()
+        self.assertEqual(message.sender.phone, "+18045551234")
+        self.assertEqual(message.provider_message_id, "async-1")
+
+    async def test_async_inbound_duplicate_returns_200(self):
+        await self.post("/messages/inbound/async/", self.inbound)
+        response = await self.post("/messages/inbound/async/", self.inbound)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"detail": "Message already exists."})
+        self.assertEqual(await Message.objects.acount(), 1)
+
+    async def test_async_inbound_duplicate_that_loses_the_race_returns_200(self):
+        await self.post("/messages/inbound/async/", self.inbound)
+        with patch("messaging.views.amessage_exists", return_value=False), \
+                patch("messaging.views.schedule_attachment_offload") as mock_offload:
+            response = await self.post("/messages/inbound/async/", self.inbound)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"detail": "Message already exists."})
+        mock_offload.assert_not_called()
+
+    async def test_async_inbound_errors_match_sync_view(self):
+        response = await self.post("/messages/inbound/async/", {"from": "+18045551234", "type": "sms"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"detail": "Missing 'from', 'to', or 'type'."})
+
+        response = await self.async_client.post("/messages/inbound/async/", "{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    async def test_async_views_reject_non_object_bodies(self):
+        for path in ("/messages/inbound/async/", "/messages/outbound/async/"):
+            for body in ([self.inbound], "sms", 1, None):
+                with self.subTest(path=path, body=body):
+                    response = await self.post(path, body)
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.json(), {"detail": "Expected a message object."})
+
+    async def test_async_inbound_reuses_participants_and_conversation(self):
+        await self.post("/messages/inbound/async/", self.inbound)
+        await self.post("/messages/inbound/async/", {**self.inbound, "messaging_provider_id": "async-2"})
+        self.assertEqual(await Participant.objects.acount(), 2)
+        self.assertEqual(await Conversation.objects.acount(), 1)
+
+    async def test_async_requests_are_instrumented(self):
+        metrics.clear()
+        await self.post("/messages/inbound/async/", self.inbound)
+        metrics.flush()
+        counts, _ = metrics.request_queries.collect()[("messages/inbound/async/", "POST")]
+        self.assertEqual(sum(counts), 1)
+        self.assertEqual(counts[0], 0, "queries run by the async ORM should be counted")
+
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    async def test_async_outbound_writes_message_and_outbox_entry(self, mock_delay):
+        data = {
+            "from": "+12016661234",
+            "to": "+18045551234",
+            "type": "sms",
+            "body": "Hello via ASGI",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        response = await self.post("/messages/outbound/async/", data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"status": "queued"})
+        entry = await OutboxMessage.objects.aget()
+        self.assertEqual(entry.provider_url, PROVIDER_URLS["sms"])
+        self.assertEqual(json.loads(entry.body)["body"], "Hello via ASGI")
+        mock_delay.assert_not_called()
+
+
+class RequestMetricsTests(ResolutionCacheMixin, FakeRedisMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+
+    def post_inbound(self, provider_id="metrics-1"):
+        data = {
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "sms",
+            "messaging_provider_id": provider_id,
+            "body": "Hello",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        return self.client.post("/messages/inbound/", data, format="json")
+
+    def test_metrics_endpoint_reports_per_route_histograms(self):
+        self.post_inbound()
+        body = self.client.get("/metrics/").content.decode()
+
+        self.assertIn('messaging_request_duration_seconds_count{endpoint="messages/inbound/",method="POST"} 1', body)
+        self.assertIn('messaging_phase_seconds_count{endpoint="messages/inbound/",phase="validation"} 1', body)
+        self.assertIn('messaging_resolution_cache_misses_total{cache="participants"}', body)
+
+    def test_query_count_matches_captured_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.post_inbound()
+        metrics.flush()
+        counts = metrics.request_queries.collect()[("messages/inbound/", "POST")][0]
+        bucket = metrics.QUERY_BUCKETS.index(min(b for b in metrics.QUERY_BUCKETS if b >= len(queries)))
+        self.assertEqual(counts[bucket], 1)
+
+    @override_settings(MESSAGING_SLOW_REQUEST_MS=1)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with patch("messaging.views.message_exists", side_effect=lambda *args: time.sleep(0.002)):
+            with self.assertLogs("messaging.slow_requests", level="WARNING") as logs:
+                self.post_inbound()
+        self.assertIn("Slow request POST /messages/inbound/", logs.output[0])
+        self.assertIn("INSERT", logs.output[0])
+        self.assertIn('"messaging_message"', logs.output[0])
+
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_relay_records_broker_publish_time(self, mock_delay):
+        data = {
+            "from": "+12016661234",
+            "to": "+18045551234",
+            "type": "sms",
+            "body": "Hello",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        self.client.post("/messages/outbound/", data, format="json")
+        relay_outbox_batch()
+        # The relay's process flushes; whichever process is scraped serves it.
+        metrics.flush()
+        metrics.clear()
+        body = self.client.get("/metrics/").content.decode()
+        self.assertIn('messaging_phase_seconds_count{endpoint="outbox_relay",phase="broker_publish"} 1', body)
+
+    def test_observations_from_every_process_add_up(self):
+        self.post_inbound("metrics-1")
+        metrics.flush()
+        # Another process observing the same route.
+        other = metrics.Histogram(metrics.request_duration.name, "", ("endpoint", "method"))
+        other.observe(0.2, "messages/inbound/", "POST")
+        pipe = self.redis.pipeline()
+        other.write(pipe, other.take())
+        pipe.execute()
+
+        self.post_inbound("metrics-2")
+        body = self.client.get("/metrics/").content.decode()
+        self.assertIn('messaging_request_duration_seconds_count{endpoint="messages/inbound/",method="POST"} 3', body)
+
+    def test_observations_wait_for_redis(self):
+        self.post_inbound()
+        self.redis_server.connected = False
+        with self.assertLogs("messaging.utils.metrics", "WARNING"):
+            response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        self.redis_server.connected = True
+        metrics.flush()
+        counts, _ = metrics.request_duration.collect()[("messages/inbound/", "POST")]
+        self.assertEqual(sum(counts), 1)
+
+    @override_settings(MESSAGING_METRICS_FLUSH_INTERVAL=0)
+    @patch("messaging.utils.metrics._next_flush", None)
+    @patch("messaging.utils.metrics.threading.Thread")
+    def test_flushes_happen_off_the_request_thread(self, mock_thread):
+        self.post_inbound()
+        mock_thread.assert_called_once_with(target=metrics.flush, name="metrics-flush", daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
+        self.assertEqual(self.redis.keys("messaging:metrics:*"), [])
+
+
+class OutboxRelayTests(ResolutionCacheMixin, APITestCase):
+
+    def post_outbound(self, count):
+        for i in range(count):
+            data = {
+                "from": "+12016661234",
+                "to": "+18045551234",
+                "type": "sms",
+                "body": f"Campaign message {i}",
+                "timestamp": "2024-11-01T14:00:00Z"
+            }
+            self.client.post("/messages/outbound/", data, format="json")
+
+    @patch("messaging.tasks.send_message_to_provider.delay", side_effect=ConnectionError("broker down"))
+    def test_broker_failure_does_not_lose_messages(self, mock_delay):
+        self.post_outbound(1)
+        with self.assertRaises(ConnectionError):
+            relay_outbox_batch()
+        self.assertEqual(OutboxMessage.objects.filter(dispatched_at__isnull=True).count(), 1)
+
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_message_and_outbox_commit_together(self, mock_delay):
+        with patch("messaging.views.OutboxMessage.objects.create", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.post_outbound(1)
+        self.assertEqual(Message.objects.count(), 0)
+
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_relay_drains_in_batches(self, mock_delay):
+        self.post_outbound(5)
+        self.assertEqual(relay_outbox_batch(batch_size=3), 3)
+        self.assertEqual(relay_outbox_batch(batch_size=3), 2)
+        self.assertEqual(relay_outbox_batch(batch_size=3), 0)
+        self.assertEqual(mock_delay.call_count, 5)
+        bodies = [json.loads(c.args[0])["body"] for c in mock_delay.call_args_list]
+        self.assertEqual(bodies, [f"Campaign message {i}" for i in range(5)])
+
+    @override_settings(OUTBOX_RETENTION_HOURS=0)
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_purge_removes_dispatched_rows(self, mock_delay):
+        self.post_outbound(2)
+        relay_outbox_batch(batch_size=1)
+        self.assertEqual(purge_dispatched_outbox(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+
+class AttachmentStoreTests(ResolutionCacheMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        override = override_settings(
+            MESSAGING_ATTACHMENT_ROOT=root.name,
+            MESSAGING_ATTACHMENT_BASE_URL="https://messaging.example.com",
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def upload(self, content, content_type="image/png"):
+        return self.client.generic("POST", "/attachments/", content, content_type=content_type)
+
+    def stored_files(self):
+        root = attachment_store.get_backend().root
+        return [name for _, _, names in os.walk(root) for name in names]
+
+    def test_identical_uploads_are_stored_once(self):
+        content = os.urandom(200 * 1024)
+        first = self.upload(content)
+        second = self.upload(content)
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.assertEqual(first.json()["id"], f"attachment:{sha256}")
+        self.assertEqual(second.json()["id"], first.json()["id"])
+        self.assertEqual(first.json()["size"], len(content))
+        self.assertEqual(Attachment.objects.count(), 1)
+        self.assertEqual(self.stored_files(), [sha256])
+
+    def test_download_streams_stored_bytes(self):
+        content = b"GIF89a" + os.urandom(1024)
+        sha256 = self.upload(content, content_type="image/gif").json()["sha256"]
+
+        response = self.client.get(f"/attachments/{sha256}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "image/gif")
+        self.assertEqual(response["Content-Disposition"], f'attachment; filename="{sha256}"')
+        self.assertEqual(response["X-Content-Type-Options"], "nosniff")
+        self.assertEqual(b"".join(response.streaming_content), content)
+        self.assertEqual(self.client.get(f"/attachments/{'0' * 64}/").status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(MESSAGING_ATTACHMENT_MAX_SIZE=1024)
+    def test_oversized_upload_is_rejected_without_leftovers(self):
+        response = self.upload(b"x" * 2048)
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(Attachment.objects.count(), 0)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_outbound_references_reach_provider_as_urls(self):
+        ref = self.upload(b"media").json()["id"]
+        data = {
+            "from": "+12016661234",
+            "to": "+18045551234",
+            "type": "mms",
+            "body": "See attached",
+            "attachments": [ref],
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        response = self.client.post("/messages/outbound/", data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(Message.objects.get().attachments, [ref])
+
+        body = json.loads(OutboxMessage.objects.get().body)
+        sha256 = ref.removeprefix("attachment:")
+        self.assertEqual(body["attachments"], [f"https://messaging.example.com/attachments/{sha256}/"])
+
+    def test_outbound_unknown_reference_is_rejected(self):
+        ref = "attachment:" + "a" * 64
+        data = {
+            "from": "+12016661234",
+            "to": "+18045551234",
+            "type": "mms",
+            "body": "See attached",
+            "attachments": [ref, "attachment:not-a-hash"],
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        response = self.client.post("/messages/outbound/", data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {"attachments": [
+            f"Unknown attachment '{ref}'.", "Unknown attachment 'attachment:not-a-hash'."
+        ]})
+        self.assertEqual(Message.objects.count(), 0)
+
+    @patch("messaging.utils.attachment_store.socket.getaddrinfo", return_value=[(2, 1, 6, "", ("93.184.216.34", 443))])
+    @patch("messaging.utils.attachment_store.requests.Session.get")
+    def test_inbound_remote_media_is_offloaded_in_background(self, mock_get, mock_getaddrinfo):
+        media = os.urandom(4096)
+        mock_get.return_value.is_redirect = False
+        mock_get.return_value.__enter__.return_value.raw.read1.side_effect = [media[:1000], media[1000:], b""]
+        mock_get.return_value.__enter__.return_value.headers = {"Content-Type": "image/jpeg"}
+        data = {
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "mms",
+            "messaging_provider_id": "mms-remote-1",
+            "body": "Photo",
+            "attachments": ["https://provider.example.com/media/1.jpg", "inline-note"],
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        response = self.client.post("/messages/inbound/", data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_get.assert_not_called()
+        self.assertEqual(
+            list(AttachmentOffload.objects.values_list("provider", "provider_message_id")),
+            [("sms_provider", "mms-remote-1")]
+        )
+
+        self.assertEqual(offload_attachment_batch(), 1)
+        sha256 = hashlib.sha256(media).hexdigest()
+        self.assertEqual(Message.objects.get().attachments, [f"attachment:{sha256}", "inline-note"])
+        self.assertEqual(Attachment.objects.get().content_type, "image/jpeg")
+        self.assertFalse(AttachmentOffload.objects.exists())
+
+    @patch("messaging.utils.attachment_store.requests.Session.get")
+    def test_internal_urls_are_never_fetched(self, mock_get):
+        addresses = {"media.provider.example": "93.184.216.34", "metadata.internal": "169.254.169.254"}
+        redirect = MagicMock(is_redirect=True, headers={"Location": "http://127.0.0.1:6379/"})
+        mock_get.return_value = redirect
+
+        def getaddrinfo(host, port, **kwargs):
+            return [(2, 1, 6, "", (addresses.get(host, host), port))]
+
+        with patch("messaging.utils.attachment_store.socket.getaddrinfo", side_effect=getaddrinfo), \
+                self.assertLogs("messaging.utils.attachment_store", "WARNING"):
+            for url in (
+                "http://127.0.0.1:8000/admin/",
+                "http://[::ffff:10.0.0.1]/",
+                "http://metadata.internal/latest/meta-data/",
+                "file:///etc/passwd",
+            ):
+                self.assertEqual(attachment_store.offload(url), url)
+            mock_get.assert_not_called()
+
+            # A public host may not redirect to an internal one.
+            url = "https://media.provider.example/1.jpg"
+            self.assertEqual(attachment_store.offload(url), url)
+            mock_get.assert_called_once()
+            self.assertFalse(mock_get.call_args.kwargs["allow_redirects"])
+
+            with override_settings(MESSAGING_ATTACHMENT_OFFLOAD_HOSTS=["provider.example"]):
+                attachment_store.check_offload_url("https://media.provider.example/1.jpg")
+                with self.assertRaises(attachment_store.UnsafeURL):
+                    attachment_store.check_offload_url("https://evil.example/1.jpg")
+
+    def test_fetch_connects_to_the_checked_address(self):
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append((self.path, self.headers["Host"]))
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        port = server.server_address[1]
+
+        # The hostname doesn't resolve; only the pinned address is used.
+        adapter = attachment_store.PinnedAdapter()
+        adapter.addresses["media.provider.invalid"] = "127.0.0.1"
+        with requests.Session() as session:
+            session.mount("http://", adapter)
+            response = session.get(f"http://media.provider.invalid:{port}/1.jpg", timeout=5)
+            self.assertEqual(response.content, b"ok")
+            with self.assertRaises(attachment_store.UnsafeURL):
+                session.get(f"http://other.provider.invalid:{port}/1.jpg", timeout=5)
+        self.assertEqual(requests_seen, [("/1.jpg", f"media.provider.invalid:{port}")])
+
+    @override_settings(MESSAGING_ATTACHMENT_OFFLOAD_TIMEOUT=10)
+    @patch("messaging.utils.attachment_store.socket.getaddrinfo", return_value=[(2, 1, 6, "", ("93.184.216.34", 443))])
+    @patch("messaging.utils.attachment_store.requests.Session.get")
+    def test_slow_downloads_are_cut_off(self, mock_get, mock_getaddrinfo):
+        clock = [0]
+
+        def drip(size, decode_content):
+            clock[0] += 4
+            return b"x"
+
+        mock_get.return_value.is_redirect = False
+        mock_get.return_value.__enter__.return_value.raw.read1.side_effect = drip
+        url = "https://media.provider.example/slow.jpg"
+        with patch("messaging.utils.attachment_store.time.monotonic", side_effect=lambda: clock[0]), \
+                self.assertLogs("messaging.utils.attachment_store", "WARNING"):
+            self.assertEqual(attachment_store.offload(url), url)
+        self.assertEqual(clock[0], 12)
+        self.assertEqual(Attachment.objects.count(), 0)
+        self.assertEqual(self.stored_files(), [])
+
+
+class ConversationSummaryTests(ResolutionCacheMixin, APITestCase):
+
+    def inbound(self, sender, provider_message_id, timestamp, body="Hi", to="+12016661234"):
+        return {
+            "from": sender,
+            "to": to,
+            "type": "sms",
+            "messaging_provider_id": provider_message_id,
+            "body": body,
+            "timestamp": timestamp,
+        }
+
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_every_write_path_updates_the_summary(self, mock_delay):
+        contact = "+18045551234"
+        self.client.post("/messages/inbound/", self.inbound(contact, "s-1", "2024-11-01T14:00:00Z"), format="json")
+        self.client.post("/messages/inbound/batch/", [
+            self.inbound(contact, "s-2", "2024-11-01T14:05:00Z", body="<p>Latest  <b>news</b></p>\n"),
+            self.inbound(contact, "s-3", "2024-11-01T14:01:00Z"),
+        ], format="json")
+        # A late webhook for an older message only bumps the count.
+        self.client.post("/messages/inbound/", self.inbound(contact, "s-4", "2024-11-01T13:00:00Z"), format="json")
+        self.client.post("/messages/outbound/", {
+            "from": "+12016661234", "to": contact, "type": "sms", "body": "x" * 300,
+            "timestamp": "2024-11-01T13:30:00Z",
+        }, format="json")
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.message_count, 5)
+        self.assertEqual(conversation.last_message_at, parse_datetime("2024-11-01T14:05:00Z"))
+        self.assertEqual(conversation.last_message_preview, "Latest news")
+        self.assertEqual(make_preview("x" * 300), "x" * 139 + "…")
+
+    def test_inbox_lists_recent_conversations_across_both_sides(self):
+        business = "+12016661234"
+        contacts = [f"+1804555{i:04d}" for i in range(7)]
+        for i, contact in enumerate(contacts):
+            # The business ends up as participant_1 for some pairs and
+            # participant_2 for others.
+            sender, to = (business, contact) if i % 2 else (contact, business)
+            timestamp = f"2024-11-01T14:{(i * 7) % 10:02d}:00Z"
+            self.client.post("/messages/inbound/", self.inbound(sender, f"i-{i}", timestamp, to=to), format="json")
+        expected = list(
+            Conversation.objects.order_by('-last_message_at', '-id').values_list('id', flat=True)
+        )
+
+        url = f"/conversations/inbox/?participant={business}&page_size=3"
+        seen = []
+        while url:
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(conversation["id"] for conversation in response.data["results"])
+            url = response.data["next"]
+        self.assertEqual(seen, expected)
+
+        first = self.client.get("/conversations/inbox/", {"participant": "(201) 666-1234"}).data["results"][0]
+        self.assertEqual(first["message_count"], 1)
+        self.assertEqual(first["last_message_preview"], "Hi")
+        self.assertEqual(self.client.get("/conversations/inbox/").status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rebuild_command_recomputes_summaries(self):
+        for i in range(3):
+            self.client.post(
+                "/messages/inbound/", self.inbound("+18045551234", f"r-{i}", f"2024-11-01T14:0{i}:00Z"), format="json"
+            )
+        Conversation.objects.update(message_count=0, last_message_at=None, last_message_preview="")
+
+        stdout = StringIO()
+        call_command("rebuild_conversation_summaries", "--batch-size", "1", stdout=stdout)
+        self.assertIn("Rebuilt 1 conversation summaries.", stdout.getvalue())
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.message_count, 3)
+        self.assertEqual(conversation.last_message_at, parse_datetime("2024-11-01T14:02:00Z"))
+        self.assertEqual(conversation.last_message_preview, "Hi")
+
+
+class ConversationHistoryTests(ResolutionCacheMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        alice = Participant.objects.create(phone="+18045551234", address_key="+18045551234")
+        bob = Participant.objects.create(phone="+12016661234", address_key="+12016661234")
+        carol = Participant.objects.create(email="carol@example.com", address_key="carol@example.com")
+        self.conversation = Conversation.objects.create(participant_1=alice, participant_2=bob)
+        Conversation.objects.create(participant_1=bob, participant_2=carol)
+        # Several messages share a timestamp so paging has to break ties on id.
+        self.messages = Message.objects.bulk_create([
+            Message(
+                conversation=self.conversation,
+                sender=alice if i % 2 else bob,
+                receiver=bob if i % 2 else alice,
+                type="sms",
+                body=f"Message {i}",
+                timestamp=parse_datetime(f"2024-11-01T14:00:0{i // 2}Z"),
+                provider="sms_provider",
+                provider_message_id=f"history-{i}",
+            )
+            for i in range(7)
+        ])
+
+    def test_message_pages_follow_cursor(self):
+        url = f"/conversations/{self.conversation.id}/messages/?page_size=3"
+        seen = []
+        while url:
+            # The conversation, then one page from each message tier.
+            with self.assertNumQueries(3):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(message["id"] for message in response.data["results"])
+            url = response.data["next"]
+        self.assertEqual(seen, [message.id for message in self.messages])
+
+    def test_messages_include_participant_addresses(self):
+        response = self.client.get(f"/conversations/{self.conversation.id}/messages/")
+        first = response.data["results"][0]
+        self.assertEqual(first["sender"], "+12016661234")
+        self.assertEqual(first["receiver"], "+18045551234")
+        self.assertIsNone(response.data["next"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(f"/conversations/{self.conversation.id}/messages/?cursor=bogus")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_tampered_cursor(self):
+        def cursor(position):
+            return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+        for position in (["garbage", 1], [{"a": 1}, 1], [None, None], ["2024-01-01T00:00:00Z", 2 ** 70]):
+            with self.subTest(position=position):
+                response = self.client.get(
+                    f"/conversations/{self.conversation.id}/messages/", {"cursor": cursor(position)}
+                )
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        for position in (["x"], [None]):
+            with self.subTest(position=position):
+                response = self.client.get("/conversations/", {"cursor": cursor(position)})
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unknown_conversation(self):
+        response = self.client.get("/conversations/999/messages/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_conversation_list_filters_by_participant(self):
+        response = self.client.get("/conversations/", {"participant": "+18045551234"})
+        self.assertEqual([c["id"] for c in response.data["results"]], [self.conversation.id])
+
+        response = self.client.get("/conversations/")
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def test_conversation_detail(self):
+        response = self.client.get(f"/conversations/{self.conversation.id}/")
+        self.assertEqual(response.data["participant_1"], "+18045551234")
+        self.assertNotIn("messages", response.data)
+
+
+@override_settings(MESSAGING_ARCHIVE_AFTER_DAYS=30, MESSAGING_RETENTION_DAYS=365, MESSAGING_ARCHIVE_BATCH_SIZE=2)
+class MessageArchiveTests(ResolutionCacheMixin, APITestCase):
 
     def setUp(self):
+        super().setUp()
+        self.now = parse_datetime("2024-11-01T12:00:00Z")
+        for i, timestamp in enumerate([
+            "2023-06-01T12:00:00Z", "2023-06-01T12:00:00Z", "2024-08-01T12:00:00Z",
+            "2024-09-01T12:00:00Z", "2024-10-30T12:00:00Z",
+        ]):
+            self.client.post("/messages/inbound/", {
+                "from": "+18045551234", "to": "+12016661234", "type": "sms",
+                "messaging_provider_id": f"a-{i}", "body": f"Message {i}", "timestamp": timestamp,
+            }, format="json")
+        self.conversation = Conversation.objects.get()
+
+    def archive(self):
+        with patch("messaging.utils.message_archive.timezone.now", return_value=self.now):
+            return archive_messages()
+
+    def test_history_spans_hot_and_archived_messages(self):
+        expected = list(Message.objects.order_by('timestamp', 'id').values_list('id', flat=True))
+        pending = Message.objects.get(provider_message_id="a-2")
+        OutboxMessage.objects.create(message=pending, provider_url="http://provider", body=b"{}")
+
+        self.assertEqual(self.archive(), {"archived": 3, "purged": 2})
+        self.assertEqual(
+            list(Message.objects.values_list('provider_message_id', flat=True).order_by('id')), ["a-2", "a-4"]
+        )
+        self.assertEqual(list(ArchivedMessage.objects.values_list('provider_message_id', flat=True)), ["a-3"])
+
+        url = f"/conversations/{self.conversation.id}/messages/?page_size=1"
+        seen = []
+        while url:
+            response = self.client.get(url)
+            seen.extend(message["id"] for message in response.data["results"])
+            url = response.data["next"]
+        self.assertEqual(seen, expected[2:])
+        self.assertEqual(response.data["results"][0]["sender"], "+18045551234")
+
+    def test_summaries_count_both_tiers(self):
+        self.archive()
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.message_count, 3)
+        self.assertEqual(conversation.last_message_preview, "Message 4")
+
+        Conversation.objects.update(message_count=0, last_message_at=None, last_message_preview="")
+        call_command("rebuild_conversation_summaries", stdout=StringIO())
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.message_count, 3)
+        self.assertEqual(conversation.last_message_at, parse_datetime("2024-10-30T12:00:00Z"))
+
+    def test_outbound_messages_wait_for_a_final_status(self):
+        old = self.now - timedelta(days=60)
+        outbound = {}
+        for status_, updated_at in (("queued", old), ("sent", self.now), ("sent", old), ("delivered", self.now)):
+            message = Message.objects.create(
+                conversation=self.conversation, sender_id=self.conversation.participant_1_id,
+                receiver_id=self.conversation.participant_2_id, type="sms", body="Out",
+                timestamp=parse_datetime("2024-08-15T12:00:00Z"), provider="provider",
+                provider_message_id=f"out-{len(outbound)}", status=status_, status_updated_at=updated_at,
+            )
+            DeliveryAttempt.objects.create(message=message, error="", created_at=old)
+            outbound[message.provider_message_id] = message.id
+
+        self.archive()
+        self.assertEqual(
+            set(Message.objects.filter(provider="provider").values_list('provider_message_id', flat=True)),
+            {"out-0", "out-1"}
+        )
+        archived = ArchivedMessage.objects.get(provider_message_id="out-3")
+        self.assertEqual(archived.delivery_attempts.count(), 1)
+        self.assertEqual(DeliveryAttempt.objects.count(), 2)
+
+    def test_webhook_retries_for_archived_messages_are_duplicates(self):
+        self.archive()
+        retry = {
+            "from": "+18045551234", "to": "+12016661234", "type": "sms",
+            "messaging_provider_id": "a-3", "body": "Message 3", "timestamp": "2024-09-01T12:00:00Z",
+        }
+        response = self.client.post("/messages/inbound/", retry, format="json")
+        self.assertEqual(response.data, {"detail": "Message already exists."})
+        response = self.client.post("/messages/inbound/batch/", [retry], format="json")
+        self.assertEqual(response.data["results"][0]["status"], "duplicate")
+        self.assertFalse(Message.objects.filter(provider_message_id="a-3").exists())
+
+    def test_purging_every_message_clears_the_preview(self):
+        Message.objects.exclude(provider_message_id__in=["a-0", "a-1"]).delete()
+        rebuild_summaries([self.conversation.id])
+        self.archive()
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.message_count, 0)
+        self.assertIsNone(conversation.last_message_at)
+        self.assertEqual(conversation.last_message_preview, "")
+
+
+class MessageSearchTests(ResolutionCacheMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.post("/messages/inbound/", {
+            "from": "user@usehatchapp.com", "to": "contact@gmail.com", "type": "email", "xillio_id": "s-1",
+            "body": "<html><body><div class=\"invoice\">Your refund &amp; receipt</div></body></html>",
+            "timestamp": "2024-11-01T14:00:00Z",
+        }, format="json")
+        self.client.post("/messages/inbound/batch/", [
+            {
+                "from": "+18045551234", "to": "+12016661234", "type": "sms", "messaging_provider_id": f"s-{i}",
+                "body": body, "timestamp": f"2024-11-0{i}T14:00:00Z",
+            }
+            for i, body in ((2, "Where is my refund?"), (3, "Refund sent, thanks"), (4, "See you tomorrow"))
+        ], format="json")
+
+    def search(self, **params):
+        response = self.client.get("/messages/search/", params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [message["provider_message_id"] for message in response.data["results"]]
+
+    def test_search_matches_every_word_newest_first(self):
+        self.assertEqual(self.search(q="REFUND"), ["s-3", "s-2", "s-1"])
+        self.assertEqual(self.search(q="refund receipt"), ["s-1"])
+        # Markup is stripped from emails before indexing.
+        self.assertEqual(self.search(q="invoice"), [])
+        self.assertEqual(self.search(q='refund" OR (tomorrow'), [])
+
+    def test_search_filters(self):
+        conversation_id = Message.objects.get(provider_message_id="s-2").conversation_id
+        self.assertEqual(self.search(q="refund", conversation=conversation_id), ["s-3", "s-2"])
+        self.assertEqual(self.search(q="refund", participant="(201) 666-1234"), ["s-3", "s-2"])
+        self.assertEqual(self.search(q="refund", participant="nobody@example.com"), [])
+        self.assertEqual(self.search(q="refund", type="email"), ["s-1"])
+        self.assertEqual(
+            self.search(q="refund", after="2024-11-02T00:00:00Z", before="2024-11-03T00:00:00Z"), ["s-2"]
+        )
+        for params in (
+            {}, {"q": "refund", "type": "fax"}, {"q": "refund", "after": "yesterday"},
+            {"q": "refund", "conversation": "abc"}, {"q": "refund", "conversation": str(2 ** 70)},
+            {"q": "refund", "conversation": "-1"},
+        ):
+            response = self.client.get("/messages/search/", params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(MESSAGING_ARCHIVE_AFTER_DAYS=30, MESSAGING_RETENTION_DAYS=0, MESSAGING_ARCHIVE_BATCH_SIZE=10)
+    def test_search_spans_archive_and_forgets_purged_messages(self):
+        with patch("messaging.utils.message_archive.timezone.now", return_value=parse_datetime("2024-12-04T00:00:00Z")):
+            archive_messages()
+        self.assertEqual(ArchivedMessage.objects.count(), 3)
+        self.assertEqual(self.search(q="refund", page_size=1), ["s-3"])
+        self.assertEqual(self.search(q="refund"), ["s-3", "s-2", "s-1"])
+
+        with override_settings(MESSAGING_RETENTION_DAYS=31), \
+                patch("messaging.utils.message_archive.timezone.now", return_value=parse_datetime("2024-12-04T00:00:00Z")):
+            archive_messages()
+        self.assertEqual(self.search(q="refund"), ["s-3"])
+
+        stdout = StringIO()
+        call_command("rebuild_search_index", stdout=stdout)
+        self.assertIn("Indexed 2 messages.", stdout.getvalue())
+        self.assertEqual(self.search(q="tomorrow"), ["s-4"])
+
+
+class RealtimeTests(ResolutionCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.redis_server = fakeredis.FakeServer()
+        patcher = patch("messaging.realtime._publisher", fakeredis.FakeRedis(server=self.redis_server))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_inserts_and_statuses_publish_after_commit(self):
+        pubsub = fakeredis.FakeRedis(server=self.redis_server).pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe("messaging:events:*")
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post("/messages/inbound/", {
+                "from": "+18045551234", "to": "+12016661234", "type": "sms",
+                "messaging_provider_id": "rt-1", "body": "Live", "timestamp": "2024-11-01T14:00:00Z",
+            }, format="json")
+        # Nothing is published before the transaction commits.
+        self.assertIsNone(pubsub.get_message())
+        for callback in callbacks:
+            callback()
+        realtime._events.join()
+
+        message = Message.objects.get()
+        published = {}
+        while (event := pubsub.get_message()) is not None:
+            published[event["channel"].decode()] = json.loads(event["data"])
+        self.assertEqual(set(published), {
+            f"messaging:events:conversation:{message.conversation_id}",
+            f"messaging:events:participant:{message.sender_id}",
+            f"messaging:events:participant:{message.receiver_id}",
+        })
+        event = published[f"messaging:events:participant:{message.receiver_id}"]
+        self.assertEqual(event["event"], "message.created")
+        self.assertEqual(event["message"]["body"], "Live")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            realtime.publish_status([message.id], "sent")
+        realtime._events.join()
+        event = json.loads(pubsub.get_message()["data"])
+        self.assertEqual(event, {
+            "event": "message.status",
+            "message": {"id": message.id, "conversation": message.conversation_id, "status": "sent"},
+        })
+
+    def test_redis_outage_is_handled_off_the_request_thread(self):
+        self.addCleanup(setattr, realtime._events, "retry_at", 0.0)
+        self.redis_server.connected = False
+        event = (1, {1, 2}, {"event": "message.status", "message": {"id": 1, "conversation": 1}})
+        with self.assertLogs("messaging.realtime", "WARNING") as logs:
+            for _ in range(3):
+                realtime._publish([event])
+                realtime._events.join()
+        # One failed attempt, then events are dropped without trying Redis.
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].threadName, "realtime-publisher")
+
+        self.redis_server.connected = True
+        realtime._events.retry_at = 0.0
+        pubsub = fakeredis.FakeRedis(server=self.redis_server).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe("messaging:events:conversation:1")
+        self.assertIsNone(pubsub.get_message())
+        realtime._publish([event])
+        realtime._events.join()
+        self.assertEqual(json.loads(pubsub.get_message()["data"]), event[2])
+
+    async def connect(self, query_string):
+        receive, sent = asyncio.Queue(), asyncio.Queue()
+        await receive.put({"type": "websocket.connect"})
+        scope = {"type": "websocket", "path": "/ws/events/", "query_string": query_string}
+        app = asyncio.create_task(realtime.websocket_application(scope, receive.get, sent.put))
+        return app, receive, sent
+
+    async def test_websocket_subscribers_receive_each_event_once(self):
+        hub = realtime.Hub(fakeredis.FakeAsyncRedis(server=self.redis_server))
+        alice = await Participant.objects.acreate(phone="+18045551234", address_key="+18045551234")
+        bob = await Participant.objects.acreate(phone="+12016661234", address_key="+12016661234")
+        conversation = await Conversation.objects.acreate(participant_1=alice, participant_2=bob)
+
+        with patch("messaging.realtime._hub", hub):
+            app, receive, sent = await self.connect(
+                f"participant=%2B12016661234&conversation={conversation.id}".encode()
+            )
+            self.assertEqual(await asyncio.wait_for(sent.get(), 5), {"type": "websocket.accept"})
+
+            event = {"event": "message.status", "message": {"id": 1, "conversation": conversation.id}}
+            realtime._publish([(conversation.id, {alice.id, bob.id}, event)])
+            received = await asyncio.wait_for(sent.get(), 5)
+            self.assertEqual(json.loads(received["text"]), event)
+
+            await receive.put({"type": "websocket.disconnect"})
+            await asyncio.wait_for(app, 5)
+            self.assertTrue(sent.empty())
+            self.assertEqual(dict(hub.subscribers), {})
+            hub.reader.cancel()
+
+    async def test_websocket_rejects_bad_subscriptions(self):
+        for query_string, code in (
+            (b"", 4400), (b"participant=555-1234", 4400), (b"conversation=999", 4404),
+            (b"participant=%2B18045559999", 4404),
+        ):
+            app, _, sent = await self.connect(query_string)
+            await app
+            self.assertEqual((await sent.get())["code"], code)
+        # Connecting never creates participants.
+        self.assertFalse(await Participant.objects.aexists())
+
+    def test_slow_subscriber_is_cut_off(self):
+        subscriber = realtime.Subscriber(queue_size=2)
+        for data in ("a", "b", "c", "d"):
+            subscriber.put(data)
+        self.assertTrue(subscriber.overflowed)
+        self.assertEqual([subscriber.queue.get_nowait() for _ in range(3)], ["a", "b", None])
+
+
+class DeliveryStatusTests(ResolutionCacheMixin, FakeRedisMixin, APITestCase):
+
+    def send_outbound(self):
+        self.client.post("/messages/outbound/", {
+            "from": "+12016661234", "to": "+18045551234", "type": "sms",
+            "body": "Status?", "attachments": [], "timestamp": "2024-11-01T14:00:00Z",
+        }, format="json")
+        return Message.objects.get()
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_attempts_move_message_from_queued_to_sent(self, mock_post):
+        message = self.send_outbound()
+        self.assertEqual(message.status, "queued")
+
+        mock_post.return_value = MagicMock(status_code=500)
+        with patch.object(send_message_to_provider, "retry", side_effect=Retry()):
+            send_message_to_provider.apply(args=(b'{"body":"Hi"}', PROVIDER_URLS['sms'], message.id))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempt_count), ("queued", 1))
+
+        mock_post.return_value = MagicMock(status_code=200)
+        send_message_to_provider.apply(args=(b'{"body":"Hi"}', PROVIDER_URLS['sms'], message.id))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempt_count), ("sent", 2))
+        self.assertEqual(
+            [attempt.error != "" for attempt in message.delivery_attempts.order_by('id')], [True, False]
+        )
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_final_failure_marks_message_failed(self, mock_post):
+        message = self.send_outbound()
+        mock_post.return_value = MagicMock(status_code=500)
+        with patch.object(send_message_to_provider, "retry", side_effect=Retry()):
+            send_message_to_provider.apply(
+                args=(b'{"body":"Hi"}', PROVIDER_URLS['sms'], message.id), retries=5
+            )
+        message.refresh_from_db()
+        self.assertEqual(message.status, "failed")
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_receipts_only_move_status_forward(self, mock_post):
+        message = self.send_outbound()
+        outbox = OutboxMessage.objects.get(message=message)
+        mock_post.return_value = MagicMock(status_code=200)
+        send_message_to_provider.apply(args=(bytes(outbox.body), outbox.provider_url, message.id))
+        # The provider echoes the id from the body it was sent.
+        echoed_id = json.loads(mock_post.call_args.args[1])["provider_message_id"]
+
+        receipt = {"messaging_provider_id": echoed_id, "status": "delivered"}
+        response = self.client.post("/messages/receipts/", receipt, format="json")
+        self.assertEqual(response.json(), {"updated": 1, "stale": 0, "unknown": 0})
+
+        response = self.client.post("/messages/receipts/", [
+            {"messaging_provider_id": echoed_id, "status": "sent"},
+            {"messaging_provider_id": "no-such-message", "status": "failed"},
+        ], format="json")
+        self.assertEqual(response.json(), {"updated": 0, "stale": 1, "unknown": 1, "errors": []})
+        message.refresh_from_db()
+        self.assertEqual(message.status, "delivered")
+
+        response = self.client.post(
+            "/messages/receipts/", {"messaging_provider_id": "x", "status": "read"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_malformed_receipts_are_skipped_and_reported(self):
+        message = self.send_outbound()
+        response = self.client.post("/messages/receipts/", [
+            {"messaging_provider_id": "x", "status": "read"},
+            {"messaging_provider_id": message.provider_message_id, "status": "delivered"},
+            "not a receipt",
+        ], format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {
+            "updated": 1, "stale": 0, "unknown": 0,
+            "errors": [
+                {"index": 0, "status": "error", "detail": "Unknown delivery status 'read'."},
+                {"index": 2, "status": "error", "detail": "Expected a receipt object."},
+            ],
+        })
+        message.refresh_from_db()
+        self.assertEqual(message.status, "delivered")
+
+
+class BuildValidatedMessageDataTests(ResolutionCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
         self.timestamp = "2024-11-01T14:00:00Z"
 
     def test_valid_sms(self):
@@ -200,3 +1387,874 @@ class BuildValidatedMessageDataTests(TestCase):
         }
         with self.assertRaisesMessage(ValueError, "Missing 'type' and unable to infer message type."):
             build_validated_message_data(data, require_type=False)
+
+
+class MessageValidationTests(ResolutionCacheMixin, APITestCase):
+    """The fast path must answer exactly as the ModelSerializer it replaced."""
+
+    class ReferenceSerializer(serializers.ModelSerializer):
+        class Meta:
+            model = Message
+            fields = '__all__'
+            validators = []
+
+    def enriched(self, **overrides):
+        data, _, _ = build_validated_message_data({
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "sms",
+            "messaging_provider_id": "validation-1",
+            "body": "Hello",
+            "attachments": ["https://example.com/a.png"],
+            "timestamp": "2024-11-01T14:00:00Z",
+        })
+        data.update(overrides)
+        for key, value in list(data.items()):
+            if value is DELETE:
+                del data[key]
+        return data
+
+    def test_errors_match_model_serializer(self):
+        cases = [
+            {"body": DELETE},
+            {"body": None},
+            {"body": "   "},
+            {"body": {"nested": True}},
+            {"timestamp": None},
+            {"timestamp": DELETE, "body": ""},
+            {"provider_message_id": "x" * 256},
+        ]
+        for overrides in cases:
+            with self.subTest(overrides=overrides):
+                data = self.enriched(**overrides)
+                reference = self.ReferenceSerializer(data=data)
+                self.assertFalse(reference.is_valid())
+                message, errors = build_message(data)
+                self.assertIsNone(message)
+                self.assertEqual(errors, reference.errors)
+
+    def test_cleaned_values_match_model_serializer(self):
+        data = self.enriched(body="  padded  ", provider_message_id=12345, attachments=DELETE)
+        reference = self.ReferenceSerializer(data=data)
+        self.assertTrue(reference.is_valid())
+        message, errors = build_message(data)
+        self.assertIsNone(errors)
+        for field in ("body", "timestamp", "provider_message_id", "type", "provider"):
+            self.assertEqual(getattr(message, field), reference.validated_data[field], field)
+        self.assertIsNone(message.attachments)
+        self.assertEqual(message.sender_id, reference.validated_data["sender"].id)
+
+    def test_invalid_payload_returns_400_with_field_errors(self):
+        data = {
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "sms",
+            "messaging_provider_id": "validation-2",
+            "body": "",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        response = self.client.post("/messages/inbound/", data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {"body": ["This field may not be blank."]})
+
+    def test_inbound_skips_foreign_key_lookups(self):
+        data = {
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "sms",
+            "body": "Warm cache",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/messages/inbound/", {**data, "messaging_provider_id": "warm-1"}, format="json")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/messages/inbound/", {**data, "messaging_provider_id": "warm-2"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # The duplicate check, the insert, the conversation summary update
+        # and the search index insert; no participant or conversation reads.
+        statements = [q["sql"] for q in queries if "SAVEPOINT" not in q["sql"]]
+        self.assertEqual(len(statements), 4, statements)
+        self.assertFalse([sql for sql in statements if sql.startswith("SELECT") and "messaging_message" not in sql])
+
+
+class AddressNormalizationTests(ResolutionCacheMixin, APITestCase):
+
+    def post_inbound(self, sender, provider_message_id, **extra):
+        data = {
+            "from": sender,
+            "to": "Support@UseHatchApp.com" if "@" in sender else "+12016661234",
+            "type": "email" if "@" in sender else "sms",
+            "messaging_provider_id": provider_message_id,
+            "body": "Hello",
+            "timestamp": "2024-11-01T14:00:00Z",
+            **extra
+        }
+        return self.client.post("/messages/inbound/", data, format="json")
+
+    def test_address_variants_normalize_to_one_key(self):
+        for phone in ("+1 (804) 555-1234", "18045551234", "804.555.1234", "+18045551234", "0018045551234"):
+            self.assertEqual(normalize_address(phone), "+18045551234")
+        self.assertEqual(normalize_address("  Alice@Example.COM "), "alice@example.com")
+        self.assertEqual(normalize_address("+44 20 7946 0958"), "+442079460958")
+        # International numbers sent without the "+" keep their country code.
+        self.assertEqual(normalize_address("447911123456"), "+447911123456")
+        self.assertEqual(normalize_address("00447911123456"), "+447911123456")
+        # Short codes have no country and are their own keys.
+        for short_code in ("12345", "262966", "262-966"):
+            self.assertEqual(normalize_address(short_code), short_code.replace("-", ""))
+        for invalid in ("555-1234", "+12345", "+1 804 CALL NOW", "not-an-email@", 12345):
+            with self.assertRaises(ValueError):
+                normalize_address(invalid)
+
+    def test_formatting_variants_share_participant_and_conversation(self):
+        for index, sender in enumerate(("+1 (804) 555-1234", "18045551234", "+18045551234")):
+            self.assertEqual(self.post_inbound(sender, f"variant-{index}").status_code, status.HTTP_201_CREATED)
+        self.post_inbound("Alice@Example.com", "email-1", xillio_id="email-1")
+        self.post_inbound("alice@example.com", "email-2", xillio_id="email-2")
+
+        self.assertEqual(
+            set(Participant.objects.values_list("address_key", flat=True)),
+            {"+18045551234", "+12016661234", "alice@example.com", "support@usehatchapp.com"}
+        )
+        self.assertEqual(Conversation.objects.count(), 2)
+        response = self.client.get("/conversations/", {"participant": "(804) 555-1234"})
+        self.assertEqual(len(response.data["results"]), 1)
+
+    def test_unparseable_address_is_rejected(self):
+        response = self.post_inbound("555-1234", "bad-address")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["detail"], "Phone number '555-1234' has no country code.")
+
+        batch = [{"from": "555-1234", "to": "+12016661234", "type": "sms", "body": "Hi"}]
+        response = self.client.post("/messages/inbound/batch/", batch, format="json")
+        self.assertEqual(response.data["results"][0]["status"], "error")
+        self.assertEqual(Participant.objects.count(), 0)
+
+    def test_short_code_is_its_own_participant(self):
+        for index in range(2):
+            self.assertEqual(self.post_inbound("262966", f"short-{index}").status_code, status.HTTP_201_CREATED)
+        participant = Participant.objects.get(address_key="262966")
+        self.assertEqual(participant.phone, "262966")
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_normalize_participants_merges_legacy_rows(self):
+        keyed = Participant.objects.create(phone="+18045551234", address_key="+18045551234")
+        legacy = [Participant.objects.create(phone=phone) for phone in ("+1 (804) 555-1234", "18045551234")]
+        other = Participant.objects.create(phone="2016661234")
+        invalid = Participant.objects.create(phone="555-1234")
+        for index, participant in enumerate([keyed, *legacy]):
+            low, high = sorted([participant, other], key=lambda p: p.id)
+            conversation = Conversation.objects.create(participant_1=low, participant_2=high)
+            Message.objects.create(
+                conversation=conversation, sender=participant, receiver=other, type="sms", body="Hi",
+                timestamp=parse_datetime("2024-11-01T14:00:00Z"), provider="sms_provider",
+                provider_message_id=f"legacy-{index}"
+            )
+
+        stdout = StringIO()
+        call_command("normalize_participants", "--dry-run", stdout=stdout)
+        self.assertIn("Would normalize 1 participants, merging 2 duplicates; 1 addresses", stdout.getvalue())
+        self.assertEqual(Participant.objects.count(), 5)
+
+        with self.assertLogs("messaging.utils.participant_merge", level="WARNING"):
+            call_command("normalize_participants", stdout=StringIO())
+        self.assertEqual(
+            set(Participant.objects.values_list("id", "address_key")),
+            {(keyed.id, "+18045551234"), (other.id, "+12016661234"), (invalid.id, None)}
+        )
+        self.assertEqual(Conversation.objects.count(), 1)
+        conversation = Conversation.objects.get()
+        self.assertEqual(Message.objects.filter(conversation=conversation, sender=keyed).count(), 3)
+
+
+    def test_address_key_migration_backfills_and_merges(self):
+        from django.apps import apps
+        backfill = import_module("messaging.migrations.0010_participant_address_key").backfill_address_keys
+
+        legacy = [Participant.objects.create(phone=phone) for phone in ("+1 (804) 555-1234", "18045551234")]
+        other = Participant.objects.create(email="Alice@Example.com")
+        invalid = Participant.objects.create(phone="555-1234")
+        for index, participant in enumerate(legacy):
+            low, high = sorted([participant, other], key=lambda p: p.id)
+            conversation = Conversation.objects.create(participant_1=low, participant_2=high)
+            Message.objects.create(
+                conversation=conversation, sender=participant, receiver=other, type="sms", body="Hi",
+                timestamp=parse_datetime("2024-11-01T14:00:00Z"), provider="sms_provider",
+                provider_message_id=f"legacy-{index}"
+            )
+
+        backfill(apps, None)
+
+        self.assertEqual(
+            set(Participant.objects.values_list("id", "address_key")),
+            {(legacy[0].id, "+18045551234"), (other.id, "alice@example.com"), (invalid.id, None)}
+        )
+        conversation = Conversation.objects.get()
+        self.assertEqual(Message.objects.filter(conversation=conversation, sender=legacy[0]).count(), 2)
+
+
+class ConcurrentResolutionTests(ResolutionCacheMixin, APITransactionTestCase):
+    """Many threads ingesting messages between the same new addresses at once."""
+
+    threads = 16
+    rounds = 5
+    addresses = ["+18045550001", "+18045550002", "+18045550003", "racer@example.com"]
+
+    def setUp(self):
+        super().setUp()
+        # Bypass the resolution caches so every request races on the upsert.
+        for cache in (message_helpers.participant_cache, message_helpers.conversation_cache):
+            patcher = patch.object(cache, "get", return_value=None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def payload(self, thread, round_, index):
+        return {
+            "from": self.addresses[index % len(self.addresses)],
+            "to": self.addresses[(index + 1) % len(self.addresses)],
+            "type": "sms",
+            "messaging_provider_id": f"race-{thread}-{round_}-{index}",
+            "body": "Race",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+
+    def test_concurrent_ingest_creates_no_duplicates(self):
+        barrier = threading.Barrier(self.threads)
+
+        def ingest(thread):
+            client = APIClient()
+            statuses = []
+            try:
+                for round_ in range(self.rounds):
+                    barrier.wait()
+                    if thread % 2:
+                        response = client.post("/messages/inbound/", self.payload(thread, round_, thread), format="json")
+                        statuses.append(response.status_code)
+                    else:
+                        items = [self.payload(thread, round_, index) for index in range(len(self.addresses))]
+                        response = client.post("/messages/inbound/batch/", items, format="json")
+                        statuses.append(response.status_code)
+                        statuses.extend(result["status"] for result in response.json()["results"])
+            finally:
+                connection.close()
+            return statuses
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            statuses = [status for result in executor.map(ingest, range(self.threads)) for status in result]
+
+        self.assertEqual(set(statuses), {201, 207, "received"})
+        self.assertEqual(Participant.objects.count(), len(self.addresses))
+        self.assertEqual(Conversation.objects.count(), len(self.addresses))
+        expected = self.rounds * (self.threads // 2) * (1 + len(self.addresses))
+        self.assertEqual(Message.objects.count(), expected)
+
+
+class ResolutionCacheTests(ResolutionCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = {
+            "from": "+18045551234",
+            "to": "+12016661234",
+            "type": "sms",
+            "body": "Test",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+
+    def test_repeat_sender_resolves_without_queries(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first, _, _ = build_validated_message_data(self.data)
+
+        with self.assertNumQueries(0):
+            second, _, _ = build_validated_message_data(self.data)
+
+        self.assertEqual(first['conversation'], second['conversation'])
+        stats = get_resolution_cache_stats()
+        self.assertEqual(stats['participants']['hits'], 2)
+        self.assertEqual(stats['conversations']['hits'], 1)
+
+    def test_uncommitted_rows_are_not_cached(self):
+        build_validated_message_data(self.data)
+        self.assertEqual(get_resolution_cache_stats()['participants']['size'], 0)
+
+    def test_delete_evicts_cached_ids(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            build_validated_message_data(self.data)
+
+        Participant.objects.get(phone=self.data['from']).delete()
+
+        stats = get_resolution_cache_stats()
+        self.assertEqual(stats['participants']['size'], 1)
+        self.assertEqual(stats['conversations']['size'], 0)
+
+    def test_conversation_pair_is_unique(self):
+        low = Participant.objects.create(phone=self.data['from'])
+        high = Participant.objects.create(phone=self.data['to'])
+        Conversation.objects.create(participant_1=low, participant_2=high)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Conversation.objects.create(participant_1=low, participant_2=high)
+
+        # A racing bulk insert of an existing pair resolves to the stored row.
+        existing = Conversation.objects.get().id
+        with patch("messaging.utils.message_helpers.Conversation.objects.filter") as mock_filter:
+            mock_filter.return_value.order_by.return_value.values_list.side_effect = [
+                [], [(existing, low.id, high.id)]
+            ]
+            resolved = bulk_resolve_conversation_ids([(high.id, low.id)])
+        self.assertEqual(resolved, {(low.id, high.id): existing})
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_upsert_that_loses_the_race_reads_the_winner(self):
+        participant = Participant.objects.create(email="winner@example.com", address_key="winner@example.com")
+        other = Participant.objects.create(email="other@example.com", address_key="other@example.com")
+        conversation = Conversation.objects.create(participant_1=participant, participant_2=other)
+
+        # Simulate the row appearing between the lookup and the insert.
+        with patch("django.db.models.query.QuerySet.first", return_value=None):
+            self.assertEqual(upsert_participant_id("winner@example.com"), participant.id)
+            self.assertEqual(upsert_conversation_id(participant.id, other.id), conversation.id)
+        self.assertEqual(Participant.objects.count(), 2)
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_conversation_pair_must_be_ordered(self):
+        low = Participant.objects.create(phone=self.data['from'])
+        high = Participant.objects.create(phone=self.data['to'])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Conversation.objects.create(participant_1=high, participant_2=low)
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expired_entries_are_misses(self):
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+class ProviderSessionTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        http_sessions.open_sessions()
+        self.addCleanup(http_sessions.close_sessions)
+
+    def test_sessions_are_reused_per_provider_url(self):
+        sms = http_sessions.get_session(PROVIDER_URLS['sms'])
+        self.assertIs(sms, http_sessions.get_session(PROVIDER_URLS['mms']))
+        self.assertIsNot(sms, http_sessions.get_session(PROVIDER_URLS['email']))
+
+    def test_forked_process_gets_its_own_sessions(self):
+        parent = http_sessions.get_session(PROVIDER_URLS['sms'])
+        with patch("messaging.utils.http_sessions.os.getpid", return_value=-1):
+            child = http_sessions.get_session(PROVIDER_URLS['sms'])
+        self.assertIsNot(parent, child)
+
+    @patch("messaging.tasks.http_sessions.get_session")
+    def test_task_posts_through_pooled_session_with_timeout(self, mock_get_session):
+        # Providers may answer 200 with an empty or non-JSON body.
+        response = MagicMock(status_code=200)
+        response.json.side_effect = ValueError
+        mock_get_session.return_value.post.return_value = response
+
+        result = send_message_to_provider.apply(args=(b'{"body":"Hi"}', PROVIDER_URLS['sms'], 1)).get()
+
+        self.assertEqual(result, {"status": "success", "status_code": 200})
+        mock_get_session.return_value.post.assert_called_once_with(
+            PROVIDER_URLS['sms'],
+            data=b'{"body":"Hi"}',
+            headers={"Content-Type": "application/json"},
+            timeout=http_sessions.get_timeout()
+        )
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_task_encodes_legacy_dict_payloads(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=200)
+        send_message_to_provider.apply(args=({"body": "Hi"}, PROVIDER_URLS['sms']))
+        mock_post.assert_called_once_with(PROVIDER_URLS['sms'], b'{"body":"Hi"}')
+
+    def test_task_body_survives_msgpack_as_raw_bytes(self):
+        from kombu.serialization import dumps, loads, prepare_accept_content
+
+        body = encode_provider_body({"body": "Ünïcode \"quoted\"", "attachments": ["a"] * 3})
+        content_type, encoding, data = dumps(
+            ((body, PROVIDER_URLS['email'], 7), {}), serializer=send_message_to_provider.serializer
+        )
+        args, _ = loads(data, content_type, encoding, accept=prepare_accept_content(send_message_to_provider.app.conf.accept_content))
+        self.assertEqual(args[0], body)
+        self.assertIsInstance(args[0], bytes)
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_rate_limit_retries_once_with_retry_after(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=429, headers={"Retry-After": "7"})
+        with patch.object(send_message_to_provider, "retry", side_effect=Retry()) as mock_retry:
+            send_message_to_provider.apply(args=(b'{"body":"Hi"}', PROVIDER_URLS['sms']))
+        mock_retry.assert_called_once()
+        self.assertEqual(mock_retry.call_args.kwargs["countdown"], 7)
+
+
+class OutboundRoutingTests(FakeRedisMixin, ResolutionCacheMixin, APITestCase):
+
+    def route(self, task, args, **options):
+        return app.amqp.router.route(options, getattr(task, "name", task), args, {})["queue"].name
+
+    def test_queues_by_type_priority_and_retry(self):
+        self.assertEqual(self.route(send_message_to_provider, (b"", PROVIDER_URLS['sms'], 1)), "outbound.sms")
+        self.assertEqual(self.route(send_message_to_provider, (b"", PROVIDER_URLS['mms'], 1)), "outbound.sms")
+        self.assertEqual(self.route(send_message_to_provider, (b"", PROVIDER_URLS['email'], 1)), "outbound.email")
+        self.assertEqual(self.route(flush_outbound_batch, (PROVIDER_URLS['email'],)), "outbound.email")
+        self.assertEqual(
+            self.route(send_message_to_provider, (b"", PROVIDER_URLS['email'], 1, "high")), "outbound.priority"
+        )
+        self.assertEqual(
+            self.route(send_message_to_provider, (b"", PROVIDER_URLS['sms'], 1), queue="outbound.retry"),
+            "outbound.retry"
+        )
+        self.assertEqual(self.route("messaging.tasks.relay_outbox", ()), "celery")
+
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_api_priority_is_relayed_but_not_sent_to_provider(self, mock_delay):
+        data = {
+            "from": "+12016661234", "to": "+18045551234", "type": "sms",
+            "body": "Your code is 123456", "timestamp": "2024-11-01T14:00:00Z",
+        }
+        response = self.client.post("/messages/outbound/", dict(data, priority="urgent"), format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("priority", response.json())
+
+        self.client.post("/messages/outbound/", dict(data, priority="high"), format="json")
+        self.client.post("/messages/outbound/", dict(data, body="Weekly digest"), format="json")
+        relay_outbox_batch()
+
+        calls = [c.args for c in mock_delay.call_args_list]
+        self.assertEqual([(json.loads(body)["body"], priority) for body, _, _, priority in calls], [
+            ("Your code is 123456", "high"), ("Weekly digest", "normal"),
+        ])
+        self.assertNotIn("priority", json.loads(calls[0][0]))
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_retries_go_to_retry_queue(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=500)
+        for priority, queue in (("normal", "outbound.retry"), ("high", "outbound.priority")):
+            with patch.object(send_message_to_provider, "retry", side_effect=Retry()) as mock_retry:
+                send_message_to_provider.apply(args=(b'{"body":"Hi"}', PROVIDER_URLS['sms'], None, priority))
+            self.assertEqual(mock_retry.call_args.kwargs["queue"], queue)
+
+    def test_async_engine_pops_high_priority_first(self):
+        async_delivery.enqueue_many([(1, b"bulk", PROVIDER_URLS['email'])])
+        async_delivery.enqueue(2, b"code", PROVIDER_URLS['sms'], priority="high")
+        _, item = self.redis.blpop([async_delivery.PRIORITY_QUEUE_KEY, async_delivery.QUEUE_KEY])
+        self.assertEqual(msgpack.unpackb(item)[1], b"code")
+
+
+@override_settings(OUTBOUND_BATCH_WINDOW=0.5, OUTBOUND_BATCH_MAX_SIZE=3)
+class OutboundBatchingTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch.dict("messaging.utils.rate_limiter.PROVIDER_RATE_LIMITS", clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = PROVIDER_URLS['sms']
+
+    @patch("messaging.tasks.flush_outbound_batch.delay")
+    @patch("messaging.tasks.flush_outbound_batch.apply_async")
+    def test_window_flush_scheduled_once_and_full_batch_flushes_now(self, mock_apply_async, mock_delay):
+        from messaging.tasks import enqueue_outbound_batch
+
+        enqueue_outbound_batch(1, b"1", self.url)
+        enqueue_outbound_batch(2, b"2", self.url)
+        mock_apply_async.assert_called_once_with((self.url,), countdown=0.5)
+        mock_delay.assert_not_called()
+
+        enqueue_outbound_batch(3, b"3", self.url)
+        mock_delay.assert_called_once_with(self.url)
+
+    @patch("messaging.tasks.flush_outbound_batch.delay")
+    @patch("messaging.tasks.post_to_provider")
+    def test_flush_drains_one_batch_and_reschedules_rest(self, mock_post, mock_delay):
+        mock_post.return_value = MagicMock(status_code=200)
+        for i in range(5):
+            outbound_batcher.push(i, str(i).encode(), self.url)
+
+        result = flush_outbound_batch(self.url)
+
+        self.assertEqual(result, {"delivered": 3, "retrying": 0})
+        self.assertEqual(mock_post.call_count, 3)
+        mock_delay.assert_called_once_with(self.url)
+        deliveries, remaining = outbound_batcher.drain(self.url, 10)
+        self.assertEqual(deliveries, [(3, b"3"), (4, b"4")])
+        self.assertEqual(remaining, 0)
+
+    @patch("messaging.providers.random.uniform", side_effect=lambda low, high: high)
+    @patch("messaging.tasks.send_message_to_provider.apply_async")
+    @patch("messaging.tasks.post_to_provider")
+    def test_failed_messages_fall_back_to_single_task_retries(self, mock_post, mock_apply_async, mock_uniform):
+        responses = {
+            "ok": MagicMock(status_code=200),
+            "limited": MagicMock(status_code=429, headers={"Retry-After": "5"}),
+            "down": MagicMock(status_code=500, text="error"),
+        }
+        mock_post.side_effect = lambda url, body: responses[body.decode()]
+
+        result = deliver_outbound_batch([(i, name.encode()) for i, name in enumerate(responses)], self.url)
+
+        self.assertEqual(result, {"delivered": 1, "retrying": 2})
+        retried = {c.args[0]: c.kwargs["countdown"] for c in mock_apply_async.call_args_list}
+        self.assertEqual(retried, {(b"limited", self.url, 1): 5, (b"down", self.url, 2): 1})
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_batch_endpoint_used_when_provider_supports_it(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=200)
+        with patch.dict("messaging.tasks.PROVIDER_BATCH_URLS", {self.url: self.url + "/batch"}):
+            result = deliver_outbound_batch([(1, b'{"body":"1"}'), (2, b'{"body":"2"}')], self.url)
+        self.assertEqual(result, {"delivered": 2, "retrying": 0})
+        mock_post.assert_called_once_with(self.url + "/batch", b'[{"body":"1"},{"body":"2"}]')
+
+    @patch("messaging.tasks.retry_outbound_batch.apply_async")
+    @patch("messaging.tasks.rate_limiter.penalize")
+    @patch("messaging.tasks.post_to_provider")
+    def test_rate_limited_batch_is_retried_whole(self, mock_post, mock_penalize, mock_apply_async):
+        deliveries = [(1, b'{"body":"1"}'), (2, b'{"body":"2"}')]
+        mock_post.return_value = MagicMock(status_code=429, headers={"Retry-After": "7"})
+        with patch.dict("messaging.tasks.PROVIDER_BATCH_URLS", {self.url: self.url + "/batch"}):
+            result = deliver_outbound_batch(deliveries, self.url)
+
+            self.assertEqual(result, {"delivered": 0, "retrying": 2})
+            mock_post.assert_called_once()
+            mock_penalize.assert_called_once_with(self.url, 7)
+            mock_apply_async.assert_called_once_with(
+                (deliveries, self.url, 1), countdown=7, queue="outbound.retry"
+            )
+
+            # Waiting for a token reschedules the batch without calling the provider.
+            with patch("messaging.tasks.rate_limiter.wait_for_token", return_value=30):
+                deliver_outbound_batch(deliveries, self.url, retries=1)
+            mock_post.assert_called_once()
+            self.assertEqual(mock_apply_async.call_args.kwargs["countdown"], 30)
+
+            # Past max_retries the batch is fanned out to per-message tasks.
+            mock_post.return_value = MagicMock(status_code=200)
+            result = deliver_outbound_batch(deliveries, self.url, retries=6)
+        self.assertEqual(result, {"delivered": 2, "retrying": 0})
+        self.assertEqual([c.args[0] for c in mock_post.call_args_list[1:]], [self.url, self.url])
+
+    @override_settings(OUTBOUND_BATCHING_ENABLED=True)
+    @patch("messaging.tasks.enqueue_outbound_batch")
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_relay_buffers_when_batching_enabled(self, mock_delay, mock_enqueue):
+        clear_resolution_caches()
+        data = {
+            "from": "+12016661234",
+            "to": "+18045551234",
+            "type": "sms",
+            "body": "Hello via SMS",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        response = self.client.post("/messages/outbound/", data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        relay_outbox_batch()
+        mock_enqueue.assert_called_once()
+        message_id, body, url = mock_enqueue.call_args.args
+        self.assertEqual(message_id, Message.objects.get().id)
+        self.assertEqual(json.loads(body)["body"], "Hello via SMS")
+        self.assertEqual(url, self.url)
+        mock_delay.assert_not_called()
+
+
+class AsyncDeliveryEngineTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch.dict("messaging.utils.rate_limiter.PROVIDER_RATE_LIMITS", clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def client_factory(self, handler):
+        return lambda max_connections: httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def run_engine(self, handler, deliveries, **kwargs):
+        async def run():
+            engine = async_delivery.AsyncDeliveryEngine(client_factory=self.client_factory(handler), **kwargs)
+            async with engine:
+                return await engine.deliver_many(deliveries)
+        return asyncio.run(run())
+
+    def test_per_provider_concurrency_is_bounded(self):
+        active = {"now": 0, "peak": 0}
+
+        async def handler(request):
+            active["now"] += 1
+            active["peak"] = max(active["peak"], active["now"])
+            await asyncio.sleep(0.01)
+            active["now"] -= 1
+            return httpx.Response(200, json={"id": "ok"})
+
+        results = self.run_engine(
+            handler, [(b'{"body":"%d"}' % i, PROVIDER_URLS['sms']) for i in range(20)], provider_concurrency=4
+        )
+
+        self.assertEqual({r["status"] for r in results}, {"success"})
+        self.assertEqual(active["peak"], 4)
+
+    @patch("messaging.providers.random.uniform", side_effect=lambda low, high: high)
+    @patch("messaging.async_delivery.asyncio.sleep")
+    def test_retry_after_then_backoff(self, mock_sleep, mock_uniform):
+        responses = [
+            httpx.Response(429, headers={"Retry-After": "3"}),
+            httpx.Response(500, text="error"),
+            httpx.Response(200, text="OK"),
+        ]
+
+        results = self.run_engine(
+            lambda request: responses.pop(0), [(b'{"body":"Hi"}', PROVIDER_URLS['sms'])], provider_concurrency=1
+        )
+
+        self.assertEqual(results, [{"status": "success", "status_code": 200}])
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [3, 2])
+
+    @patch("messaging.providers.random.uniform", side_effect=lambda low, high: high)
+    @patch("messaging.async_delivery.asyncio.sleep")
+    def test_gives_up_after_max_retries(self, mock_sleep, mock_uniform):
+        results = self.run_engine(
+            lambda request: httpx.Response(503, text="down"),
+            [(b'{"body":"Hi"}', PROVIDER_URLS['email'])],
+            provider_concurrency=1,
+            max_retries=2,
+        )
+        self.assertEqual(results[0]["status"], "failed")
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1, 2])
+
+    def test_worker_drains_queue(self):
+        server = fakeredis.FakeServer()
+        delivered = []
+
+        def handler(request):
+            delivered.append(json.loads(request.content))
+            return httpx.Response(200, json={"id": "ok"})
+
+        with patch("messaging.async_delivery.get_redis", return_value=fakeredis.FakeRedis(server=server)):
+            for i in range(3):
+                async_delivery.enqueue(i, b'{"body":"%d"}' % i, PROVIDER_URLS['sms'])
+
+        async def run():
+            stop = asyncio.Event()
+            redis = fakeredis.FakeAsyncRedis(server=server)
+            worker = asyncio.create_task(
+                async_delivery.run_worker(redis, stop, 10, 10, client_factory=self.client_factory(handler))
+            )
+            while len(delivered) < 3:
+                await asyncio.sleep(0.01)
+            stop.set()
+            await worker
+
+        # Attempts are written once the worker stops, as one batch.
+        with patch("messaging.async_delivery.delivery_status.record_attempts") as mock_record:
+            asyncio.run(run())
+
+        self.assertEqual(sorted(d["body"] for d in delivered), ["0", "1", "2"])
+        mock_record.assert_called_once()
+        self.assertEqual(sorted(mock_record.call_args.args[0]), [(0, None, False), (1, None, False), (2, None, False)])
+
+    @override_settings(OUTBOUND_DELIVERY_ENGINE="asyncio")
+    @patch("messaging.tasks.async_delivery.enqueue_many")
+    @patch("messaging.tasks.send_message_to_provider.delay")
+    def test_relay_uses_async_engine_when_selected(self, mock_delay, mock_enqueue):
+        clear_resolution_caches()
+        data = {
+            "from": "user@usehatchapp.com",
+            "to": "contact@gmail.com",
+            "type": "email",
+            "body": "Hello",
+            "timestamp": "2024-11-01T14:00:00Z"
+        }
+        response = self.client.post("/messages/outbound/", data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        relay_outbox_batch()
+        mock_enqueue.assert_called_once()
+        [(message_id, body, url)] = mock_enqueue.call_args.args[0]
+        self.assertEqual(json.loads(body)["to"], "contact@gmail.com")
+        self.assertEqual(url, PROVIDER_URLS['email'])
+        mock_delay.assert_not_called()
+
+
+@override_settings(PROVIDER_RATE_LIMIT_RECOVERY=100.0, PROVIDER_RATE_LIMIT_MIN_FRACTION=0.1)
+class RateLimiterTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = PROVIDER_URLS['sms']
+        patcher = patch.dict("messaging.utils.rate_limiter.PROVIDER_RATE_LIMITS", {self.url: {"rate": 2, "burst": 2}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bucket_allows_burst_then_paces(self):
+        self.assertEqual(rate_limiter.acquire(self.url, now=1000), 0)
+        self.assertEqual(rate_limiter.acquire(self.url, now=1000), 0)
+        self.assertAlmostEqual(rate_limiter.acquire(self.url, now=1000), 0.5)
+        self.assertEqual(rate_limiter.acquire(self.url, now=1000.5), 0)
+
+    def test_bucket_is_shared_between_clients(self):
+        rate_limiter.acquire(self.url, now=1000)
+        other_worker = fakeredis.FakeRedis(server=self.redis_server)
+        with patch("messaging.utils.redis_client._client", other_worker):
+            rate_limiter.acquire(self.url, now=1000)
+        self.assertGreater(rate_limiter.acquire(self.url, now=1000), 0)
+
+    def test_429_blocks_then_halves_rate_and_recovers(self):
+        rate_limiter.penalize(self.url, retry_after=5, now=1000)
+
+        self.assertEqual(rate_limiter.acquire(self.url, now=1003), 2)
+        # The halved rate of 1/s climbs back by 2/s per 100s, and the bucket
+        # only starts refilling once Retry-After has passed.
+        self.assertAlmostEqual(rate_limiter.acquire(self.url, now=1005.5), (1 - 0.5 * 1.11) / 1.11)
+        self.assertEqual(rate_limiter.acquire(self.url, now=1006), 0)
+        rate = float(self.redis.hget(f"messaging:ratelimit:{self.url}", "rate"))
+        self.assertAlmostEqual(rate, 1.12)
+
+    def test_unlimited_provider_and_redis_outage_never_block(self):
+        self.assertEqual(rate_limiter.acquire("http://unlisted.example/api"), 0)
+
+        with patch("messaging.utils.rate_limiter._run", side_effect=redis.ConnectionError()):
+            with self.assertLogs("messaging.utils.rate_limiter", "WARNING"):
+                self.assertEqual(rate_limiter.acquire(self.url), 0)
+
+    @patch("messaging.tasks.post_to_provider")
+    @patch("messaging.tasks.rate_limiter.acquire", return_value=30)
+    def test_task_defers_without_calling_provider(self, mock_acquire, mock_post):
+        with patch.object(send_message_to_provider, "apply_async") as mock_apply_async:
+            result = send_message_to_provider.apply(args=(b'{"body":"Hi"}', self.url, 1)).get()
+        self.assertEqual(result, {"status": "deferred", "countdown": 30})
+        mock_apply_async.assert_called_once_with(
+            (b'{"body":"Hi"}', self.url, 1, "normal"), countdown=30, queue="outbound.retry", retries=0
+        )
+        mock_post.assert_not_called()
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_task_429_holds_off_every_worker(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=429, headers={"Retry-After": "7"})
+        with patch.object(send_message_to_provider, "retry", side_effect=Retry()):
+            send_message_to_provider.apply(args=(b'{"body":"Hi"}', self.url))
+        self.assertGreater(rate_limiter.acquire(self.url), 6)
+
+
+@override_settings(
+    PROVIDER_CIRCUIT_MIN_CALLS=4,
+    PROVIDER_CIRCUIT_ERROR_RATE=0.5,
+    PROVIDER_CIRCUIT_SLOW_RATE=0.5,
+    PROVIDER_CIRCUIT_SLOW_CALL_SECONDS=2.0,
+    PROVIDER_CIRCUIT_OPEN_SECONDS=10.0,
+    PROVIDER_HTTP_CONNECT_TIMEOUT=1.0,
+    PROVIDER_HTTP_READ_TIMEOUT=2.0,
+)
+@patch("messaging.utils.circuit_breaker.random.uniform", return_value=1)
+class CircuitBreakerTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = PROVIDER_URLS['email']
+
+    def trip(self, now=1000):
+        for failed in (False, False, True):
+            self.assertEqual(circuit_breaker.record(self.url, failed, 0.1, now=now), "closed")
+        with self.assertLogs("messaging.utils.circuit_breaker", "WARNING"):
+            self.assertEqual(circuit_breaker.record(self.url, True, 0.1, now=now), "open")
+
+    def test_opens_on_error_rate_and_recovers_through_one_probe(self, mock_uniform):
+        self.trip()
+        self.assertEqual(circuit_breaker.wait_seconds(self.url, now=1005), 5)
+
+        # Half-open: one probe at a time, each failure doubles the wait.
+        self.assertEqual(circuit_breaker.wait_seconds(self.url, now=1010), 0)
+        self.assertEqual(circuit_breaker.wait_seconds(self.url, now=1011), 2)
+        with self.assertLogs("messaging.utils.circuit_breaker", "WARNING"):
+            self.assertEqual(circuit_breaker.record(self.url, True, 0.1, now=1012), "open")
+        self.assertEqual(circuit_breaker.wait_seconds(self.url, now=1022), 10)
+
+        self.assertEqual(circuit_breaker.wait_seconds(self.url, now=1032), 0)
+        self.assertEqual(circuit_breaker.record(self.url, False, 0.1, now=1033), "closed")
+        self.assertEqual(circuit_breaker.wait_seconds(self.url, now=1033), 0)
+
+    def test_slow_calls_open_the_circuit_but_rejections_do_not(self, mock_uniform):
+        for _ in range(3):
+            circuit_breaker.record(self.url, False, 0.1, now=1000)
+        self.assertEqual(circuit_breaker.record(self.url, False, 5.0, now=1000), "closed")
+        self.assertEqual(circuit_breaker.record(self.url, False, 5.0, now=1000), "closed")
+        with self.assertLogs("messaging.utils.circuit_breaker", "WARNING"):
+            self.assertEqual(circuit_breaker.record(self.url, False, 5.0, now=1000), "open")
+
+        self.assertFalse(is_outage(RateLimited(5)))
+        self.assertFalse(is_outage(ProviderError(400, "bad request")))
+        self.assertTrue(is_outage(ProviderError(503, "down")))
+        self.assertTrue(is_outage(ConnectionError()))
+
+    def test_redis_outage_never_blocks(self, mock_uniform):
+        with patch("messaging.utils.circuit_breaker._run", side_effect=redis.ConnectionError()):
+            with self.assertLogs("messaging.utils.circuit_breaker", "WARNING"):
+                self.assertEqual(circuit_breaker.wait_seconds(self.url), 0)
+
+    @patch("messaging.tasks.post_to_provider")
+    def test_open_circuit_parks_task_without_calling_provider(self, mock_post, mock_uniform):
+        self.trip(now=time.time())
+        with patch.object(send_message_to_provider, "apply_async") as mock_apply_async:
+            result = send_message_to_provider.apply(args=(b'{"body":"Hi"}', self.url, 1)).get()
+        self.assertEqual(result["status"], "parked")
+        mock_post.assert_not_called()
+        self.assertEqual(mock_apply_async.call_args.kwargs["queue"], "outbound.retry")
+        self.assertAlmostEqual(mock_apply_async.call_args.kwargs["countdown"], 10, delta=1)
+
+    @patch("messaging.tasks.rate_limiter.acquire")
+    @patch("messaging.tasks.post_to_provider")
+    def test_parked_task_keeps_its_retries_and_takes_no_token(self, mock_post, mock_acquire, mock_uniform):
+        self.trip(now=time.time())
+        with patch.object(send_message_to_provider, "apply_async") as mock_apply_async:
+            send_message_to_provider.apply(args=(b'{"body":"Hi"}', self.url, 1), retries=3)
+        self.assertEqual(mock_apply_async.call_args.kwargs["retries"], 3)
+        mock_acquire.assert_not_called()
+
+    @patch("messaging.async_delivery.rate_limiter.acquire")
+    def test_async_parked_delivery_keeps_its_retries(self, mock_acquire, mock_uniform):
+        self.trip(now=time.time())
+
+        async def run():
+            async with async_delivery.AsyncDeliveryEngine(1) as engine:
+                return await engine.deliver(b'{"body":"Hi"}', self.url, 1, retries=3)
+
+        result = asyncio.run(run())
+        self.assertEqual((result["status"], result["retries"]), ("parked", 3))
+        mock_acquire.assert_not_called()
+
+    def test_async_worker_releases_parked_deliveries_when_due(self, mock_uniform):
+        client = fakeredis.FakeAsyncRedis(server=self.redis_server)
+
+        async def run():
+            await async_delivery.park(client, async_delivery.PRIORITY_QUEUE_KEY, b"payload", 10)
+            self.assertEqual(await async_delivery.release_parked(client), 0)
+            self.assertEqual(await async_delivery.release_parked(client, now=time.time() + 11), 1)
+            return await client.lrange(async_delivery.PRIORITY_QUEUE_KEY, 0, -1)
+
+        self.assertEqual(asyncio.run(run()), [b"payload"])
+
+
+class RetryAfterTests(TestCase):
+
+    def test_delta_seconds_and_http_date(self):
+        now = parse_datetime("2015-10-21T07:28:00Z")
+        self.assertEqual(parse_retry_after("120", now=now), 120)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:30:00 GMT", now=now), 120)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:00:00 GMT", now=now), 0)
+        self.assertIsNone(parse_retry_after("soon", now=now))
+
+    @patch("messaging.providers.random.uniform", side_effect=lambda low, high: high)
+    def test_unparseable_retry_after_falls_back_to_backoff(self, mock_uniform):
+        response = MagicMock(status_code=429, headers={"Retry-After": "soon"})
+        with self.assertRaises(RateLimited) as raised:
+            check_provider_response(response, retries=3)
+        self.assertEqual(raised.exception.countdown, 8)
@@ -1,7 +1,36 @@
 from django.urls import path
-from .views import InboundMessageAPIView, OutboundMessageAPIView
+from .views import (
+    AsyncInboundMessageView,
+    AsyncOutboundMessageView,
+    AttachmentDownloadView,
+    AttachmentUploadView,
+    ConversationDetailAPIView,
+    ConversationListAPIView,
+    ConversationMessagesAPIView,
+    DeliveryReceiptAPIView,
+    InboundMessageAPIView,
+    InboundMessageBatchAPIView,
+    InboxAPIView,
+    MessageSearchAPIView,
+    MetricsView,
+    OutboundMessageAPIView,
+    ResolutionCacheStatsAPIView,
+)
 
 urlpatterns = [
     path("messages/inbound/", InboundMessageAPIView.as_view(), name="inbound-message"),
+    path("messages/inbound/batch/", InboundMessageBatchAPIView.as_view(), name="inbound-message-batch"),
     path("messages/outbound/", OutboundMessageAPIView.as_view(), name="outbound-message"),
+    path("messages/receipts/", DeliveryReceiptAPIView.as_view(), name="delivery-receipts"),
+    path("messages/inbound/async/", AsyncInboundMessageView.as_view(), name="inbound-message-async"),
+    path("messages/outbound/async/", AsyncOutboundMessageView.as_view(), name="outbound-message-async"),
+    path("attachments/", AttachmentUploadView.as_view(), name="attachment-upload"),
+    path("attachments/<str:sha256>/", AttachmentDownloadView.as_view(), name="attachment-download"),
+    path("messages/search/", MessageSearchAPIView.as_view(), name="message-search"),
+    path("messages/cache/stats/", ResolutionCacheStatsAPIView.as_view(), name="resolution-cache-stats"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
+    path("conversations/", ConversationListAPIView.as_view(), name="conversation-list"),
+    path("conversations/inbox/", InboxAPIView.as_view(), name="conversation-inbox"),
+    path("conversations/<int:pk>/", ConversationDetailAPIView.as_view(), name="conversation-detail"),
+    path("conversations/<int:pk>/messages/", ConversationMessagesAPIView.as_view(), name="conversation-messages"),
 ]
\ No newline at end of file
@@ -0,0 +1,82 @@
+"""
+Canonical participant addresses.
+
+Every address a provider or client sends is reduced to one key before it
+is looked up: emails are trimmed and lower-cased, phone numbers are
+rewritten as E.164 (``+<country code><number>``). "+1 (804) 555-1234",
+"18045551234" and "804.555.1234" all become "+18045551234", so they
+resolve to one Participant and one conversation. SMS short codes
+("262966") have no country and are kept as their digits.
+"""
+
+import re
+
+from django.conf import settings
+
+_PHONE_PUNCTUATION_RE = re.compile(r"[\s().\-/]")
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+# E.164 allows at most 15 digits after the "+".
+_MAX_DIGITS = 15
+_MIN_DIGITS = 8
+_MAX_SHORT_CODE_DIGITS = 6
+
+
+def is_email(address):
+    return "@" in address
+
+
+def normalize_email(address):
+    email = address.strip().lower()
+    if email.startswith("mailto:"):
+        email = email[len("mailto:"):]
+    if not _EMAIL_RE.match(email):
+        raise ValueError(f"Invalid email address: '{address}'.")
+    return email
+
+
+def normalize_phone(address):
+    """
+    Rewrite a phone number in E.164. Numbers without a "+" get
+    MESSAGING_DEFAULT_COUNTRY_CODE when they have the national length
+    (10 digits for the default, North America) and are taken to start with
+    their country code when they are longer. Short codes, up to 6 digits
+    without a "+", are returned as they are.
+    """
+    phone = _PHONE_PUNCTUATION_RE.sub("", address.strip())
+    if phone.startswith("tel:"):
+        phone = phone[len("tel:"):]
+    if phone.startswith("00"):
+        phone = "+" + phone[2:]
+
+    digits = phone.lstrip("+")
+    if not digits.isdigit():
+        raise ValueError(f"Invalid phone number: '{address}'.")
+
+    if not phone.startswith("+"):
+        national_length = settings.MESSAGING_DEFAULT_NATIONAL_NUMBER_LENGTH
+        if len(digits) <= _MAX_SHORT_CODE_DIGITS:
+            return digits
+        if len(digits) == national_length:
+            digits = settings.MESSAGING_DEFAULT_COUNTRY_CODE + digits
+        elif len(digits) < national_length:
+            raise ValueError(f"Phone number '{address}' has no country code.")
+
+    if not _MIN_DIGITS <= len(digits) <= _MAX_DIGITS:
+        raise ValueError(f"Invalid phone number: '{address}'.")
+    return "+" + digits
+
+
+def normalize_address(address):
+    """Return the canonical key for an email address or phone number, raising ValueError if it is neither."""
+    if not isinstance(address, str):
+        raise ValueError(f"Invalid address: '{address}'.")
+    if is_email(address):
+        return normalize_email(address)
+    return normalize_phone(address)
+
+
+def participant_fields(address_key):
+    """Model fields for a new Participant with a normalized address."""
+    field = "email" if is_email(address_key) else "phone"
+    return {"address_key": address_key, field: address_key}
@@ -0,0 +1,276 @@
+"""
+Content-addressed attachment storage.
+
+Media is streamed to disk once, named by its SHA-256, and messages hold
+``attachment:<sha256>`` references instead of the bytes, so rows, broker
+messages and worker memory stay small however large the MMS or email.
+Identical uploads share one file and one Attachment row.
+"""
+
+import hashlib
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+import time
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from django.conf import settings
+from django.urls import reverse
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as TransportError
+
+from messaging.models import Attachment
+
+logger = logging.getLogger(__name__)
+
+REF_PREFIX = "attachment:"
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class UnsafeURL(Exception):
+    pass
+
+
+class DownloadTimedOut(Exception):
+    pass
+
+
+class FileSystemBackend:
+    """Blobs under ``root/ab/cd/abcd...``; partial uploads live in ``root/tmp``."""
+
+    def __init__(self, root):
+        self.root = os.fspath(root)
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def temporary_file(self):
+        directory = os.path.join(self.root, "tmp")
+        os.makedirs(directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directory, delete=False)
+
+    def commit(self, temp_path, sha256):
+        # os.replace is atomic, so concurrent uploads of the same content
+        # race harmlessly and readers never see a partial file.
+        path = self.path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def open(self, sha256):
+        return open(self.path(sha256), "rb")
+
+
+def get_backend():
+    return FileSystemBackend(settings.MESSAGING_ATTACHMENT_ROOT)
+
+
+def store(chunks, content_type="application/octet-stream"):
+    """
+    Write an iterable of byte chunks to the store, hashing as it goes.
+
+    Returns (attachment, created); ``created`` is False when the content was
+    already stored. Raises AttachmentTooLarge past
+    MESSAGING_ATTACHMENT_MAX_SIZE without keeping anything.
+    """
+    backend = get_backend()
+    max_size = settings.MESSAGING_ATTACHMENT_MAX_SIZE
+    digest = hashlib.sha256()
+    size = 0
+
+    temp = backend.temporary_file()
+    try:
+        with temp:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise AttachmentTooLarge(f"Attachment exceeds maximum size of {max_size} bytes.")
+                digest.update(chunk)
+                temp.write(chunk)
+        sha256 = digest.hexdigest()
+        if backend.exists(sha256):
+            os.unlink(temp.name)
+        else:
+            backend.commit(temp.name, sha256)
+    except BaseException:
+        if os.path.exists(temp.name):
+            os.unlink(temp.name)
+        raise
+
+    return Attachment.objects.get_or_create(
+        sha256=sha256,
+        defaults={"size": size, "content_type": content_type or "application/octet-stream"},
+    )
+
+
+def make_ref(sha256):
+    return REF_PREFIX + sha256
+
+
+def parse_ref(value):
+    """Return the SHA-256 of an ``attachment:`` reference, or None for anything else."""
+    if isinstance(value, str) and value.startswith(REF_PREFIX):
+        sha256 = value[len(REF_PREFIX):]
+        if _SHA256_RE.match(sha256):
+            return sha256
+    return None
+
+
+def is_remote(value):
+    return isinstance(value, str) and value.startswith(("http://", "https://"))
+
+
+def public_url(sha256):
+    return settings.MESSAGING_ATTACHMENT_BASE_URL.rstrip("/") + reverse("attachment-download", args=[sha256])
+
+
+def unknown_refs(attachments):
+    """References in ``attachments`` that don't name a stored attachment."""
+    if not isinstance(attachments, list):
+        return []
+    refs = {
+        value: parse_ref(value)
+        for value in attachments
+        if isinstance(value, str) and value.startswith(REF_PREFIX)
+    }
+    if not refs:
+        return []
+    known = set(
+        Attachment.objects.filter(sha256__in=[sha for sha in refs.values() if sha])
+        .values_list("sha256", flat=True)
+    )
+    return [value for value, sha in refs.items() if sha not in known]
+
+
+def resolve_refs(attachments):
+    """Swap references for download URLs the provider can fetch from."""
+    if not isinstance(attachments, list):
+        return attachments
+    return [public_url(sha) if (sha := parse_ref(value)) else value for value in attachments]
+
+
+def check_offload_url(url):
+    """
+    Raise UnsafeURL unless ``url`` is http(s) on an allowed media host
+    (MESSAGING_ATTACHMENT_OFFLOAD_HOSTS, any host when empty) that resolves
+    only to public addresses, and return the address to connect to.
+    Inbound URLs come from unauthenticated webhooks and what is fetched is
+    served back publicly, so internal services must never be reachable
+    through them.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise UnsafeURL("Only http(s) URLs can be offloaded.")
+    host = parts.hostname.lower()
+    allowed = settings.MESSAGING_ATTACHMENT_OFFLOAD_HOSTS
+    if allowed and not any(host == name or host.endswith("." + name) for name in allowed):
+        raise UnsafeURL(f"{host} is not an allowed media host.")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError, ValueError) as exc:
+        raise UnsafeURL(f"Could not resolve {host}: {exc}")
+    addresses = [info[4][0].split("%")[0] for info in infos]
+    for value in addresses:
+        address = ipaddress.ip_address(value)
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise UnsafeURL(f"{host} resolves to non-public address {address}.")
+    return addresses[0]
+
+
+class PinnedAdapter(HTTPAdapter):
+    """
+    Connects each host to the address check_offload_url vetted for it
+    instead of resolving it again, so a DNS answer that changes between the
+    check and the connection (rebinding) can't point the fetch at an
+    internal service. TLS still verifies the certificate for the hostname.
+    """
+
+    def __init__(self, **kwargs):
+        self.addresses = {}
+        super().__init__(max_retries=0, **kwargs)
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        host = host_params["host"]
+        if host_params["scheme"] == "https":
+            pool_kwargs["server_hostname"] = host
+            pool_kwargs["assert_hostname"] = host
+        if host not in self.addresses:
+            raise UnsafeURL(f"{host} was not checked before connecting.")
+        host_params["host"] = self.addresses[host]
+        return host_params, pool_kwargs
+
+    def add_headers(self, request, **kwargs):
+        # The connection is to an address, so name the host explicitly.
+        request.headers["Host"] = urlsplit(request.url).netloc.rpartition("@")[2]
+
+
+def _fetch(session, url, deadline):
+    """GET ``url``, checking it and every redirect hop with check_offload_url."""
+    adapter = PinnedAdapter()
+    session.trust_env = False
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    for _ in range(MAX_REDIRECTS + 1):
+        adapter.addresses[urlsplit(url).hostname.lower()] = check_offload_url(url)
+        response = session.get(
+            url, stream=True, allow_redirects=False, timeout=_timeout(deadline)
+        )
+        if not response.is_redirect:
+            return response
+        response.close()
+        url = urljoin(url, response.headers["Location"])
+    raise UnsafeURL(f"More than {MAX_REDIRECTS} redirects.")
+
+
+def _timeout(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DownloadTimedOut("Download took too long.")
+    return min(settings.PROVIDER_HTTP_READ_TIMEOUT, remaining)
+
+
+def _read_chunks(response, deadline):
+    # read1 returns whatever has arrived instead of waiting for a full
+    # chunk, so a host dripping bytes can't outlast the deadline by more
+    # than one read timeout.
+    while chunk := response.raw.read1(CHUNK_SIZE, decode_content=True):
+        yield chunk
+        _timeout(deadline)
+
+
+def offload(url):
+    """
+    Stream a remote attachment into the store and return its reference.
+
+    The whole download, redirects included, gets
+    MESSAGING_ATTACHMENT_OFFLOAD_TIMEOUT seconds. Returns ``url`` unchanged
+    when it can't or mustn't be fetched, so the message keeps a working link.
+    """
+    deadline = time.monotonic() + settings.MESSAGING_ATTACHMENT_OFFLOAD_TIMEOUT
+    try:
+        with requests.Session() as session, _fetch(session, url, deadline) as response:
+            response.raise_for_status()
+            attachment, _ = store(
+                _read_chunks(response, deadline),
+                content_type=response.headers.get("Content-Type"),
+            )
+    except (requests.RequestException, TransportError, AttachmentTooLarge, UnsafeURL, DownloadTimedOut) as exc:
+        logger.warning("Could not offload attachment %s: %s", url, exc)
+        return url
+    return make_ref(attachment.sha256)
@@ -0,0 +1,171 @@
+"""
+Circuit breaker per provider URL, shared by all workers through Redis.
+
+Closed, every call goes out and its outcome is counted in a window of
+PROVIDER_CIRCUIT_WINDOW seconds. Once the window has at least
+PROVIDER_CIRCUIT_MIN_CALLS calls and the share of failures (5xx and
+connection errors; see providers.is_outage) reaches
+PROVIDER_CIRCUIT_ERROR_RATE, or the share of calls slower than
+PROVIDER_CIRCUIT_SLOW_CALL_SECONDS reaches PROVIDER_CIRCUIT_SLOW_RATE, the
+circuit opens. Open, callers park their messages without calling the
+provider. After PROVIDER_CIRCUIT_OPEN_SECONDS it is half-open: one probe
+goes out at a time and closes the circuit if it succeeds, or reopens it
+for twice as long, up to PROVIDER_CIRCUIT_MAX_OPEN_SECONDS.
+"""
+
+import logging
+import random
+import time
+
+import redis
+from django.conf import settings
+
+from messaging.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Returns the seconds the caller should wait, 0 if it may call the
+# provider. A caller let through while half-open is the probe, and other
+# callers wait until it reports back or its time runs out.
+WAIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local probe_timeout = tonumber(ARGV[2])
+
+local state = redis.call('HMGET', KEYS[1], 'opened_until', 'probe_until')
+local opened_until = tonumber(state[1]) or 0
+local probe_until = tonumber(state[2]) or 0
+
+if opened_until == 0 then
+    return '0'
+elseif now < opened_until then
+    return tostring(opened_until - now)
+elseif now < probe_until then
+    return tostring(probe_until - now)
+end
+redis.call('HSET', KEYS[1], 'probe_until', now + probe_timeout)
+return '0'
+"""
+
+# Records one call and returns the resulting state, 'opened' when this
+# call opened the circuit.
+RECORD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local failed = tonumber(ARGV[2])
+local slow = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+local min_calls = tonumber(ARGV[5])
+local error_rate = tonumber(ARGV[6])
+local slow_rate = tonumber(ARGV[7])
+local open_seconds = tonumber(ARGV[8])
+local max_open_seconds = tonumber(ARGV[9])
+local jitter = tonumber(ARGV[10])
+
+local state = redis.call(
+    'HMGET', KEYS[1], 'opened_until', 'probe_until', 'open_seconds', 'window_start', 'calls', 'failures', 'slow'
+)
+local opened_until = tonumber(state[1]) or 0
+local probe_until = tonumber(state[2]) or 0
+
+if opened_until > 0 then
+    -- Only the probe's outcome counts; calls that started before the
+    -- circuit opened are ignored.
+    if now < opened_until or probe_until == 0 then
+        return 'open'
+    end
+    if failed == 0 and slow == 0 then
+        redis.call('DEL', KEYS[1])
+        return 'closed'
+    end
+    local next_open = math.min(max_open_seconds, (tonumber(state[3]) or open_seconds) * 2)
+    redis.call('HSET', KEYS[1], 'opened_until', now + next_open * jitter, 'probe_until', 0, 'open_seconds', next_open)
+    redis.call('EXPIRE', KEYS[1], math.ceil(next_open * jitter + 3600))
+    return 'opened'
+end
+
+local window_start = tonumber(state[4]) or now
+local calls = tonumber(state[5]) or 0
+local failures = tonumber(state[6]) or 0
+local slow_calls = tonumber(state[7]) or 0
+if now - window_start >= window then
+    window_start, calls, failures, slow_calls = now, 0, 0, 0
+end
+calls = calls + 1
+failures = failures + failed
+slow_calls = slow_calls + slow
+
+if calls >= min_calls and (failures / calls >= error_rate or slow_calls / calls >= slow_rate) then
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], 'opened_until', now + open_seconds * jitter, 'probe_until', 0, 'open_seconds', open_seconds)
+    redis.call('EXPIRE', KEYS[1], math.ceil(open_seconds * jitter + 3600))
+    return 'opened'
+end
+redis.call('HSET', KEYS[1], 'window_start', window_start, 'calls', calls, 'failures', failures, 'slow', slow_calls)
+redis.call('EXPIRE', KEYS[1], math.ceil(window + 60))
+return 'closed'
+"""
+
+_scripts = {}
+
+
+def _circuit_key(provider_url):
+    return f"messaging:circuit:{provider_url}"
+
+
+def _run(source, keys, args):
+    client = get_redis()
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = client.register_script(source)
+    return script(keys=keys, args=args, client=client)
+
+
+def wait_seconds(provider_url, now=None):
+    """
+    Returns 0 when a call to ``provider_url`` may go out, otherwise the
+    seconds to park the message for. The wait is spread out so parked
+    messages don't all come back at once. Redis outages never block
+    delivery.
+    """
+    if not settings.PROVIDER_CIRCUIT_ENABLED:
+        return 0
+    try:
+        wait = float(_run(
+            WAIT_SCRIPT,
+            keys=[_circuit_key(provider_url)],
+            args=[now or time.time(), settings.PROVIDER_HTTP_CONNECT_TIMEOUT + settings.PROVIDER_HTTP_READ_TIMEOUT]
+        ))
+    except redis.RedisError:
+        logger.warning("Circuit breaker unavailable, sending to %s", provider_url, exc_info=True)
+        return 0
+    return wait * random.uniform(1, 1.5) if wait else 0
+
+
+def record(provider_url, failed, seconds, now=None):
+    """Count a call's outcome; ``seconds`` is how long it took. Returns the circuit's state."""
+    if not settings.PROVIDER_CIRCUIT_ENABLED:
+        return "closed"
+    try:
+        state = _run(
+            RECORD_SCRIPT,
+            keys=[_circuit_key(provider_url)],
+            args=[
+                now or time.time(),
+                int(failed),
+                int(seconds >= settings.PROVIDER_CIRCUIT_SLOW_CALL_SECONDS),
+                settings.PROVIDER_CIRCUIT_WINDOW,
+                settings.PROVIDER_CIRCUIT_MIN_CALLS,
+                settings.PROVIDER_CIRCUIT_ERROR_RATE,
+                settings.PROVIDER_CIRCUIT_SLOW_RATE,
+                settings.PROVIDER_CIRCUIT_OPEN_SECONDS,
+                settings.PROVIDER_CIRCUIT_MAX_OPEN_SECONDS,
+                random.uniform(0.8, 1.2),
+            ]
+        )
+    except redis.RedisError:
+        logger.warning("Circuit breaker unavailable, could not record call to %s", provider_url, exc_info=True)
+        return "closed"
+    state = state.decode() if isinstance(state, bytes) else state
+    if state == "opened":
+        logger.warning("Circuit for %s opened; parking deliveries", provider_url)
+        return "open"
+    return state
@@ -0,0 +1,106 @@
+"""
+Denormalized per-conversation summary: last_message_at,
+last_message_preview and message_count.
+
+Every path that inserts messages calls record_messages in the same
+transaction, so an inbox is one indexed read of Conversation rows instead
+of an aggregate over Message. rebuild_summaries recomputes them from the
+messages, for backfills and after participant merges.
+"""
+
+import re
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.utils.html import strip_tags
+
+from messaging.constants import CONVERSATION_PREVIEW_LENGTH
+from messaging.models import ArchivedMessage, Conversation, Message
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def make_preview(body):
+    """Plain-text start of a message body: tags stripped, whitespace collapsed."""
+    text = _WHITESPACE_RE.sub(" ", strip_tags(body or "")).strip()
+    if len(text) > CONVERSATION_PREVIEW_LENGTH:
+        text = text[:CONVERSATION_PREVIEW_LENGTH - 1].rstrip() + "…"
+    return text
+
+
+def record_messages(messages):
+    """
+    Fold newly inserted ``messages`` into their conversations' summaries
+    with one UPDATE per conversation. Must run in the transaction that
+    inserted them.
+
+    The latest message is decided by timestamp, so a late webhook for an
+    older message only bumps the count.
+    """
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[message.conversation_id].append(message)
+
+    for conversation_id, conversation_messages in by_conversation.items():
+        latest = max(conversation_messages, key=lambda message: message.timestamp)
+        is_newer = Q(last_message_at__isnull=True) | Q(last_message_at__lt=latest.timestamp)
+        Conversation.objects.filter(id=conversation_id).update(
+            message_count=F('message_count') + len(conversation_messages),
+            last_message_at=Case(When(is_newer, then=Value(latest.timestamp)), default=F('last_message_at')),
+            last_message_preview=Case(
+                When(is_newer, then=Value(make_preview(latest.body))), default=F('last_message_preview')
+            ),
+        )
+
+
+def rebuild_summaries(conversation_ids):
+    """Recompute the summaries of ``conversation_ids`` from their messages in both tiers."""
+    with transaction.atomic():
+        # Locked separately: PostgreSQL doesn't allow FOR UPDATE with GROUP BY.
+        locked = list(
+            Conversation.objects.select_for_update().filter(id__in=conversation_ids).values_list('id', flat=True)
+        )
+        conversations = Conversation.objects.in_bulk(locked)
+        counts = Counter()
+        latest = {}
+        for model in (Message, ArchivedMessage):
+            newest = model.objects.filter(conversation=OuterRef('conversation_id')).order_by('-timestamp', '-id')
+            rows = list(
+                model.objects
+                .filter(conversation_id__in=locked)
+                .values('conversation_id')
+                .annotate(count=Count('id'), latest_id=Subquery(newest.values('id')[:1]))
+                .order_by()
+            )
+            newest_messages = model.objects.in_bulk([row['latest_id'] for row in rows])
+            for row in rows:
+                counts[row['conversation_id']] += row['count']
+                message = newest_messages[row['latest_id']]
+                current = latest.get(row['conversation_id'])
+                if current is None or (message.timestamp, message.id) > (current.timestamp, current.id):
+                    latest[row['conversation_id']] = message
+
+        for conversation in conversations.values():
+            message = latest.get(conversation.id)
+            conversation.message_count = counts[conversation.id]
+            conversation.last_message_at = message.timestamp if message else None
+            conversation.last_message_preview = make_preview(message.body) if message else ""
+        Conversation.objects.bulk_update(
+            list(conversations.values()), ['message_count', 'last_message_at', 'last_message_preview']
+        )
+    return len(conversations)
+
+
+def rebuild_all_summaries(batch_size=1000):
+    """Rebuild every conversation's summary, ``batch_size`` conversations per transaction."""
+    rebuilt = 0
+    last_id = 0
+    while True:
+        ids = list(
+            Conversation.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return rebuilt
+        rebuilt += rebuild_summaries(ids)
+        last_id = ids[-1]
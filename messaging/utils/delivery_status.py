@@ -0,0 +1,121 @@
+"""
+Outbound delivery status: queued -> sent -> delivered, or failed.
+
+A message is queued when it is accepted, sent once a provider takes it
+and delivered or failed when the provider's receipt says so; it fails
+without a receipt when the workers give up. Statuses only move forward,
+so a late "sent" never overwrites a receipt that arrived first, and
+delivered and failed are final.
+
+Workers hand over their attempts in batches and each batch is written
+with one INSERT and one UPDATE per resulting status.
+"""
+
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from messaging import realtime
+from messaging.models import DeliveryAttempt, Message
+
+QUEUED, SENT, DELIVERED, FAILED = "queued", "sent", "delivered", "failed"
+
+# The statuses each status may be entered from.
+TRANSITIONS = {
+    SENT: [QUEUED],
+    DELIVERED: [QUEUED, SENT],
+    FAILED: [QUEUED, SENT],
+}
+
+# Statuses a provider receipt may report.
+RECEIPT_STATUSES = {SENT, DELIVERED, FAILED}
+
+
+def advance(message_ids, status, at=None):
+    """
+    Move the messages in ``message_ids`` that may enter ``status`` to it and
+    push the change to realtime subscribers. Returns the ids that moved.
+    """
+    at = at or timezone.now()
+    eligible = Message.objects.filter(id__in=message_ids, status__in=TRANSITIONS[status])
+    with transaction.atomic():
+        moved = list(eligible.values_list('id', flat=True))
+        if moved:
+            eligible.filter(id__in=moved).update(status=status, status_updated_at=at)
+            realtime.publish_status(moved, status)
+    return moved
+
+
+def record_attempts(attempts):
+    """
+    Save delivery attempts, given as (message_id, error, final) triples
+    where ``error`` is None when the provider accepted the message and
+    ``final`` marks a failure that won't be retried.
+
+    Accepted messages become sent and final failures failed; a failure that
+    will be retried leaves the message queued. Attempts for messages that
+    no longer exist (archived or deleted) are dropped.
+    """
+    attempts = [attempt for attempt in attempts if attempt[0] is not None]
+    if not attempts:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        existing = set(
+            Message.objects.filter(id__in={message_id for message_id, _, _ in attempts}).values_list('id', flat=True)
+        )
+        attempts = [attempt for attempt in attempts if attempt[0] in existing]
+        DeliveryAttempt.objects.bulk_create([
+            DeliveryAttempt(message_id=message_id, error=error or "", created_at=now)
+            for message_id, error, _ in attempts
+        ])
+
+        outcomes = defaultdict(list)
+        for message_id, error, final in attempts:
+            if error is None:
+                outcomes[SENT].append(message_id)
+            elif final:
+                outcomes[FAILED].append(message_id)
+
+        by_count = defaultdict(list)
+        for message_id, count in Counter(message_id for message_id, _, _ in attempts).items():
+            by_count[count].append(message_id)
+        for count, message_ids in by_count.items():
+            Message.objects.filter(id__in=message_ids).update(attempt_count=F('attempt_count') + count)
+        for status, message_ids in outcomes.items():
+            advance(message_ids, status, now)
+
+
+def apply_receipts(receipts):
+    """
+    Apply provider delivery receipts, given as (provider, provider_message_id,
+    status) triples, with one lookup per provider and one UPDATE per status.
+
+    Returns counts of receipts that changed a message, that were stale
+    (the message had already moved past that status) and that matched no
+    message.
+    """
+    ids = {}
+    by_provider = defaultdict(set)
+    for provider, provider_message_id, _ in receipts:
+        by_provider[provider].add(provider_message_id)
+    for provider, provider_message_ids in by_provider.items():
+        for message_id, provider_message_id in Message.objects.filter(
+            provider=provider, provider_message_id__in=provider_message_ids
+        ).values_list('id', 'provider_message_id'):
+            ids[(provider, provider_message_id)] = message_id
+
+    by_status = defaultdict(set)
+    for provider, provider_message_id, status in receipts:
+        if (provider, provider_message_id) in ids:
+            by_status[status].add(ids[(provider, provider_message_id)])
+
+    now = timezone.now()
+    updated = 0
+    with transaction.atomic():
+        for status, message_ids in by_status.items():
+            updated += len(advance(message_ids, status, now))
+    matched = sum(1 for provider, provider_message_id, _ in receipts if (provider, provider_message_id) in ids)
+    return {"updated": updated, "stale": matched - updated, "unknown": len(receipts) - matched}
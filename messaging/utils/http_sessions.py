@@ -0,0 +1,72 @@
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from messaging.constants import PROVIDER_URLS
+
+_sessions = {}
+_owner_pid = None
+_lock = threading.Lock()
+
+
+def _build_session():
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.PROVIDER_HTTP_POOL_SIZE,
+        max_retries=0,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def open_sessions():
+    """
+    Create one keep-alive session per provider URL for this process.
+
+    Called from Celery's worker_process_init so every forked child owns its
+    sockets instead of sharing the parent's.
+    """
+    global _owner_pid
+    with _lock:
+        # Sessions inherited across a fork share sockets with the parent, so
+        # they are dropped rather than closed.
+        if _owner_pid == os.getpid():
+            _close_all()
+        _sessions.clear()
+        for url in set(PROVIDER_URLS.values()):
+            _sessions[url] = _build_session()
+        _owner_pid = os.getpid()
+
+
+def close_sessions():
+    global _owner_pid
+    with _lock:
+        if _owner_pid == os.getpid():
+            _close_all()
+        _sessions.clear()
+        _owner_pid = None
+
+
+def _close_all():
+    for session in _sessions.values():
+        session.close()
+
+
+def get_session(url):
+    if _owner_pid != os.getpid():
+        open_sessions()
+
+    session = _sessions.get(url)
+    if session is None:
+        with _lock:
+            session = _sessions.setdefault(url, _build_session())
+    return session
+
+
+def get_timeout():
+    return (settings.PROVIDER_HTTP_CONNECT_TIMEOUT, settings.PROVIDER_HTTP_READ_TIMEOUT)
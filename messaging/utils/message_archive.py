@@ -0,0 +1,126 @@
+"""
+Hot/cold split of message storage.
+
+Messages older than MESSAGING_ARCHIVE_AFTER_DAYS are moved from Message to
+ArchivedMessage in chunks, so the hot table and its indexes only grow with
+recent traffic. Outbound messages stay until their delivery status is
+final, so attempts and receipts still find them; their attempts are
+archived with them. Archived messages older than MESSAGING_RETENTION_DAYS
+are deleted. Both run from the archive-messages beat task; history reads merge
+the two tables (see MessageHistoryPagination).
+"""
+
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Exists, F, OuterRef, Q, Value, When
+from django.utils import timezone
+
+from messaging.models import (
+    ArchivedDeliveryAttempt,
+    ArchivedMessage,
+    Conversation,
+    DeliveryAttempt,
+    Message,
+    OutboxMessage,
+)
+from messaging.utils import message_search
+from messaging.utils.delivery_status import DELIVERED, FAILED, SENT
+
+ARCHIVED_FIELDS = [
+    'id', 'conversation_id', 'sender_id', 'receiver_id', 'type', 'body', 'attachments',
+    'timestamp', 'provider', 'provider_message_id', 'status', 'status_updated_at', 'attempt_count',
+]
+
+
+def archive_batch(cutoff, batch_size):
+    """
+    Move up to ``batch_size`` of the oldest messages sent before ``cutoff``
+    to the archive, with their delivery attempts, in one transaction.
+
+    The timestamp is the client's, so outbound messages also wait for their
+    delivery to settle: messages still in the outbox or queued stay put,
+    and sent ones until their status is ``cutoff`` old, as providers that
+    send receipts do so well before then. Returns the number moved.
+    """
+    pending = OutboxMessage.objects.filter(message=OuterRef('pk'), dispatched_at__isnull=True)
+    settled = (
+        Q(status__isnull=True) | Q(status__in=[DELIVERED, FAILED]) | Q(status=SENT, status_updated_at__lt=cutoff)
+    )
+    with transaction.atomic():
+        rows = list(
+            Message.objects
+            .filter(settled, timestamp__lt=cutoff)
+            .exclude(Exists(pending))
+            .order_by('timestamp', 'id')
+            .values(*ARCHIVED_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return 0
+        message_ids = [row['id'] for row in rows]
+        ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows])
+        ArchivedDeliveryAttempt.objects.bulk_create([
+            ArchivedDeliveryAttempt(**attempt) for attempt in
+            DeliveryAttempt.objects.filter(message_id__in=message_ids).values('message_id', 'error', 'created_at')
+        ])
+        # Dispatched outbox rows and attempts for these messages go with them.
+        Message.objects.filter(id__in=message_ids).delete()
+    return len(rows)
+
+
+def purge_batch(cutoff, batch_size):
+    """
+    Delete up to ``batch_size`` of the oldest archived messages sent before
+    ``cutoff`` and take them out of their conversations' summaries.
+    Returns the number deleted.
+    """
+    with transaction.atomic():
+        rows = list(
+            ArchivedMessage.objects
+            .filter(timestamp__lt=cutoff)
+            .order_by('timestamp', 'id')
+            .values_list('id', 'conversation_id')[:batch_size]
+        )
+        if not rows:
+            return 0
+        ArchivedMessage.objects.filter(id__in=[row[0] for row in rows]).delete()
+        message_search.remove_messages([row[0] for row in rows])
+
+        for conversation_id, count in Counter(conversation_id for _, conversation_id in rows).items():
+            # The latest message is only deleted along with every other one,
+            # and then the conversation drops out of inboxes.
+            expired = Q(last_message_at__lt=cutoff)
+            Conversation.objects.filter(id=conversation_id).update(
+                message_count=Case(When(message_count__gt=count, then=F('message_count') - count), default=Value(0)),
+                last_message_preview=Case(When(expired, then=Value("")), default=F('last_message_preview')),
+                last_message_at=Case(When(expired, then=Value(None)), default=F('last_message_at')),
+            )
+    return len(rows)
+
+
+def archive_messages(now=None):
+    """
+    Archive messages past MESSAGING_ARCHIVE_AFTER_DAYS and purge archived
+    messages past MESSAGING_RETENTION_DAYS, MESSAGING_ARCHIVE_BATCH_SIZE
+    rows per transaction. A setting of 0 turns that step off.
+
+    Returns counts of archived and purged messages.
+    """
+    now = now or timezone.now()
+    batch_size = settings.MESSAGING_ARCHIVE_BATCH_SIZE
+    stats = {"archived": 0, "purged": 0}
+    for key, days, step in (
+        ("archived", settings.MESSAGING_ARCHIVE_AFTER_DAYS, archive_batch),
+        ("purged", settings.MESSAGING_RETENTION_DAYS, purge_batch),
+    ):
+        if not days:
+            continue
+        cutoff = now - timedelta(days=days)
+        while True:
+            count = step(cutoff, batch_size)
+            stats[key] += count
+            if count < batch_size:
+                break
+    return stats
@@ -1,22 +1,135 @@
 import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models.constants import OnConflict
+from django.db.models.sql import InsertQuery
 from django.utils.dateparse import parse_datetime
-from messaging.models import Participant, Conversation
+from messaging import realtime
+from messaging.models import ArchivedMessage, Participant, Conversation, Message
+from messaging.tasks import schedule_attachment_offload
+from messaging.utils.addresses import normalize_address, participant_fields
+from messaging.utils.cache import LRUCache
+from messaging.utils import message_search
+from messaging.utils.conversation_summary import record_messages
+from messaging.utils.message_validation import validate_message_fields
 
+participant_cache = LRUCache(
+    maxsize=settings.MESSAGING_PARTICIPANT_CACHE_SIZE,
+    ttl=settings.MESSAGING_RESOLUTION_CACHE_TTL
+)
+conversation_cache = LRUCache(
+    maxsize=settings.MESSAGING_CONVERSATION_CACHE_SIZE,
+    ttl=settings.MESSAGING_RESOLUTION_CACHE_TTL
+)
 
-def get_or_create_participant(address):
-    if '@' in address:
-        return Participant.objects.get_or_create(email=address)
-    return Participant.objects.get_or_create(phone=address)
 
+# Resolution is an upsert: look the row up, and if it is missing insert it
+# with ON CONFLICT DO NOTHING and read it back. Callers racing to create the
+# same participant or conversation all end up with the one row the unique
+# constraint let through, without IntegrityErrors or savepoints.
 
-def get_conversation_between(p1, p2):
-    return Conversation.objects.get_or_create(
-        participant_1=min(p1, p2, key=lambda x: x.id),
-        participant_2=max(p1, p2, key=lambda x: x.id)
-    )
+def upsert_participant_id(address_key):
+    participants = Participant.objects.filter(address_key=address_key).values_list('id', flat=True)
+    participant_id = participants.first()
+    if participant_id is None:
+        Participant.objects.bulk_create([Participant(**participant_fields(address_key))], ignore_conflicts=True)
+        participant_id = participants.get()
+    return participant_id
 
 
-def build_validated_message_data(data, require_type=True):
+def upsert_conversation_id(low, high):
+    conversations = Conversation.objects.filter(
+        participant_1_id=low, participant_2_id=high
+    ).values_list('id', flat=True)
+    conversation_id = conversations.first()
+    if conversation_id is None:
+        Conversation.objects.bulk_create(
+            [Conversation(participant_1_id=low, participant_2_id=high)], ignore_conflicts=True
+        )
+        conversation_id = conversations.get()
+    return conversation_id
+
+
+async def aupsert_participant_id(address_key):
+    participants = Participant.objects.filter(address_key=address_key).values_list('id', flat=True)
+    participant_id = await participants.afirst()
+    if participant_id is None:
+        await Participant.objects.abulk_create([Participant(**participant_fields(address_key))], ignore_conflicts=True)
+        participant_id = await participants.aget()
+    return participant_id
+
+
+async def aupsert_conversation_id(low, high):
+    conversations = Conversation.objects.filter(
+        participant_1_id=low, participant_2_id=high
+    ).values_list('id', flat=True)
+    conversation_id = await conversations.afirst()
+    if conversation_id is None:
+        await Conversation.objects.abulk_create(
+            [Conversation(participant_1_id=low, participant_2_id=high)], ignore_conflicts=True
+        )
+        conversation_id = await conversations.aget()
+    return conversation_id
+
+
+def _cache_on_commit(cache, key, value):
+    # Only cache ids of committed rows so a rolled back insert can't leave
+    # a dangling id behind.
+    transaction.on_commit(lambda: cache.set(key, value))
+
+
+def resolve_participant_id(address):
+    """Return the Participant id for ``address``, raising ValueError if it can't be normalized."""
+    address_key = normalize_address(address)
+    participant_id = participant_cache.get(address_key)
+    if participant_id is None:
+        participant_id = upsert_participant_id(address_key)
+        _cache_on_commit(participant_cache, address_key, participant_id)
+    return participant_id
+
+
+def resolve_conversation_id(p1_id, p2_id):
+    key = (min(p1_id, p2_id), max(p1_id, p2_id))
+    conversation_id = conversation_cache.get(key)
+    if conversation_id is None:
+        conversation_id = upsert_conversation_id(*key)
+        _cache_on_commit(conversation_cache, key, conversation_id)
+    return conversation_id
+
+
+async def aresolve_participant_id(address):
+    address_key = normalize_address(address)
+    participant_id = participant_cache.get(address_key)
+    if participant_id is None:
+        participant_id = await aupsert_participant_id(address_key)
+        # The async ORM runs in autocommit mode, so the row is committed.
+        participant_cache.set(address_key, participant_id)
+    return participant_id
+
+
+async def aresolve_conversation_id(p1_id, p2_id):
+    key = (min(p1_id, p2_id), max(p1_id, p2_id))
+    conversation_id = conversation_cache.get(key)
+    if conversation_id is None:
+        conversation_id = await aupsert_conversation_id(*key)
+        conversation_cache.set(key, conversation_id)
+    return conversation_id
+
+
+def get_resolution_cache_stats():
+    return {
+        "participants": participant_cache.stats(),
+        "conversations": conversation_cache.stats(),
+    }
+
+
+def clear_resolution_caches():
+    participant_cache.clear()
+    conversation_cache.clear()
+
+
+def resolve_message_type(data, require_type=True):
     from_address = data.get("from")
     to_address = data.get("to")
     msg_type = data.get("type")
@@ -36,24 +149,317 @@ def build_validated_message_data(data, require_type=True):
     if msg_type not in ["sms", "mms", "email"]:
         raise ValueError(f"Invalid message type: '{msg_type}'.")
 
-    sender, _ = get_or_create_participant(from_address)
-    receiver, _ = get_or_create_participant(to_address)
+    return msg_type
 
-    enriched_data = data.copy()
-    enriched_data['provider_message_id'] = (
+
+def get_provider_message_id(data):
+    return (
         data.get('messaging_provider_id') or
         data.get('xillio_id') or
         str(uuid.uuid4())
     )
-    enriched_data['provider'] = (
-        "sms_provider" if msg_type in ['sms', 'mms'] else "email_provider"
-    )
-    enriched_data['timestamp'] = parse_datetime(data['timestamp'])
 
-    conversation, _ = get_conversation_between(sender, receiver)
-    enriched_data['conversation'] = conversation.id
-    enriched_data['sender'] = sender.id
-    enriched_data['receiver'] = receiver.id
+
+def get_provider_name(msg_type):
+    return "sms_provider" if msg_type in ['sms', 'mms'] else "email_provider"
+
+
+def _enrich_message_data(data, msg_type, sender_id, receiver_id, conversation_id):
+    enriched_data = data.copy()
+    enriched_data['provider_message_id'] = get_provider_message_id(data)
+    enriched_data['provider'] = get_provider_name(msg_type)
+    if isinstance(data.get('timestamp'), str):
+        enriched_data['timestamp'] = parse_datetime(data['timestamp'])
+
+    enriched_data['conversation'] = conversation_id
+    enriched_data['sender'] = sender_id
+    enriched_data['receiver'] = receiver_id
     enriched_data['type'] = msg_type
 
-    return enriched_data, sender, msg_type
+    return enriched_data
+
+
+def build_validated_message_data(data, require_type=True):
+    msg_type = resolve_message_type(data, require_type=require_type)
+
+    sender_id = resolve_participant_id(data["from"])
+    receiver_id = resolve_participant_id(data["to"])
+    conversation_id = resolve_conversation_id(sender_id, receiver_id)
+
+    enriched_data = _enrich_message_data(data, msg_type, sender_id, receiver_id, conversation_id)
+    return enriched_data, sender_id, msg_type
+
+
+async def abuild_validated_message_data(data, require_type=True):
+    msg_type = resolve_message_type(data, require_type=require_type)
+
+    sender_id = await aresolve_participant_id(data["from"])
+    receiver_id = await aresolve_participant_id(data["to"])
+    conversation_id = await aresolve_conversation_id(sender_id, receiver_id)
+
+    enriched_data = _enrich_message_data(data, msg_type, sender_id, receiver_id, conversation_id)
+    return enriched_data, sender_id, msg_type
+
+
+def bulk_resolve_participant_ids(address_keys):
+    """
+    Resolve many normalized addresses to Participant ids using the cache
+    and set-based queries for the misses.
+
+    Returns a dict mapping each address key to its Participant id.
+    """
+    participants = {}
+    for address_key in set(address_keys):
+        participant_id = participant_cache.get(address_key)
+        if participant_id is not None:
+            participants[address_key] = participant_id
+
+    def fetch(keys):
+        return dict(
+            (address_key, participant_id) for participant_id, address_key in
+            Participant.objects.filter(address_key__in=keys).values_list('id', 'address_key')
+        )
+
+    misses = set(address_keys) - participants.keys()
+    fetched = fetch(misses) if misses else {}
+    missing = misses - fetched.keys()
+
+    if missing:
+        # Concurrent requests may create the same address; the unique
+        # constraint on address_key makes this insert safe to race.
+        Participant.objects.bulk_create(
+            [Participant(**participant_fields(address_key)) for address_key in missing],
+            ignore_conflicts=True
+        )
+        fetched.update(fetch(missing))
+
+    for address_key, participant_id in fetched.items():
+        _cache_on_commit(participant_cache, address_key, participant_id)
+    participants.update(fetched)
+
+    return participants
+
+
+def bulk_resolve_conversation_ids(pairs):
+    """
+    Resolve many (participant_id, participant_id) pairs to Conversation ids.
+
+    Pairs are normalized to (lower id, higher id) to match
+    resolve_conversation_id. Returns a dict keyed by the normalized pair.
+    """
+    conversations = {}
+    pairs = {(min(a, b), max(a, b)) for a, b in pairs}
+    for pair in pairs:
+        conversation_id = conversation_cache.get(pair)
+        if conversation_id is not None:
+            conversations[pair] = conversation_id
+    pairs -= conversations.keys()
+
+    def fetch(pairs):
+        found = {}
+        candidates = Conversation.objects.filter(
+            participant_1_id__in={low for low, _ in pairs},
+            participant_2_id__in={high for _, high in pairs},
+        ).order_by('id').values_list('id', 'participant_1_id', 'participant_2_id')
+        for conversation_id, low, high in candidates:
+            if (low, high) in pairs:
+                found.setdefault((low, high), conversation_id)
+        return found
+
+    fetched = fetch(pairs) if pairs else {}
+    missing = pairs - fetched.keys()
+
+    if missing:
+        # As with participants, unique_conversation_participants makes a
+        # racing insert of the same pair a no-op.
+        Conversation.objects.bulk_create([
+            Conversation(participant_1_id=low, participant_2_id=high)
+            for low, high in missing
+        ], ignore_conflicts=True)
+        fetched.update(fetch(missing))
+
+    for pair, conversation_id in fetched.items():
+        _cache_on_commit(conversation_cache, pair, conversation_id)
+    conversations.update(fetched)
+
+    return conversations
+
+
+def _stored_messages(model, **filters):
+    return model.objects.filter(**filters).order_by().values_list('provider', 'provider_message_id')
+
+
+def stored_message_keys(**filters):
+    """
+    (provider, provider_message_id) of stored messages matching ``filters``
+    in both tiers, in one query, so retried webhooks for archived messages
+    are duplicates too.
+    """
+    return _stored_messages(Message, **filters).union(_stored_messages(ArchivedMessage, **filters))
+
+
+def message_exists(provider, provider_message_id):
+    return stored_message_keys(provider=provider, provider_message_id=provider_message_id).exists()
+
+
+async def amessage_exists(provider, provider_message_id):
+    return await stored_message_keys(provider=provider, provider_message_id=provider_message_id).aexists()
+
+
+def _insert_new_messages(messages):
+    """
+    Insert ``messages`` with ON CONFLICT DO NOTHING and return the ones
+    that were stored, with their ids set.
+
+    Like bulk_create(ignore_conflicts=True), a message whose (provider,
+    provider_message_id) is already stored is skipped without an
+    IntegrityError or savepoint, and other violations still raise. The
+    insert also RETURNs the ids and keys of the rows it stored, so callers
+    know which messages to summarize, index and publish without looking
+    them up again. Inbound messages always have a provider_message_id.
+    """
+    if not messages:
+        return []
+    connection = connections[Message.objects.db]
+    opts = Message._meta
+    fields = [field for field in opts.concrete_fields if not field.primary_key]
+    by_key = {(message.provider, message.provider_message_id): message for message in messages}
+    batch_size = max(connection.ops.bulk_batch_size(fields, messages), 1)
+
+    inserted = []
+    for start in range(0, len(messages), batch_size):
+        query = InsertQuery(Message, on_conflict=OnConflict.IGNORE)
+        query.insert_values(fields, messages[start:start + batch_size])
+        compiler = query.get_compiler(connection=connection)
+        compiler.returning_fields = [opts.pk, opts.get_field('provider'), opts.get_field('provider_message_id')]
+        with connection.cursor() as cursor:
+            for sql, params in compiler.as_sql():
+                cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        for message_id, provider, provider_message_id in rows:
+            message = by_key[(provider, provider_message_id)]
+            message.id = message_id
+            message._state.adding = False
+            message._state.db = connection.alias
+            inserted.append(message)
+    return inserted
+
+
+def insert_message(message):
+    """
+    Insert ``message``, fold it into its conversation's summary, add it to
+    the search index and push it to subscribers on commit.
+
+    A concurrent insert of the same (provider, provider_message_id) is
+    silently skipped by the unique constraint instead of raising. Returns
+    whether the message was inserted.
+    """
+    with transaction.atomic():
+        if not _insert_new_messages([message]):
+            return False
+        record_messages([message])
+        message_search.index_messages([message])
+        realtime.publish_messages([message])
+    return True
+
+
+async def ainsert_message(message):
+    # The async ORM has no transactions, so the insert and the summary
+    # update run together on the ORM's sync thread.
+    return await sync_to_async(insert_message)(message)
+
+
+def _drop_duplicate_messages(pending, results):
+    """
+    Mark pending batch items that are already stored, or repeated within
+    the batch, as duplicates with one indexed lookup.
+    """
+    keys = {(message.provider, message.provider_message_id) for _, _, message in pending}
+    existing = set(stored_message_keys(
+        provider__in={provider for provider, _ in keys},
+        provider_message_id__in={provider_message_id for _, provider_message_id in keys},
+    )) if keys else set()
+
+    remaining = []
+    for index, addresses, message in pending:
+        key = (message.provider, message.provider_message_id)
+        if key in existing:
+            results[index] = {"index": index, "status": "duplicate", "detail": "Message already exists."}
+            continue
+        existing.add(key)
+        remaining.append((index, addresses, message))
+    return remaining
+
+
+def ingest_inbound_batch(items):
+    """
+    Validate and store a batch of inbound message payloads.
+
+    Participants and conversations for the whole batch are resolved with a
+    handful of set-based queries and messages are inserted with a single
+    bulk_create. Returns one result dict per item, in order, so a bad
+    payload does not reject the rest of the batch.
+    """
+    results = [None] * len(items)
+    pending = []
+
+    for index, data in enumerate(items):
+        if not isinstance(data, dict):
+            results[index] = {"index": index, "status": "error", "detail": "Expected a message object."}
+            continue
+
+        fields = {key: data[key] for key in ("body", "attachments", "timestamp") if key in data}
+        try:
+            msg_type = resolve_message_type(data, require_type=False)
+            addresses = (normalize_address(data["from"]), normalize_address(data["to"]))
+            # Well-formed but impossible dates (month 13) raise ValueError.
+            if isinstance(fields.get('timestamp'), str):
+                fields['timestamp'] = parse_datetime(fields['timestamp'])
+        except ValueError as e:
+            results[index] = {"index": index, "status": "error", "detail": str(e)}
+            continue
+        fields['provider_message_id'] = get_provider_message_id(data)
+
+        values, errors = validate_message_fields(fields)
+        if errors:
+            results[index] = {"index": index, "status": "error", "errors": errors}
+            continue
+
+        message = Message(type=msg_type, provider=get_provider_name(msg_type), **values)
+        pending.append((index, addresses, message))
+
+    pending = _drop_duplicate_messages(pending, results)
+
+    if pending:
+        participants = bulk_resolve_participant_ids(
+            {address_key for _, addresses, _ in pending for address_key in addresses}
+        )
+        pairs = {}
+        for index, (sender_key, receiver_key), message in pending:
+            message.sender_id = participants[sender_key]
+            message.receiver_id = participants[receiver_key]
+            pairs[index] = (
+                min(message.sender_id, message.receiver_id),
+                max(message.sender_id, message.receiver_id),
+            )
+
+        conversations = bulk_resolve_conversation_ids(pairs.values())
+        for index, _, message in pending:
+            message.conversation_id = conversations[pairs[index]]
+
+        with transaction.atomic():
+            # A concurrent request may have stored some of these since the
+            # duplicate check; the insert skips them.
+            inserted = _insert_new_messages([message for _, _, message in pending])
+            record_messages(inserted)
+            message_search.index_messages(inserted)
+            realtime.publish_messages(inserted)
+            schedule_attachment_offload(inserted)
+
+        for index, _, message in pending:
+            if message.pk is None:
+                results[index] = {"index": index, "status": "duplicate", "detail": "Message already exists."}
+            else:
+                results[index] = {"index": index, "status": "received"}
+
+    return results
@@ -0,0 +1,111 @@
+"""
+Full-text search over message bodies.
+
+Bodies are kept in an inverted index next to the message tables: an FTS5
+table on SQLite and a tsvector column with a GIN index on PostgreSQL,
+created by migration 0013. Every path that inserts messages calls
+index_messages in the same transaction, so the index never lags behind,
+and retention removes rows with remove_messages. Email bodies are
+indexed as plain text with their HTML stripped.
+
+Index rows are keyed by message id, which archived messages keep, so a
+search covers both tiers. Other databases have no index and fall back to
+a substring scan.
+"""
+
+import html
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.html import strip_tags
+
+from messaging.models import ArchivedMessage, Message
+
+SEARCH_TABLE = "messaging_message_search"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_TERM_RE = re.compile(r"\w+")
+
+
+def search_text(message):
+    """The text indexed for ``message``: its body, with HTML stripped from emails."""
+    body = message.body or ""
+    if message.type == "email":
+        body = html.unescape(strip_tags(body))
+    return _WHITESPACE_RE.sub(" ", body).strip()
+
+
+def is_supported():
+    return connection.vendor in ("sqlite", "postgresql")
+
+
+def index_messages(messages):
+    """Add newly inserted ``messages`` to the index."""
+    rows = [(message.id, search_text(message)) for message in messages]
+    if not rows or not is_supported():
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.executemany(f"INSERT OR REPLACE INTO {SEARCH_TABLE} (rowid, body) VALUES (%s, %s)", rows)
+        else:
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (message_id, document) VALUES (%s, to_tsvector('simple', %s)) "
+                f"ON CONFLICT (message_id) DO UPDATE SET document = EXCLUDED.document",
+                rows
+            )
+
+
+def remove_messages(message_ids):
+    """Drop deleted messages from the index."""
+    if not message_ids or not is_supported():
+        return
+    column = "rowid" if connection.vendor == "sqlite" else "message_id"
+    placeholders = ", ".join(["%s"] * len(message_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE {column} IN ({placeholders})", list(message_ids))
+
+
+def rebuild_index(batch_size=1000):
+    """Index every stored message from scratch, ``batch_size`` messages per query. Returns the number indexed."""
+    if not is_supported():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+    indexed = 0
+    for model in (Message, ArchivedMessage):
+        last_id = 0
+        while True:
+            messages = list(model.objects.filter(id__gt=last_id).order_by('id').only('id', 'type', 'body')[:batch_size])
+            if not messages:
+                break
+            index_messages(messages)
+            indexed += len(messages)
+            last_id = messages[-1].id
+    return indexed
+
+
+def parse_terms(query):
+    """The words of a search query; every one of them has to match."""
+    return _TERM_RE.findall(query.lower())
+
+
+def matching(queryset, terms):
+    """Filter a Message or ArchivedMessage queryset to rows whose body contains every one of ``terms``."""
+    if connection.vendor == "sqlite":
+        # Quoted, so user input is always a list of words and never FTS5
+        # query syntax.
+        match = " ".join(f'"{term}"' for term in terms)
+        return queryset.filter(
+            id__in=RawSQL(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s", [match])
+        )
+    if connection.vendor == "postgresql":
+        return queryset.filter(
+            id__in=RawSQL(
+                f"SELECT message_id FROM {SEARCH_TABLE} WHERE document @@ plainto_tsquery('simple', %s)",
+                [" ".join(terms)]
+            )
+        )
+    for term in terms:
+        queryset = queryset.filter(body__icontains=term)
+    return queryset
@@ -0,0 +1,143 @@
+"""
+Fast-path validation for ingest payloads.
+
+MessageSerializer re-validated every field and looked up the conversation,
+sender and receiver by primary key even though build_validated_message_data
+had just resolved them. Instead, the fields a client controls are checked
+against a schema compiled once from the Message model, with the error
+messages DRF used, and the Message is built straight from the resolved ids.
+"""
+
+from datetime import datetime
+
+from django.utils import timezone
+
+from messaging.models import Message
+
+REQUIRED = "This field is required."
+NULL = "This field may not be null."
+BLANK = "This field may not be blank."
+INVALID_STRING = "Not a valid string."
+INVALID_DATETIME = "Expected a datetime but got a {input_type}."
+MAX_LENGTH = "Ensure this field has no more than {max_length} characters."
+
+_MISSING = object()
+
+
+class _Invalid(Exception):
+    pass
+
+
+def _string_field(model_field, required):
+    # Mirrors DRF's CharField: numbers are coerced, surrounding whitespace
+    # is trimmed and blank/null are allowed only where the model allows them.
+    allow_null = model_field.null
+    allow_blank = model_field.blank
+    max_length = model_field.max_length
+    max_length_message = MAX_LENGTH.format(max_length=max_length)
+
+    def clean(value):
+        if value is _MISSING:
+            if required:
+                raise _Invalid(REQUIRED)
+            return _MISSING
+        if value is None:
+            if allow_null:
+                return None
+            raise _Invalid(NULL)
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise _Invalid(INVALID_STRING)
+        value = str(value).strip()
+        if not value and not allow_blank:
+            raise _Invalid(BLANK)
+        if max_length is not None and len(value) > max_length:
+            raise _Invalid(max_length_message)
+        return value
+
+    return clean
+
+
+def _json_field(model_field):
+    # Payloads arrive as parsed JSON, so any value is serializable.
+    allow_null = model_field.null
+
+    def clean(value):
+        if value is None and not allow_null:
+            raise _Invalid(NULL)
+        return value
+
+    return clean
+
+
+def _datetime_field(model_field):
+    allow_null = model_field.null
+    default_timezone = timezone.get_default_timezone()
+
+    def clean(value):
+        if value is _MISSING:
+            raise _Invalid(REQUIRED)
+        if value is None:
+            if allow_null:
+                return None
+            raise _Invalid(NULL)
+        if not isinstance(value, datetime):
+            raise _Invalid(INVALID_DATETIME.format(input_type=type(value).__name__))
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, default_timezone)
+        return value
+
+    return clean
+
+
+def _compile_schema():
+    field = Message._meta.get_field
+    return (
+        ("body", _string_field(field("body"), required=True)),
+        ("attachments", _json_field(field("attachments"))),
+        ("timestamp", _datetime_field(field("timestamp"))),
+        ("provider_message_id", _string_field(field("provider_message_id"), required=False)),
+    )
+
+
+MESSAGE_SCHEMA = _compile_schema()
+
+
+def validate_message_fields(data):
+    """
+    Validate the client-supplied Message fields in ``data``.
+
+    Returns (values, errors): cleaned values keyed by field name, leaving
+    out optional fields that are absent, and a DRF-style dict of error
+    lists that is empty when the payload is valid.
+    """
+    values = {}
+    errors = {}
+    for name, clean in MESSAGE_SCHEMA:
+        try:
+            value = clean(data.get(name, _MISSING))
+        except _Invalid as e:
+            errors[name] = [str(e)]
+            continue
+        if value is not _MISSING:
+            values[name] = value
+    return values, errors
+
+
+def build_message(data):
+    """
+    Build an unsaved Message from the output of build_validated_message_data.
+
+    Returns (message, errors); ``message`` is None when there are errors.
+    """
+    values, errors = validate_message_fields(data)
+    if errors:
+        return None, errors
+    message = Message(
+        conversation_id=data['conversation'],
+        sender_id=data['sender'],
+        receiver_id=data['receiver'],
+        type=data['type'],
+        provider=data['provider'],
+        **values
+    )
+    return message, None
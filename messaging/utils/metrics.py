@@ -0,0 +1,266 @@
+"""
+Lightweight request metrics exported in the Prometheus text format.
+
+RequestMetricsMiddleware counts the queries and DB time of each request
+through an execute wrapper installed on every DB connection; code inside a
+request can time named phases with ``phase("serializer")``. Everything is
+aggregated into fixed-bucket histograms, so the per-request cost is a few
+perf_counter() calls and list increments.
+
+Each process keeps what it observed since its last flush and adds it to
+Redis hashes every MESSAGING_METRICS_FLUSH_INTERVAL seconds from a
+short-lived thread, so /metrics/ serves the totals of every web, relay and
+worker process whichever process answers the scrape.
+"""
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+KEY_PREFIX = "messaging:metrics:"
+# Seconds a flush or scrape waits on Redis before giving up.
+STORE_TIMEOUT = 0.5
+
+_store = None
+
+
+def get_store():
+    """Redis client holding the metrics of every process."""
+    global _store
+    if _store is None:
+        _store = redis.Redis.from_url(
+            settings.MESSAGING_REDIS_URL, socket_timeout=STORE_TIMEOUT, socket_connect_timeout=STORE_TIMEOUT
+        )
+    return _store
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    @property
+    def key(self):
+        return KEY_PREFIX + self.name
+
+    def take(self):
+        """Hand over the observations since the last call, leaving none behind."""
+        with self._lock:
+            series, self._series = self._series, {}
+        return series
+
+    def restore(self, series):
+        """Put back observations that couldn't be flushed."""
+        with self._lock:
+            for labels, (counts, total) in series.items():
+                current = self._series.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0])
+                current[0] = [a + b for a, b in zip(current[0], counts)]
+                current[1] += total
+
+    def write(self, pipe, series):
+        # One hash per histogram; a field is the JSON of the label values
+        # followed by the bucket index, or "sum".
+        for labels, (counts, total) in series.items():
+            for index, count in enumerate(counts):
+                if count:
+                    pipe.hincrby(self.key, json.dumps([*labels, index]), count)
+            pipe.hincrbyfloat(self.key, json.dumps([*labels, "sum"]), total)
+
+    def parse(self, fields):
+        """Stored fields as {labels: [counts, total]}."""
+        series = {}
+        for field, value in fields.items():
+            *labels, index = json.loads(field)
+            entry = series.setdefault(tuple(labels), [[0] * (len(self.buckets) + 1), 0.0])
+            if index == "sum":
+                entry[1] = float(value)
+            else:
+                entry[0][index] = int(value)
+        return series
+
+    def collect(self):
+        """Observations of every process, as far as they have been flushed."""
+        return self.parse(get_store().hgetall(self.key))
+
+    def render(self, stored):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        series = sorted((labels, counts, total) for labels, (counts, total) in self.parse(stored).items())
+        for labels, counts, total in series:
+            label_text = ",".join(f'{name}="{value}"' for name, value in zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+        return lines
+
+
+request_duration = Histogram(
+    "messaging_request_duration_seconds", "Request latency.", ("endpoint", "method")
+)
+request_queries = Histogram(
+    "messaging_request_db_queries", "SQL queries per request.", ("endpoint", "method"), QUERY_BUCKETS
+)
+request_db_time = Histogram(
+    "messaging_request_db_seconds", "Time spent in SQL per request.", ("endpoint", "method")
+)
+phase_duration = Histogram(
+    "messaging_phase_seconds", "Time spent in a named phase, per request or background job.", ("endpoint", "phase")
+)
+
+HISTOGRAMS = [request_duration, request_queries, request_db_time, phase_duration]
+
+
+class RequestMetrics:
+    """What one request has spent so far. ``queries`` is only kept when
+    ``max_queries`` is set, for the slow request log."""
+
+    def __init__(self, max_queries=0):
+        self.query_count = 0
+        self.db_time = 0.0
+        self.phases = {}
+        self.queries = []
+        self.max_queries = max_queries
+
+
+_current = ContextVar("messaging_request_metrics", default=None)
+
+
+def begin_request(state):
+    return _current.set(state)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper that times queries run on behalf of a request."""
+    state = _current.get()
+    if state is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        state.query_count += 1
+        state.db_time += elapsed
+        if len(state.queries) < state.max_queries:
+            state.queries.append((sql, elapsed))
+
+
+@contextmanager
+def phase(name, endpoint="background"):
+    """
+    Time a block as ``name``. Inside a request the time is added to that
+    request's phases; elsewhere it is observed under ``endpoint``.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        state = _current.get()
+        if state is None:
+            phase_duration.observe(elapsed, endpoint, name)
+            _schedule_flush()
+        else:
+            state.phases[name] = state.phases.get(name, 0.0) + elapsed
+
+
+def observe_request(endpoint, method, duration, state):
+    request_duration.observe(duration, endpoint, method)
+    request_queries.observe(state.query_count, endpoint, method)
+    request_db_time.observe(state.db_time, endpoint, method)
+    for name, elapsed in state.phases.items():
+        phase_duration.observe(elapsed, endpoint, name)
+    _schedule_flush()
+
+
+_next_flush = None
+_flush_lock = threading.Lock()
+
+
+def _schedule_flush():
+    """Flush from a background thread once MESSAGING_METRICS_FLUSH_INTERVAL has passed."""
+    global _next_flush
+    now = time.monotonic()
+    with _flush_lock:
+        if _next_flush is None:
+            _next_flush = now + settings.MESSAGING_METRICS_FLUSH_INTERVAL
+        if now < _next_flush:
+            return
+        _next_flush = now + settings.MESSAGING_METRICS_FLUSH_INTERVAL
+    threading.Thread(target=flush, name="metrics-flush", daemon=True).start()
+
+
+def flush():
+    """
+    Add this process's observations since the last flush to the shared
+    store. If Redis is unavailable they are kept for the next flush.
+    """
+    taken = [(histogram, histogram.take()) for histogram in HISTOGRAMS]
+    if not any(series for _, series in taken):
+        return
+    try:
+        pipe = get_store().pipeline()
+        for histogram, series in taken:
+            histogram.write(pipe, series)
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not flush metrics, keeping them for the next flush", exc_info=True)
+        for histogram, series in taken:
+            histogram.restore(series)
+
+
+def render(extra_lines=()):
+    """
+    The shared metrics in the text format, this process's latest included.
+    Raises redis.RedisError when the store is unavailable.
+    """
+    flush()
+    pipe = get_store().pipeline(transaction=False)
+    for histogram in HISTOGRAMS:
+        pipe.hgetall(histogram.key)
+    lines = []
+    for histogram, stored in zip(HISTOGRAMS, pipe.execute()):
+        lines.extend(histogram.render(stored))
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    """Drop this process's unflushed observations."""
+    for histogram in HISTOGRAMS:
+        histogram.clear()
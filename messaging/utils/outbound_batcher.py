@@ -0,0 +1,46 @@
+import msgpack
+from django.conf import settings
+
+from messaging.utils.redis_client import get_redis
+
+
+def _buffer_key(provider_url):
+    return f"messaging:outbound:buffer:{provider_url}"
+
+
+def _window_key(provider_url):
+    return f"messaging:outbound:window:{provider_url}"
+
+
+def push(message_id, body, provider_url):
+    """
+    Append an encoded provider body to the provider's buffer.
+
+    Returns (buffered, opened_window): the buffer length after the push and
+    whether this push opened a new batching window, in which case the
+    caller is responsible for scheduling the flush.
+    """
+    window_ms = max(1, int(settings.OUTBOUND_BATCH_WINDOW * 1000))
+    pipe = get_redis().pipeline()
+    pipe.rpush(_buffer_key(provider_url), msgpack.packb((message_id, body)))
+    # The marker outlives the window so a lost flush task only delays the
+    # buffer until the next push reopens it, rather than stranding it.
+    pipe.set(_window_key(provider_url), 1, nx=True, px=window_ms * 10)
+    buffered, opened_window = pipe.execute()
+    return buffered, bool(opened_window)
+
+
+def drain(provider_url, max_size):
+    """
+    Atomically pop up to ``max_size`` deliveries from the provider's buffer.
+
+    Returns ([(message_id, body), ...], remaining).
+    """
+    key = _buffer_key(provider_url)
+    pipe = get_redis().pipeline()
+    pipe.delete(_window_key(provider_url))
+    pipe.lrange(key, 0, max_size - 1)
+    pipe.ltrim(key, max_size, -1)
+    pipe.llen(key)
+    _, entries, _, remaining = pipe.execute()
+    return [tuple(msgpack.unpackb(entry)) for entry in entries], remaining
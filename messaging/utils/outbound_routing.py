@@ -0,0 +1,65 @@
+"""
+Celery queues for outbound delivery.
+
+Deliveries are routed by message type (OUTBOUND_QUEUES), so a bulk email
+campaign never queues in front of SMS. Messages sent with priority "high",
+such as 2FA codes, skip to OUTBOUND_PRIORITY_QUEUE, and failed attempts
+wait out their backoff on OUTBOUND_RETRY_QUEUE, so a provider outage's
+retries don't hold up fresh messages. Each queue gets its own workers
+with the concurrency in OUTBOUND_QUEUE_CONCURRENCY
+(`manage.py run_outbound_workers`).
+"""
+
+from django.conf import settings
+
+from messaging.constants import PROVIDER_URLS
+
+HIGH, NORMAL = "high", "normal"
+PRIORITIES = (HIGH, NORMAL)
+
+SEND_TASK = "messaging.tasks.send_message_to_provider"
+FLUSH_TASK = "messaging.tasks.flush_outbound_batch"
+
+
+def parse_priority(value):
+    """The priority requested by an outbound payload, raising ValueError if it's unknown."""
+    if value is None:
+        return NORMAL
+    if value not in PRIORITIES:
+        raise ValueError(f"Expected one of {', '.join(PRIORITIES)}.")
+    return value
+
+
+def queue_for(provider_url, priority=NORMAL):
+    """The queue a delivery to ``provider_url`` is sent to."""
+    if priority == HIGH:
+        return settings.OUTBOUND_PRIORITY_QUEUE
+    # SMS and MMS share a provider URL, so they share a queue.
+    for msg_type, url in PROVIDER_URLS.items():
+        if url == provider_url and msg_type in settings.OUTBOUND_QUEUES:
+            return settings.OUTBOUND_QUEUES[msg_type]
+    return settings.CELERY_TASK_DEFAULT_QUEUE
+
+
+def retry_queue(priority=NORMAL):
+    """High priority messages are retried in their own lane too."""
+    return settings.OUTBOUND_PRIORITY_QUEUE if priority == HIGH else settings.OUTBOUND_RETRY_QUEUE
+
+
+def _argument(args, kwargs, index, name, default=None):
+    if args and len(args) > index:
+        return args[index]
+    return (kwargs or {}).get(name, default)
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Celery router (CELERY_TASK_ROUTES) for the delivery tasks. A ``queue``
+    passed to apply_async, as retries do, takes precedence.
+    """
+    if name == SEND_TASK:
+        provider_url = _argument(args, kwargs, 1, "provider_url")
+        return {"queue": queue_for(provider_url, _argument(args, kwargs, 3, "priority", NORMAL))}
+    if name == FLUSH_TASK:
+        return {"queue": queue_for(_argument(args, kwargs, 0, "provider_url"))}
+    return None
@@ -0,0 +1,106 @@
+"""
+Backfill Participant.address_key for rows created before addresses were
+normalized, merging participants whose addresses turn out to be the same.
+"""
+
+import logging
+from collections import Counter, defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from messaging.models import ArchivedMessage, Conversation, Message, Participant
+from messaging.utils.addresses import normalize_address, participant_fields
+from messaging.utils.conversation_summary import rebuild_summaries
+
+logger = logging.getLogger(__name__)
+
+
+def merge_participants(survivor_id, duplicate_ids):
+    """
+    Fold ``duplicate_ids`` into ``survivor_id``: their messages move to the
+    survivor, their conversations are re-pointed or, where the survivor
+    already has a conversation with the same person, merged into it.
+    """
+    for duplicate_id in duplicate_ids:
+        conversations = Conversation.objects.filter(
+            Q(participant_1_id=duplicate_id) | Q(participant_2_id=duplicate_id)
+        ).values_list('id', 'participant_1_id', 'participant_2_id')
+        for conversation_id, participant_1_id, participant_2_id in list(conversations):
+            other_id = participant_2_id if participant_1_id == duplicate_id else participant_1_id
+            if other_id == duplicate_id:
+                other_id = survivor_id
+            low, high = min(survivor_id, other_id), max(survivor_id, other_id)
+            target_id = (
+                Conversation.objects
+                .filter(participant_1_id=low, participant_2_id=high)
+                .exclude(id=conversation_id)
+                .values_list('id', flat=True)
+                .first()
+            )
+            if target_id is None:
+                Conversation.objects.filter(id=conversation_id).update(participant_1_id=low, participant_2_id=high)
+            else:
+                for model in (Message, ArchivedMessage):
+                    model.objects.filter(conversation_id=conversation_id).update(conversation_id=target_id)
+                Conversation.objects.filter(id=conversation_id).delete()
+                rebuild_summaries([target_id])
+
+        for model in (Message, ArchivedMessage):
+            model.objects.filter(sender_id=duplicate_id).update(sender_id=survivor_id)
+            model.objects.filter(receiver_id=duplicate_id).update(receiver_id=survivor_id)
+        Participant.objects.filter(id=duplicate_id).delete()
+
+
+def _normalize_group(address_key, participant_ids, dry_run):
+    # A request may create the keyed participant while we work, so the
+    # survivor is chosen inside the transaction and the group is retried if
+    # the key was taken in between.
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                keyed_id = Participant.objects.filter(address_key=address_key).values_list('id', flat=True).first()
+                survivor_id = keyed_id or participant_ids[0]
+                duplicate_ids = [participant_id for participant_id in participant_ids if participant_id != survivor_id]
+                if not dry_run:
+                    merge_participants(survivor_id, duplicate_ids)
+                    Participant.objects.filter(id=survivor_id).update(**participant_fields(address_key))
+                return len(duplicate_ids)
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"Could not normalize participants for {address_key!r}.")
+
+
+def normalize_participants(batch_size=500, dry_run=False):
+    """
+    Give every participant without an address_key its normalized key,
+    merging rows that normalize to the same address. Rows whose address
+    can't be normalized are logged and left alone.
+
+    Returns counts of normalized, merged and invalid participants.
+    """
+    stats = Counter(normalized=0, merged=0, invalid=0)
+    last_id = 0
+    while True:
+        rows = list(
+            Participant.objects
+            .filter(address_key__isnull=True, id__gt=last_id)
+            .order_by('id')
+            .values_list('id', 'email', 'phone')[:batch_size]
+        )
+        if not rows:
+            return stats
+        last_id = rows[-1][0]
+
+        groups = defaultdict(list)
+        for participant_id, email, phone in rows:
+            try:
+                groups[normalize_address(email or phone or "")].append(participant_id)
+            except ValueError as e:
+                logger.warning("Participant %s not normalized: %s", participant_id, e)
+                stats["invalid"] += 1
+
+        for address_key, participant_ids in groups.items():
+            merged = _normalize_group(address_key, participant_ids, dry_run)
+            stats["normalized"] += len(participant_ids) - merged
+            stats["merged"] += merged
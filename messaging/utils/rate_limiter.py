@@ -0,0 +1,126 @@
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from messaging.constants import PROVIDER_RATE_LIMITS
+from messaging.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Token bucket refilled at `rate` tokens per second up to `burst`. After a
+# 429 the rate is halved and climbs back to the configured rate over
+# `recovery` seconds, and no tokens are handed out until Retry-After passes.
+# Returns the seconds the caller should wait, 0 if a token was taken.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local recovery = tonumber(ARGV[4])
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at', 'rate', 'blocked_until')
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+local rate = tonumber(state[3]) or max_rate
+local blocked_until = tonumber(state[4]) or 0
+
+-- Nothing refills while Retry-After is in force, so the end of a 429
+-- doesn't release a full burst at once.
+rate = math.min(max_rate, rate + math.max(0, now - updated_at) * max_rate / recovery)
+tokens = math.min(burst, tokens + math.max(0, now - math.max(updated_at, blocked_until)) * rate)
+
+local wait = 0
+if blocked_until > now then
+    wait = blocked_until - now
+elseif tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+PENALIZE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local retry_after = tonumber(ARGV[2])
+local max_rate = tonumber(ARGV[3])
+local min_rate = tonumber(ARGV[4])
+
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or max_rate
+rate = math.max(min_rate, rate / 2)
+
+redis.call('HSET', KEYS[1], 'rate', rate, 'tokens', 0, 'updated_at', now, 'blocked_until', now + retry_after)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+_scripts = {}
+
+
+def _bucket_key(provider_url):
+    return f"messaging:ratelimit:{provider_url}"
+
+
+def _run(source, keys, args):
+    client = get_redis()
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = client.register_script(source)
+    return script(keys=keys, args=args, client=client)
+
+
+def acquire(provider_url, now=None):
+    """
+    Take a token for ``provider_url`` from the bucket shared by all workers.
+
+    Returns 0 when the request may go out now, otherwise the number of
+    seconds to wait. Providers without a configured limit, and Redis
+    outages, never block delivery.
+    """
+    limit = PROVIDER_RATE_LIMITS.get(provider_url)
+    if limit is None:
+        return 0
+    try:
+        wait = _run(
+            ACQUIRE_SCRIPT,
+            keys=[_bucket_key(provider_url)],
+            args=[now or time.time(), limit["rate"], limit["burst"], settings.PROVIDER_RATE_LIMIT_RECOVERY]
+        )
+    except redis.RedisError:
+        logger.warning("Rate limiter unavailable, sending to %s without a token", provider_url, exc_info=True)
+        return 0
+    return float(wait)
+
+
+def penalize(provider_url, retry_after, now=None):
+    """Halve the provider's rate and hold all workers off for ``retry_after`` seconds."""
+    limit = PROVIDER_RATE_LIMITS.get(provider_url)
+    if limit is None:
+        return
+    try:
+        _run(
+            PENALIZE_SCRIPT,
+            keys=[_bucket_key(provider_url)],
+            args=[now or time.time(), retry_after, limit["rate"], limit["rate"] * settings.PROVIDER_RATE_LIMIT_MIN_FRACTION]
+        )
+    except redis.RedisError:
+        logger.warning("Rate limiter unavailable, could not record 429 from %s", provider_url, exc_info=True)
+
+
+def wait_for_token(provider_url):
+    """
+    Sleep through short waits until a token is taken.
+
+    Returns 0 once the caller may send, or the wait in seconds when it is
+    longer than PROVIDER_RATE_LIMIT_MAX_SLEEP and the caller should
+    reschedule instead of holding the worker.
+    """
+    while True:
+        wait = acquire(provider_url)
+        if wait == 0 or wait > settings.PROVIDER_RATE_LIMIT_MAX_SLEEP:
+            return wait
+        time.sleep(wait)
@@ -0,0 +1,17 @@
+import redis
+from django.conf import settings
+
+_client = None
+
+
+def get_redis():
+    """
+    Shared Redis client for coordination state (batch buffers, rate limits).
+
+    redis-py's connection pool detects forks, so one module-level client is
+    safe across Celery's prefork workers.
+    """
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.MESSAGING_REDIS_URL)
+    return _client
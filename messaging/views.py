@@ -1,52 +1,453 @@
-from copy import deepcopy
+import json
 
+import redis
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from django.db import IntegrityError
 
-from .constants import PROVIDER_URLS
-from .serializers import MessageSerializer
-from .tasks import send_message_to_provider
-from .utils.message_helpers import build_validated_message_data
+from . import realtime
+from .constants import INBOUND_BATCH_MAX_SIZE, PROVIDER_URLS
+from .models import ArchivedMessage, Attachment, Conversation, Message, OutboxMessage, Participant
+from .pagination import ConversationPagination, InboxPagination, MessageHistoryPagination, MessageSearchPagination
+from .providers import encode_provider_body
+from .serializers import ConversationSerializer, MessageHistorySerializer
+from .tasks import schedule_attachment_offload
+from .utils import attachment_store, delivery_status, message_search, metrics, outbound_routing
+from .utils.addresses import normalize_address
+from .utils.conversation_summary import record_messages
+from .utils.message_helpers import (
+    abuild_validated_message_data,
+    ainsert_message,
+    amessage_exists,
+    build_validated_message_data,
+    get_provider_name,
+    get_resolution_cache_stats,
+    ingest_inbound_batch,
+    insert_message,
+    message_exists,
+)
+from .utils.message_validation import build_message
 
 
 class InboundMessageAPIView(APIView):
     def post(self, request):
         try:
-            data, sender, _ = build_validated_message_data(request.data, require_type=False)
+            with metrics.phase("resolve"):
+                data, sender_id, _ = build_validated_message_data(request.data, require_type=False)
         except ValueError as e:
             return Response({"detail": str(e)}, status=400)
 
-        serializer = MessageSerializer(data=data)
-        if serializer.is_valid():
+        # Provider webhook retries are answered with one indexed lookup on
+        # (provider, provider_message_id) instead of a rejected insert.
+        if message_exists(data['provider'], data['provider_message_id']):
+            return Response({"detail": "Message already exists."}, status=200)
+
+        with metrics.phase("validation"):
+            message, errors = build_message(data)
+        if errors:
+            return Response(errors, status=400)
+
+        # A concurrent retry may still win the race for the unique constraint.
+        if not insert_message(message):
+            return Response({"detail": "Message already exists."}, status=200)
+        schedule_attachment_offload([message])
+        return Response({"status": "received"}, status=201)
+
+
+class InboundMessageBatchAPIView(APIView):
+    def post(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"detail": "Expected a list of messages."}, status=400)
+
+        if len(items) > INBOUND_BATCH_MAX_SIZE:
+            return Response(
+                {"detail": f"Batch exceeds maximum size of {INBOUND_BATCH_MAX_SIZE}."},
+                status=400
+            )
+
+        return Response({"results": ingest_inbound_batch(items)}, status=207)
+
+
+def parse_receipt(data):
+    """(provider, provider_message_id, status) for a delivery receipt, raising ValueError if it's malformed."""
+    if not isinstance(data, dict):
+        raise ValueError("Expected a receipt object.")
+    if data.get('messaging_provider_id'):
+        provider, provider_message_id = get_provider_name('sms'), data['messaging_provider_id']
+    elif data.get('xillio_id'):
+        provider, provider_message_id = get_provider_name('email'), data['xillio_id']
+    else:
+        raise ValueError("Missing 'messaging_provider_id' or 'xillio_id'.")
+    status = data.get('status')
+    if status not in delivery_status.RECEIPT_STATUSES:
+        raise ValueError(f"Unknown delivery status '{status}'.")
+    return provider, str(provider_message_id), status
+
+
+class DeliveryReceiptAPIView(APIView):
+    """
+    Provider delivery receipts, one object or a list. Receipts for unknown
+    messages and stale receipts are counted but not rejected, so providers
+    don't retry them.
+
+    Outbound bodies carry our ``provider_message_id``; providers echo it
+    back on receipts as ``messaging_provider_id`` (SMS/MMS) or
+    ``xillio_id`` (email), which is what receipts are matched on.
+    """
+
+    def post(self, request):
+        if not isinstance(request.data, list):
             try:
-                serializer.save()
-            except IntegrityError:
-                return Response({"detail": "Message already exists."}, status=200)
-            return Response({"status": "received"}, status=201)
+                receipts = [parse_receipt(request.data)]
+            except ValueError as e:
+                return Response({"detail": str(e)}, status=400)
+            return Response(delivery_status.apply_receipts(receipts), status=200)
 
-        return Response(serializer.errors, status=400)
+        items = request.data
+        if len(items) > INBOUND_BATCH_MAX_SIZE:
+            return Response(
+                {"detail": f"Batch exceeds maximum size of {INBOUND_BATCH_MAX_SIZE}."},
+                status=400
+            )
+        # A malformed item is skipped and reported, so one bad receipt
+        # doesn't make the provider retry the whole batch.
+        receipts, errors = [], []
+        for index, item in enumerate(items):
+            try:
+                receipts.append(parse_receipt(item))
+            except ValueError as e:
+                errors.append({"index": index, "status": "error", "detail": str(e)})
+        return Response({**delivery_status.apply_receipts(receipts), "errors": errors}, status=200)
 
 
 class OutboundMessageAPIView(APIView):
     def post(self, request):
         try:
-            data, sender, msg_type = build_validated_message_data(request.data, require_type=True)
+            with metrics.phase("resolve"):
+                data, sender_id, msg_type = build_validated_message_data(request.data, require_type=True)
         except ValueError as e:
             return Response({"detail": str(e)}, status=400)
 
-        serializer = MessageSerializer(data=data)
-        if serializer.is_valid():
-            serializer.save()
+        try:
+            priority = outbound_routing.parse_priority(data.pop('priority', None))
+        except ValueError as e:
+            return Response({"priority": [str(e)]}, status=400)
+
+        with metrics.phase("validation"):
+            message, errors = build_message(data)
+        if errors:
+            return Response(errors, status=400)
+
+        missing = attachment_store.unknown_refs(message.attachments)
+        if missing:
+            return Response(unknown_attachments_error(missing), status=400)
+
+        save_outbound_message(message, data, msg_type, priority)
+        return Response({"status": "queued"}, status=202)
 
-            safe_data = deepcopy(data)
-            safe_data['timestamp'] = safe_data['timestamp'].isoformat()
 
-            send_message_to_provider.delay(
-                safe_data,
-                PROVIDER_URLS.get(msg_type)
+def unknown_attachments_error(refs):
+    return {"attachments": [f"Unknown attachment '{ref}'." for ref in refs]}
+
+
+def save_outbound_message(message, data, msg_type, priority=outbound_routing.NORMAL):
+    # Encoded once here; the relay, broker and worker pass these bytes on
+    # to the provider untouched. Attachments go out as download URLs so
+    # the provider fetches the media itself.
+    if message.attachments:
+        data = {**data, 'attachments': attachment_store.resolve_refs(message.attachments)}
+    body = encode_provider_body(data)
+
+    # The message and its outbox entry commit together; the relay
+    # publishes to the broker outside the request.
+    message.status = delivery_status.QUEUED
+    message.status_updated_at = timezone.now()
+    with transaction.atomic():
+        message.save()
+        record_messages([message])
+        message_search.index_messages([message])
+        realtime.publish_messages([message])
+        OutboxMessage.objects.create(
+            message=message,
+            provider_url=PROVIDER_URLS.get(msg_type),
+            body=body,
+            priority=priority
+        )
+
+
+def load_json_body(request):
+    """Parse a JSON object request body, returning (data, error_response)."""
+    try:
+        data = json.loads(request.body)
+    except ValueError as e:
+        return None, JsonResponse({"detail": f"JSON parse error - {e}"}, status=400)
+    if not isinstance(data, dict):
+        return None, JsonResponse({"detail": "Expected a message object."}, status=400)
+    return data, None
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncInboundMessageView(View):
+    """
+    InboundMessageAPIView for ASGI deployments. Lookups and the insert use
+    the async ORM, so a slow database doesn't hold a worker thread per
+    webhook connection. Responses match the sync view.
+    """
+
+    async def post(self, request):
+        payload, error = load_json_body(request)
+        if error:
+            return error
+
+        try:
+            with metrics.phase("resolve"):
+                data, sender_id, _ = await abuild_validated_message_data(payload, require_type=False)
+        except ValueError as e:
+            return JsonResponse({"detail": str(e)}, status=400)
+
+        if await amessage_exists(data['provider'], data['provider_message_id']):
+            return JsonResponse({"detail": "Message already exists."}, status=200)
+
+        with metrics.phase("validation"):
+            message, errors = build_message(data)
+        if errors:
+            return JsonResponse(errors, status=400)
+
+        if not await ainsert_message(message):
+            return JsonResponse({"detail": "Message already exists."}, status=200)
+        await sync_to_async(schedule_attachment_offload)([message])
+        return JsonResponse({"status": "received"}, status=201)
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncOutboundMessageView(View):
+    """
+    OutboundMessageAPIView for ASGI deployments. The message and its outbox
+    row are written in one transaction on the ORM's sync thread; nothing
+    talks to the broker during the request.
+    """
+
+    async def post(self, request):
+        payload, error = load_json_body(request)
+        if error:
+            return error
+
+        try:
+            with metrics.phase("resolve"):
+                data, sender_id, msg_type = await abuild_validated_message_data(payload, require_type=True)
+        except ValueError as e:
+            return JsonResponse({"detail": str(e)}, status=400)
+
+        try:
+            priority = outbound_routing.parse_priority(data.pop('priority', None))
+        except ValueError as e:
+            return JsonResponse({"priority": [str(e)]}, status=400)
+
+        with metrics.phase("validation"):
+            message, errors = build_message(data)
+        if errors:
+            return JsonResponse(errors, status=400)
+
+        missing = await sync_to_async(attachment_store.unknown_refs)(message.attachments)
+        if missing:
+            return JsonResponse(unknown_attachments_error(missing), status=400)
+
+        await sync_to_async(save_outbound_message)(message, data, msg_type, priority)
+        return JsonResponse({"status": "queued"}, status=202)
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AttachmentUploadView(View):
+    """
+    Store the raw request body as an attachment. The body is streamed to
+    disk in chunks, never held in memory whole, and content already stored
+    is answered with the existing attachment (200 instead of 201).
+    """
+
+    def post(self, request):
+        chunks = iter(lambda: request.read(attachment_store.CHUNK_SIZE), b"")
+        try:
+            attachment, created = attachment_store.store(chunks, content_type=request.content_type)
+        except attachment_store.AttachmentTooLarge as e:
+            return JsonResponse({"detail": str(e)}, status=413)
+
+        return JsonResponse({
+            "id": attachment_store.make_ref(attachment.sha256),
+            "sha256": attachment.sha256,
+            "size": attachment.size,
+            "content_type": attachment.content_type,
+            "url": attachment_store.public_url(attachment.sha256),
+        }, status=201 if created else 200)
+
+
+class AttachmentDownloadView(View):
+    """
+    Stream a stored attachment from disk. Uploads are untrusted, so it is
+    always served as a download and browsers aren't allowed to sniff it
+    into something they would render.
+    """
+
+    def get(self, request, sha256):
+        attachment = Attachment.objects.filter(sha256=sha256).only('content_type').first()
+        if attachment is None:
+            raise Http404("Unknown attachment.")
+        try:
+            handle = attachment_store.get_backend().open(sha256)
+        except FileNotFoundError:
+            raise Http404("Unknown attachment.")
+        response = FileResponse(
+            handle, content_type=attachment.content_type, as_attachment=True, filename=sha256
+        )
+        response["X-Content-Type-Options"] = "nosniff"
+        return response
+
+
+class ResolutionCacheStatsAPIView(APIView):
+    def get(self, request):
+        return Response(get_resolution_cache_stats())
+
+
+class MetricsView(View):
+    """
+    Request histograms of every process and this process's resolution
+    cache counters in the Prometheus text format.
+    """
+
+    def get(self, request):
+        lines = []
+        for stat, kind in (("hits", "counter"), ("misses", "counter"), ("size", "gauge"), ("maxsize", "gauge")):
+            name = f"messaging_resolution_cache_{stat}" + ("_total" if kind == "counter" else "")
+            lines.append(f"# TYPE {name} {kind}")
+            for cache, stats in get_resolution_cache_stats().items():
+                lines.append(f'{name}{{cache="{cache}"}} {stats[stat]}')
+        try:
+            body = metrics.render(lines)
+        except redis.RedisError:
+            return HttpResponse("Metrics store unavailable.\n", status=503, content_type="text/plain")
+        return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class ConversationListAPIView(generics.ListAPIView):
+    serializer_class = ConversationSerializer
+    pagination_class = ConversationPagination
+
+    def get_queryset(self):
+        queryset = Conversation.objects.select_related('participant_1', 'participant_2')
+        participant = self.request.query_params.get('participant')
+        if participant:
+            try:
+                address_key = normalize_address(participant)
+            except ValueError:
+                return queryset.none()
+            queryset = queryset.filter(
+                Q(participant_1__address_key=address_key) | Q(participant_2__address_key=address_key)
             )
+        return queryset
+
+
+class InboxAPIView(generics.ListAPIView):
+    """A participant's conversations by latest activity, with their preview and message count."""
+    serializer_class = ConversationSerializer
+    pagination_class = InboxPagination
+
+    def list(self, request, *args, **kwargs):
+        participant = request.query_params.get('participant')
+        if not participant:
+            return Response({"detail": "The 'participant' query parameter is required."}, status=400)
+        try:
+            address_key = normalize_address(participant)
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=400)
+
+        conversations = Conversation.objects.select_related('participant_1', 'participant_2').filter(
+            last_message_at__isnull=False
+        )
+        page = self.paginate_queryset([
+            conversations.filter(participant_1__address_key=address_key),
+            conversations.filter(participant_2__address_key=address_key),
+        ])
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
 
-            return Response({"status": "queued"}, status=202)
 
-        return Response(serializer.errors, status=400)
+class ConversationDetailAPIView(generics.RetrieveAPIView):
+    serializer_class = ConversationSerializer
+    queryset = Conversation.objects.select_related('participant_1', 'participant_2')
+
+
+class ConversationMessagesAPIView(generics.ListAPIView):
+    """A conversation's history, spanning the hot and archived message tables."""
+    serializer_class = MessageHistorySerializer
+    pagination_class = MessageHistoryPagination
+
+    def list(self, request, *args, **kwargs):
+        conversation = get_object_or_404(Conversation.objects.only('id'), pk=self.kwargs['pk'])
+        page = self.paginate_queryset([
+            model.objects.filter(conversation=conversation).select_related('sender', 'receiver')
+            for model in (Message, ArchivedMessage)
+        ])
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
+class MessageSearchAPIView(generics.ListAPIView):
+    """
+    Messages whose body contains every word of ``q``, newest first, from
+    the hot and archived tables. Optionally narrowed by ``conversation``,
+    ``participant`` (either side), ``type`` and an ``after``/``before``
+    timestamp range.
+    """
+    serializer_class = MessageHistorySerializer
+    pagination_class = MessageSearchPagination
+
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        terms = message_search.parse_terms(params.get('q', ''))
+        if not terms:
+            return Response({"detail": "The 'q' query parameter is required."}, status=400)
+
+        filters = Q()
+        if 'conversation' in params:
+            try:
+                conversation_id = int(params['conversation'])
+            except ValueError:
+                conversation_id = None
+            # Ids past the bigint range overflow the database driver.
+            if conversation_id is None or not 0 < conversation_id < 2 ** 63:
+                return Response({"detail": "'conversation' must be a conversation id."}, status=400)
+            filters &= Q(conversation_id=conversation_id)
+        if 'participant' in params:
+            try:
+                address_key = normalize_address(params['participant'])
+            except ValueError as e:
+                return Response({"detail": str(e)}, status=400)
+            participant_id = Participant.objects.filter(address_key=address_key).values_list('id', flat=True).first()
+            filters &= Q(sender_id=participant_id) | Q(receiver_id=participant_id)
+        if 'type' in params:
+            if params['type'] not in dict(Message.MESSAGE_TYPES):
+                return Response({"detail": f"Unknown message type '{params['type']}'."}, status=400)
+            filters &= Q(type=params['type'])
+        for param, lookup in (('after', 'timestamp__gte'), ('before', 'timestamp__lt')):
+            if param in params:
+                try:
+                    value = parse_datetime(params[param])
+                except ValueError:
+                    value = None
+                if value is None:
+                    return Response({"detail": f"'{param}' must be an ISO 8601 timestamp."}, status=400)
+                filters &= Q(**{lookup: value})
+
+        page = self.paginate_queryset([
+            message_search.matching(model.objects.filter(filters), terms).select_related('sender', 'receiver')
+            for model in (Message, ArchivedMessage)
+        ])
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)